@@ -0,0 +1,86 @@
+"""
+Benchmark degli estrattori HTML (extractors.py) su pagine prodotto salvate.
+
+Uso (dalla radice del progetto):
+    python benchmarks/bench_extractors.py
+    python benchmarks/bench_extractors.py --dir /percorso/pagine_salvate --repeat 50
+    python benchmarks/bench_extractors.py --pad-kb 500   # simula pagine Amazon reali (~500 KB)
+
+Per ogni fixture e per ogni estrattore misura il tempo medio di parsing e il picco di memoria
+(tracemalloc), e verifica che il risultato coincida con quello di BeautifulSoup.
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from extractors import StreamingExtractor, LxmlExtractor, SoupExtractor, LXML_AVAILABLE  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Blocco di riempimento: script inline e markup come nelle pagine prodotto reali
+FILLER_SCRIPT = "<script>P.when('A').execute(function(A){var d=" + "[1,2,3,4,5,6,7,8,9,0]," * 40 + "0;});</script>\n"
+FILLER_MARKUP = '<div class="a-section a-spacing-small"><span class="a-list-item">Dettaglio prodotto</span></div>\n' * 10
+
+def load_fixtures(directory: str, pad_kb: int) -> dict:
+    pages = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".html"):
+            continue
+        with open(os.path.join(directory, name), "rb") as f:
+            content = f.read()
+        if pad_kb:
+            content = pad_page(content, pad_kb * 1024)
+        pages[name] = content
+    return pages
+
+def pad_page(content: bytes, target_size: int) -> bytes:
+    """Aggiunge script in <head> e markup in coda al <body> fino a target_size byte."""
+    head_block = FILLER_SCRIPT.encode()
+    tail_block = FILLER_MARKUP.encode()
+    missing = max(0, target_size - len(content))
+    head = head_block * (missing // 4 // len(head_block))
+    tail = tail_block * (missing * 3 // 4 // len(tail_block))
+    content = content.replace(b"</head>", head + b"</head>", 1)
+    return content.replace(b"</body>", tail + b"</body>", 1)
+
+def measure(extractor, content: bytes, repeat: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = extractor.extract(content)
+    elapsed_ms = (time.perf_counter() - start) / repeat * 1000
+
+    tracemalloc.start()
+    extractor.extract(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed_ms, peak / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark degli estrattori HTML")
+    parser.add_argument("--dir", default=FIXTURES_DIR, help="cartella con le pagine .html salvate")
+    parser.add_argument("--repeat", type=int, default=20, help="ripetizioni per misura")
+    parser.add_argument("--pad-kb", type=int, default=0, help="gonfia ogni fixture fino a N KB")
+    args = parser.parse_args()
+
+    extractors = [StreamingExtractor()]
+    if LXML_AVAILABLE:
+        extractors.append(LxmlExtractor())
+    else:
+        print("lxml non installato: estrattore lxml escluso dal confronto.\n")
+    extractors.append(SoupExtractor())
+
+    print(f"{'fixture':<32} {'KB':>6} {'estrattore':<10} {'ms/pagina':>10} {'picco KB':>10}  ok")
+    for name, content in load_fixtures(args.dir, args.pad_kb).items():
+        reference = SoupExtractor().extract(content)
+        for extractor in extractors:
+            result, elapsed_ms, peak_kb = measure(extractor, content, args.repeat)
+            ok = "✓" if result == reference else "✗"
+            print(f"{name:<32} {len(content) / 1024:>6.0f} {extractor.name:<10} {elapsed_ms:>10.3f} {peak_kb:>10.0f}  {ok}")
+
+if __name__ == "__main__":
+    main()
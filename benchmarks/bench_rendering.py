@@ -0,0 +1,75 @@
+"""
+Microbenchmark del rendering dei post (rendering.py): costo per post di caption + tastiera.
+
+Uso (dalla radice del progetto):
+    python benchmarks/bench_rendering.py
+    python benchmarks/bench_rendering.py --drafts 5000 --channels 4
+
+Misura tre casi:
+    freddo    bozze mai viste (escape, formattazione e URL-encoding completi)
+    caldo     le stesse bozze di nuovo (anteprima -> pubblicazione: resta solo l'intestazione casuale)
+    batch     render_batch su una coda in cui ogni bozza va su --channels canali
+"""
+import os
+import sys
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import rendering  # noqa: E402
+
+TITLES = [
+    "Cuffie Bluetooth [2024] - Over-Ear, 60h di autonomia (nero) *offerta*",
+    "Robot aspirapolvere con stazione di svuotamento, 4000 Pa, mappatura LiDAR",
+    "Set di 6 padelle antiaderenti + coperchi in vetro, adatte a induzione",
+    "Monitor 27\" QHD 165Hz IPS, 1ms, FreeSync Premium, HDR10",
+]
+
+def make_drafts(count: int) -> list:
+    drafts = []
+    for i in range(count):
+        asin = f"B0{i:08d}"
+        drafts.append({
+            "asin": asin,
+            "title": f"{TITLES[i % len(TITLES)]} #{i}",
+            "final_buy_link": f"https://www.amazon.it/dp/{asin}?tag=legione-21",
+            "prezzo_precedente": 129.99 + i % 50,
+            "prezzo_attuale": 79.99 + i % 30,
+        })
+    return drafts
+
+def per_post_us(func, items: list) -> float:
+    start = time.perf_counter()
+    func(items)
+    return (time.perf_counter() - start) / len(items) * 1_000_000
+
+def render_each(drafts: list) -> None:
+    for draft in drafts:
+        rendering.build_final_message(draft)
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark del rendering dei post")
+    parser.add_argument("--drafts", type=int, default=1000, help="bozze distinte")
+    parser.add_argument("--channels", type=int, default=3, help="canali per bozza nel caso batch")
+    args = parser.parse_args()
+
+    # Cache dimensionata sul numero di bozze, altrimenti il caso caldo misura le espulsioni
+    rendering._render_body.cache_clear()
+    drafts = make_drafts(args.drafts)
+    if args.drafts > rendering.RENDER_CACHE_SIZE:
+        print(f"Attenzione: {args.drafts} bozze > RENDER_CACHE_SIZE={rendering.RENDER_CACHE_SIZE}, il caso caldo sarà parzialmente freddo.\n")
+
+    cold = per_post_us(render_each, drafts)
+    warm = per_post_us(render_each, drafts)
+    fanned = [draft for draft in drafts for _ in range(args.channels)]
+    batch = per_post_us(rendering.render_batch, fanned)
+
+    print(f"{'caso':<10} {'µs/post':>10} {'post/s':>12}")
+    for name, value in (("freddo", cold), ("caldo", warm), (f"batch x{args.channels}", batch)):
+        print(f"{name:<10} {value:>10.2f} {1_000_000 / value:>12.0f}")
+    print(f"\nCache: {rendering.render_cache_info()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Bot API di Telegram finta (aiohttp) per test e benchmark offline.
+
+Risponde a getMe, setWebhook, sendMessage, sendPhoto, ... registrando ogni chiamata con il suo
+timestamp, così un test può misurare quanto tempo passa tra un aggiornamento e la risposta del bot.
+Si usa passando base_url=FakeTelegramAPI.base_url a bot.build_application().
+"""
+import time
+import asyncio
+import itertools
+
+from aiohttp import web
+
+BOT_USER = {
+    "id": 100000001,
+    "is_bot": True,
+    "first_name": "Legione Harness",
+    "username": "legione_harness_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": True,
+}
+
+class FakeTelegramAPI:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        # Ritardo artificiale per simulare il round-trip verso i server Telegram
+        self.latency = latency
+        self.calls = []
+        self._message_ids = itertools.count(1)
+        self._waiters = []
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    def wait_for(self, method: str, predicate=None) -> asyncio.Future:
+        """Future risolto (con i parametri) alla prossima chiamata `method` che soddisfa `predicate`."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((method, predicate, future))
+        return future
+
+    def calls_of(self, method: str) -> list:
+        return [call for call in self.calls if call[1] == method]
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls.append((time.perf_counter(), method, params))
+
+        for waiter in list(self._waiters):
+            wanted, predicate, future = waiter
+            if wanted == method and not future.done() and (predicate is None or predicate(params)):
+                future.set_result(params)
+                self._waiters.remove(waiter)
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "sendPhoto", "editMessageText"):
+            return self._message(method, params)
+        return True
+
+    def _message(self, method: str, params: dict) -> dict:
+        message_id = next(self._message_ids)
+        chat_id = int(params.get("chat_id", 0)) if str(params.get("chat_id", "0")).lstrip("-").isdigit() else 0
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+            "from": BOT_USER,
+        }
+        if method == "sendPhoto":
+            message["photo"] = [{"file_id": f"fake-file-{message_id}", "file_unique_id": f"u{message_id}", "width": 500, "height": 500}]
+            message["caption"] = params.get("caption", "")
+        else:
+            message["text"] = params.get("text", "")
+        return message
+
+def make_message_update(update_id: int, chat_id: int, text: str) -> dict:
+    """Aggiornamento sintetico: messaggio privato di un admin (comandi riconosciuti come tali)."""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private", "first_name": "Admin"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Admin"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
@@ -0,0 +1,292 @@
+"""
+Suite di benchmark/load-test completamente offline: pagine Amazon salvate servite da stub_amazon.py
+e Bot API finta (fake_telegram.py), nessuna chiamata esterna.
+
+Misure:
+    parse      tempo di parsing per fixture ed estrattore (extractors.py)
+    render     throughput di rendering.build_final_message (caption + tastiera, memoizzate)
+    scrape     latenza dello scraper asincrono (fetch + parsing) e throughput in batch, link brevi
+    e2e        latenza link -> anteprima attraverso conv_handler (fino a "1️⃣ Inserisci il prezzo")
+    admins     scalabilità con N admin che inviano un link nello stesso momento
+
+I risultati vengono salvati in benchmarks/results/<data>.json e confrontati con una baseline:
+una metrica peggiorata oltre --tolerance viene segnalata e il processo esce con codice 1.
+
+Uso (dalla radice del progetto):
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --only parse render --repeat 50
+    python benchmarks/run_benchmarks.py --admins 1 10 50 --amazon-latency-ms 300
+    python benchmarks/run_benchmarks.py --save-baseline      # la run diventa la nuova baseline
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import platform
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+DEFAULT_BASELINE = os.path.join(RESULTS_DIR, "baseline.json")
+SUITES = ("parse", "render", "scrape", "e2e", "admins")
+
+STUB_PORT = 8082
+API_PORT = 8081
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+def fake_asin(index: int) -> str:
+    """ASIN sempre diversi: ogni richiesta salta la cache prodotti e arriva allo stub."""
+    return f"B0{index:08d}"
+
+class Results:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name: str, value: float, unit: str, better: str = "lower") -> None:
+        self.metrics[name] = {"value": round(value, 4), "unit": unit, "better": better}
+        print(f"  {name:<44} {value:>12.3f} {unit}")
+
+    def add_latencies(self, prefix: str, latencies: list) -> None:
+        self.add(f"{prefix}.p50_ms", percentile(latencies, 0.5), "ms")
+        self.add(f"{prefix}.p95_ms", percentile(latencies, 0.95), "ms")
+
+# --- Suite ---
+
+def bench_parse(results: Results, repeat: int, pad_kb: int) -> None:
+    from bench_extractors import FIXTURES_DIR, load_fixtures, measure
+    from extractors import StreamingExtractor, LxmlExtractor, SoupExtractor, LXML_AVAILABLE
+
+    extractors = [StreamingExtractor(), SoupExtractor()]
+    if LXML_AVAILABLE:
+        extractors.insert(1, LxmlExtractor())
+
+    for name, content in load_fixtures(FIXTURES_DIR, pad_kb).items():
+        fixture = name.rsplit(".", 1)[0]
+        for extractor in extractors:
+            _, elapsed_ms, peak_kb = measure(extractor, content, repeat)
+            results.add(f"parse.{fixture}.{extractor.name}_ms", elapsed_ms, "ms")
+            results.add(f"parse.{fixture}.{extractor.name}_peak_kb", peak_kb, "KB")
+
+def bench_render(results: Results, iterations: int) -> None:
+    import rendering
+    from bench_rendering import make_drafts, per_post_us, render_each
+
+    rendering._render_body.cache_clear()
+    drafts = make_drafts(min(iterations, rendering.RENDER_CACHE_SIZE))
+    cold = per_post_us(render_each, drafts)
+    warm = per_post_us(render_each, drafts)
+    batch = per_post_us(rendering.render_batch, [draft for draft in drafts for _ in range(3)])
+    results.add("render.build_final_message_cold_us", cold, "µs")
+    results.add("render.build_final_message_us", warm, "µs")
+    results.add("render.build_final_message_per_s", 1_000_000 / warm, "msg/s", better="higher")
+    results.add("render.batch_3_channels_us", batch, "µs")
+
+async def bench_scrape(results: Results, stub, requests_count: int, concurrency: int) -> None:
+    import utils
+
+    latencies = []
+    for i in range(requests_count):
+        started = time.perf_counter()
+        data = await utils.get_amazon_product_details_async(f"https://www.amazon.it/dp/{fake_asin(i)}", use_cache=False)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if not data or not data.get("title"):
+            raise RuntimeError(f"Scraping dello stub fallito per {fake_asin(i)}")
+    results.add_latencies("scrape.single", latencies)
+
+    urls = [f"https://www.amazon.it/dp/{fake_asin(100_000 + i)}" for i in range(requests_count * 4)]
+    started = time.perf_counter()
+    products = await utils.get_many_product_details_async(urls, concurrency=concurrency)
+    elapsed = time.perf_counter() - started
+    ok = sum(1 for product in products if product)
+    results.add("scrape.batch_pages_per_s", ok / elapsed, "pagine/s", better="higher")
+    results.add("scrape.batch_success_ratio", ok / len(urls), "ratio", better="higher")
+
+    latencies = []
+    for i in range(requests_count):
+        started = time.perf_counter()
+        asin = await utils.resolve_short_link_async(stub.short_url(fake_asin(200_000 + i)))
+        latencies.append((time.perf_counter() - started) * 1000)
+        if asin != fake_asin(200_000 + i):
+            raise RuntimeError(f"Link breve risolto male: {asin}")
+    results.add_latencies("scrape.short_link", latencies)
+
+async def send_links(application, api, admins: int, offset: int) -> tuple:
+    """N admin inviano un link insieme; ritorna (latenze in ms, durata totale in s)."""
+    from telegram import Update
+    from fake_telegram import make_message_update
+
+    latencies = []
+
+    async def _one(index: int):
+        chat_id = 50_000 + offset + index
+        reply = api.wait_for(
+            "sendMessage",
+            lambda p, c=chat_id: p.get("chat_id") == str(c) and p.get("text", "").startswith(("1️⃣", "❌", "🛑")),
+        )
+        link = f"https://www.amazon.it/dp/{fake_asin(300_000 + offset + index)}"
+        update = Update.de_json(make_message_update(offset + index + 1, chat_id, link), application.bot)
+        started = time.perf_counter()
+        await application.update_queue.put(update)
+        params = await asyncio.wait_for(reply, timeout=60)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if not params["text"].startswith("1️⃣"):
+            raise RuntimeError(f"Anteprima non riuscita per la chat {chat_id}: {params['text']}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(_one(i) for i in range(admins)))
+    return latencies, time.perf_counter() - started
+
+async def bench_conversation(results: Results, suites: list, api, requests_count: int, admin_levels: list) -> None:
+    import bot
+
+    application = bot.build_application(token=os.environ["TELEGRAM_BOT_TOKEN"], base_url=api.base_url)
+    await application.initialize()
+    await application.start()
+    try:
+        offset = 0
+        if "e2e" in suites:
+            latencies = []
+            for _ in range(requests_count):
+                sample, _ = await send_links(application, api, 1, offset)
+                latencies.extend(sample)
+                offset += 1
+            results.add_latencies("e2e.link_to_preview", latencies)
+
+        if "admins" in suites:
+            for admins in admin_levels:
+                latencies, wall = await send_links(application, api, admins, offset)
+                offset += admins
+                results.add_latencies(f"admins.{admins}", latencies)
+                results.add(f"admins.{admins}.links_per_s", admins / wall, "link/s", better="higher")
+    finally:
+        await application.stop()
+        await application.shutdown()
+
+async def run_async(results: Results, suites: list, args, stub) -> None:
+    from fake_telegram import FakeTelegramAPI
+    import utils
+
+    await stub.start()
+    api = FakeTelegramAPI(port=API_PORT, latency=args.api_latency_ms / 1000)
+    await api.start()
+    try:
+        if "scrape" in suites:
+            print("\n[scrape]")
+            await bench_scrape(results, stub, args.requests, args.concurrency)
+        if "e2e" in suites or "admins" in suites:
+            print("\n[e2e / admins]")
+            await bench_conversation(results, suites, api, args.requests, args.admins)
+    finally:
+        await utils.close_http_session()
+        await api.stop()
+        await stub.stop()
+
+# --- Confronto con la baseline ---
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """Ritorna le metriche peggiorate oltre `tolerance` (frazione, es. 0.15)."""
+    regressions = []
+    print(f"\nConfronto con la baseline del {baseline.get('created', '?')} (tolleranza {tolerance:.0%}):")
+    for name, metric in current["metrics"].items():
+        old = baseline.get("metrics", {}).get(name)
+        if not old or not old["value"]:
+            continue
+        change = (metric["value"] - old["value"]) / old["value"]
+        worse = change > tolerance if metric["better"] == "lower" else change < -tolerance
+        flag = "  ⚠️ REGRESSIONE" if worse else ""
+        print(f"  {name:<44} {old['value']:>12.3f} -> {metric['value']:>12.3f} ({change:+.1%}){flag}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+def save(results: Results, args, suites: list) -> dict:
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"suites": suites, **{k: v for k, v in vars(args).items() if k not in ("only", "baseline")}},
+        "metrics": results.metrics,
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nRisultati salvati in {path}")
+    if args.save_baseline:
+        shutil.copyfile(path, args.baseline)
+        print(f"Baseline aggiornata: {args.baseline}")
+    return report
+
+def configure_environment(args) -> None:
+    """Da chiamare PRIMA di importare i moduli del bot (leggono la configurazione all'import)."""
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCH")
+    os.environ["ADMIN_IDS"] = ""
+    os.environ["AMAZON_BASE_URL"] = f"http://127.0.0.1:{STUB_PORT}"
+    # Niente Postgres nei benchmark: cache solo in memoria
+    os.environ["PRODUCT_CACHE_PERSIST"] = "0"
+    # Le immagini delle fixture puntano al CDN vero: la foto viaggia come URL verso la Bot API finta
+    os.environ["IMAGE_PIPELINE"] = "0"
+    # Livello letto da metrics.py (i moduli del bot loggano solo errori gravi)
+    os.environ["LOG_LEVEL"] = "CRITICAL"
+    if not args.realistic:
+        # Senza pacing il benchmark misura il nostro codice, non le attese volute verso Amazon
+        os.environ["AMAZON_MIN_INTERVAL"] = "0"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark e load-test offline del bot")
+    parser.add_argument("--only", nargs="+", choices=SUITES, help="esegue solo alcune suite")
+    parser.add_argument("--repeat", type=int, default=20, help="ripetizioni per le misure di parsing")
+    parser.add_argument("--pad-kb", type=int, default=0, help="gonfia le fixture fino a N KB")
+    parser.add_argument("--render-iterations", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=30, help="richieste sequenziali per scrape/e2e")
+    parser.add_argument("--concurrency", type=int, default=5, help="concorrenza dello scraping in batch")
+    parser.add_argument("--admins", type=int, nargs="+", default=[1, 5, 20], help="livelli di admin concorrenti")
+    parser.add_argument("--amazon-latency-ms", type=float, default=50, help="latenza simulata dello stub Amazon")
+    parser.add_argument("--api-latency-ms", type=float, default=20, help="latenza simulata della Bot API")
+    parser.add_argument("--realistic", action="store_true", help="mantiene il pacing di request_controller.py")
+    parser.add_argument("--output", help="file JSON dei risultati (default: benchmarks/results/<data>.json)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline con cui confrontare")
+    parser.add_argument("--save-baseline", action="store_true", help="salva questa run come baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="peggioramento tollerato (0.15 = 15%%)")
+    args = parser.parse_args()
+
+    suites = args.only or list(SUITES)
+    configure_environment(args)
+    # Il bot logga ogni passaggio: qui interessa solo l'output del benchmark
+    logging.basicConfig(level=logging.CRITICAL)
+
+    from stub_amazon import StubAmazon
+
+    results = Results()
+    if "parse" in suites:
+        print("[parse]")
+        bench_parse(results, args.repeat, args.pad_kb)
+    if "render" in suites:
+        print("\n[render]")
+        bench_render(results, args.render_iterations)
+    if {"scrape", "e2e", "admins"} & set(suites):
+        stub = StubAmazon(port=STUB_PORT, latency=args.amazon_latency_ms / 1000, pad_kb=args.pad_kb)
+        # I gestori non stampano nulla (usano il logging, qui ridotto a CRITICAL): l'output è solo del benchmark
+        asyncio.run(run_async(results, suites, args, stub))
+
+    report = save(results, args, suites)
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metriche peggiorate oltre la tolleranza.")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
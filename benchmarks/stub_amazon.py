@@ -0,0 +1,77 @@
+"""
+Server Amazon finto (aiohttp) che serve le pagine prodotto salvate in benchmarks/fixtures.
+
+    GET  /dp/{asin}    -> fixture associata all'ASIN (default: product_landing_image.html)
+    HEAD /s/{code}     -> 301 verso /dp/{asin}, come i link brevi amzn.to / amzn.eu
+
+Si usa impostando AMAZON_BASE_URL=StubAmazon.base_url prima di importare utils.py: lo scraper
+scarica allora le pagine da qui, passando comunque da request_controller.py e dal parsing reale.
+"""
+import os
+import asyncio
+
+from aiohttp import web
+
+from bench_extractors import FIXTURES_DIR, pad_page
+
+DEFAULT_FIXTURE = "product_landing_image.html"
+
+# ASIN "speciali" per provocare pagine particolari; tutti gli altri ricevono DEFAULT_FIXTURE
+FIXTURE_BY_ASIN = {
+    "B0BLISS001": "product_img_bliss.html",
+    "B0CAPTCHA1": "captcha.html",
+}
+
+class StubAmazon:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8082, latency: float = 0.0, pad_kb: int = 0):
+        self.host = host
+        self.port = port
+        # Ritardo artificiale per simulare il tempo di risposta di Amazon
+        self.latency = latency
+        self.requests = 0
+        self._pages = self._load_pages(pad_kb)
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def product_url(self, asin: str) -> str:
+        return f"{self.base_url}/dp/{asin}"
+
+    def short_url(self, asin: str) -> str:
+        return f"{self.base_url}/s/{asin}"
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/dp/{asin}", self._product)
+        app.router.add_route("HEAD", "/s/{code}", self._short_link)
+        app.router.add_get("/s/{code}", self._short_link, allow_head=False)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _load_pages(self, pad_kb: int) -> dict:
+        pages = {}
+        for name in set(FIXTURE_BY_ASIN.values()) | {DEFAULT_FIXTURE}:
+            with open(os.path.join(FIXTURES_DIR, name), "rb") as f:
+                content = f.read()
+            pages[name] = pad_page(content, pad_kb * 1024) if pad_kb else content
+        return pages
+
+    async def _product(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        name = FIXTURE_BY_ASIN.get(request.match_info["asin"], DEFAULT_FIXTURE)
+        return web.Response(body=self._pages[name], content_type="text/html", charset="utf-8")
+
+    async def _short_link(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        raise web.HTTPMovedPermanently(location=f"/dp/{request.match_info['code']}?ref_=stub")
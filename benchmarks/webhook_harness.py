@@ -0,0 +1,104 @@
+"""
+Harness locale per la modalità webhook: avvia la Bot API finta, avvia il bot in modalità webhook
+puntato su di essa e invia aggiornamenti sintetici al server webhook (con il secret token),
+misurando la latenza aggiornamento -> risposta del bot.
+
+Uso (dalla radice del progetto):
+    python benchmarks/webhook_harness.py --updates 200 --concurrency 20
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Valori di prova prima di importare bot.py (che li legge all'import)
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:HARNESS")
+os.environ.setdefault("ADMIN_IDS", "")
+
+import aiohttp  # noqa: E402
+from fake_telegram import FakeTelegramAPI, make_message_update  # noqa: E402
+import bot  # noqa: E402
+
+SECRET = "harness-secret"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+async def run(updates: int, concurrency: int, api_latency: float) -> None:
+    api = FakeTelegramAPI(latency=api_latency)
+    await api.start()
+
+    application = bot.build_application(token=os.environ["TELEGRAM_BOT_TOKEN"], base_url=api.base_url)
+    await application.initialize()
+    await application.start()
+    await application.updater.start_webhook(
+        listen="127.0.0.1",
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH}",
+        secret_token=SECRET,
+        allowed_updates=bot.ALLOWED_UPDATES,
+    )
+    url = f"http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH}"
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            # 1. Un aggiornamento senza secret token deve essere rifiutato
+            async with session.post(url, json=make_message_update(1, 1, "/start")) as response:
+                print(f"Richiesta senza secret token: HTTP {response.status} (atteso 403)")
+
+            # 2. Latenza aggiornamento -> sendMessage, con `concurrency` admin in parallelo
+            semaphore = asyncio.Semaphore(concurrency)
+            latencies = []
+
+            async def _one(index: int):
+                chat_id = 10_000 + index
+                async with semaphore:
+                    reply = api.wait_for("sendMessage", lambda p, c=chat_id: p.get("chat_id") == str(c))
+                    started = time.perf_counter()
+                    async with session.post(
+                        url,
+                        json=make_message_update(index + 2, chat_id, "/start"),
+                        headers={"X-Telegram-Bot-Api-Secret-Token": SECRET},
+                    ) as response:
+                        response.raise_for_status()
+                    await asyncio.wait_for(reply, timeout=10)
+                    latencies.append((time.perf_counter() - started) * 1000)
+
+            wall_start = time.perf_counter()
+            await asyncio.gather(*(_one(i) for i in range(updates)))
+            wall = time.perf_counter() - wall_start
+
+        print(f"Aggiornamenti: {updates}, concorrenza: {concurrency}, latenza API finta: {api_latency * 1000:.0f} ms")
+        print(f"Latenza aggiornamento -> risposta: media {statistics.mean(latencies):.1f} ms, "
+              f"p50 {percentile(latencies, 0.5):.1f} ms, p95 {percentile(latencies, 0.95):.1f} ms, "
+              f"max {max(latencies):.1f} ms")
+        print(f"Throughput: {updates / wall:.0f} aggiornamenti/s")
+        webhook_calls = api.calls_of("setWebhook")
+        if webhook_calls:
+            print(f"allowed_updates registrati: {webhook_calls[-1][2].get('allowed_updates')}")
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await api.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Harness webhook con Bot API finta")
+    parser.add_argument("--updates", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--api-latency-ms", type=float, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args.updates, args.concurrency, args.api_latency_ms / 1000))
+
+if __name__ == "__main__":
+    main()
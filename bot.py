@@ -1,4 +1,10 @@
+import time
+# Cronometro di avvio: parte prima di qualunque altro import (vedi startup.py)
+STARTED = time.perf_counter()
+
 import os
+import re
+import asyncio
 import logging
 from telegram.ext import Application, CommandHandler
 from telegram import Update
@@ -8,16 +14,25 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Importa le funzioni e il conversation handler dal tuo file handlers.py
-from handlers import start, help_command, conv_handler, cancel
-from database import init_db
-
-# Configurazione del logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-logging.getLogger("httpx").setLevel(logging.WARNING)
+from handlers import start, help_command, conv_handler, cancel, aggiungi_canale, lista_canali, stato
+from bulk import bulk_handlers
+from database import close_pool
+from utils import close_http_session
+from scheduler import setup_publish_queue
+from watcher import setup_price_watcher, watch_handlers
+from feeds import setup_feed_ingestion, close_feed_session, feed_handlers
+from inline_search import load_search_index, inline_handlers
+from workers import shutdown_workers
+from images import close_image_session
+from metrics import setup_logging, setup_metrics, shutdown_metrics, InstrumentedRequest
+from persistence import PostgresPersistence, PERSISTENCE_ENABLED
+from startup import StartupTimer, run_background_startup
+
 logger = logging.getLogger(__name__)
 
+startup_timer = StartupTimer(STARTED)
+startup_timer.mark("import")
+
 # Carica il token del bot dai Secrets
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
@@ -25,25 +40,151 @@ if not TELEGRAM_BOT_TOKEN:
     logger.error("ERRORE: TELEGRAM_BOT_TOKEN non trovato nei Secrets!")
     exit(1)
 
-def main():
-    """Avvia il bot e registra gli handler corretti."""
-    # Inizializza il database SQLite
-    init_db()
+# --- Modalità di ricezione degli aggiornamenti ---
+# BOT_MODE=polling (default) oppure webhook (server HTTP asincrono integrato in python-telegram-bot)
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")            # es: https://legione.example.com
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "8080"))
+
+# Connessioni HTTP verso la Bot API (stesso default di python-telegram-bot)
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", "256"))
+
+# Telegram accetta solo 1-256 caratteri A-Z, a-z, 0-9, _ e - come secret_token
+WEBHOOK_SECRET_RE = re.compile(r'^[A-Za-z0-9_-]{1,256}$')
+
+# Il bot gestisce solo messaggi, pulsanti e ricerche inline: Telegram non invia nient'altro
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
+
+# Init DB, ripristino della coda e warm-up: girano mentre il bot risponde già (vedi startup.py)
+_background_startup = None
+
+async def post_init(application: Application) -> None:
+    """Registra i servizi periodici; tutto ciò che richiede rete o DB parte dopo l'avvio."""
+    # Con PERSISTENCE, initialize legge lo stato salvato (pool DB + una query): fase riportata a parte
+    load_seconds = getattr(application.persistence, "load_seconds", None)
+    startup_timer.mark("initialize", **({"persistence_load": load_seconds} if load_seconds is not None else {}))
+    setup_price_watcher(application)
+    setup_feed_ingestion(application)
+    await setup_metrics(application)
+    application.job_queue.run_once(on_started, 0, name="startup")
+    startup_timer.mark("post_init")
+
+async def on_db_ready(application: Application) -> None:
+    """Servizi che leggono dal DB: coda di pubblicazione, poi indice della ricerca inline."""
+    await setup_publish_queue(application)
+    await load_search_index(application)
 
-    # Crea l'applicazione del bot
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+async def on_started(context) -> None:
+    """Primo job dopo l'avvio del polling/webhook: da qui il bot serve gli aggiornamenti."""
+    global _background_startup
+    startup_timer.mark("start")
+    startup_timer.report("Bot pronto")
+    _background_startup = asyncio.create_task(
+        run_background_startup(context.application, startup_timer, on_db_ready)
+    )
+
+async def post_shutdown(application: Application) -> None:
+    """Rilascia le risorse condivise: sessioni HTTP, endpoint metriche, pool di parsing e pool DB."""
+    if _background_startup is not None and not _background_startup.done():
+        _background_startup.cancel()
+    await close_http_session()
+    await close_feed_session()
+    await close_image_session()
+    await shutdown_metrics()
+    shutdown_workers()
+    close_pool()
+
+def build_application(token: str = TELEGRAM_BOT_TOKEN, base_url: str = None) -> Application:
+    """
+    Crea l'Application e registra gli handler.
+    base_url permette di puntare a una Bot API locale (vedi benchmarks/webhook_harness.py).
+    """
+    # concurrent_updates: uno scraping lento non blocca gli altri amministratori
+    # post_init: avvia il dispatcher della coda di pubblicazione e il watcher prezzi
+    # post_shutdown: chiude la sessione HTTP condivisa dello scraper e il pool DB
+    # request: ogni chiamata alla Bot API viene cronometrata (metrica telegram_request_seconds)
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(InstrumentedRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if PERSISTENCE_ENABLED:
+        # Conversazioni, bozze e coda bulk sopravvivono ai riavvii (vedi persistence.py)
+        builder = builder.persistence(PostgresPersistence())
+    application = builder.build()
 
     # --- Registrazione degli Handlers ---
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("cancel", cancel))
+    application.add_handler(CommandHandler("aggiungi_canale", aggiungi_canale))
+    application.add_handler(CommandHandler("canali", lista_canali))
+    application.add_handler(CommandHandler("stato", stato))
+
+    # Watchlist prezzi: /segui, /smetti, /seguiti
+    for handler in watch_handlers:
+        application.add_handler(handler)
+
+    # Feed RSS/Atom di offerte: /aggiungi_feed, /rimuovi_feed, /feed
+    for handler in feed_handlers:
+        application.add_handler(handler)
+
+    # Modalità bulk: più link (o file .txt/.csv) in un solo messaggio -> coda di bozze
+    for handler in bulk_handlers:
+        application.add_handler(handler)
+
+    # Ricerca inline delle offerte: @bot parola o @bot ASIN
+    for handler in inline_handlers:
+        application.add_handler(handler)
 
     # Gestisce tutto il flusso: link -> prezzo1 -> prezzo2 -> conferma
     application.add_handler(conv_handler)
+    return application
+
+def run_webhook(application: Application) -> None:
+    """Avvia il server webhook: Telegram spinge gli aggiornamenti, niente long-polling."""
+    if not WEBHOOK_URL:
+        logger.error("ERRORE: BOT_MODE=webhook richiede WEBHOOK_URL!")
+        exit(1)
+    if not WEBHOOK_SECRET_RE.match(WEBHOOK_SECRET):
+        logger.error("ERRORE: WEBHOOK_SECRET mancante o non valido (1-256 caratteri tra A-Z, a-z, 0-9, _ e -)!")
+        exit(1)
+
+    webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+    logger.info(f"🚀 Bot avviato in modalità webhook su {WEBHOOK_LISTEN}:{PORT}/{WEBHOOK_PATH}")
+    # Le richieste senza header X-Telegram-Bot-Api-Secret-Token corretto vengono rifiutate (403)
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=webhook_url,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=ALLOWED_UPDATES,
+    )
+
+def main():
+    """Avvia il bot e registra gli handler corretti."""
+    # Logging non bloccante (tramite coda e thread dedicato: vedi metrics.py). Qui e non all'import:
+    # i processi del pool di parsing reimportano questo file come __mp_main__ (vedi workers.py)
+    setup_logging()
+    # Il database viene inizializzato in background dopo l'avvio (startup.py)
+    application = build_application()
+    startup_timer.mark("build")
 
     # --- Avvio del Bot ---
-    logger.info("🚀 Bot avviato! In attesa di comandi dagli amministratori...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == "webhook":
+        run_webhook(application)
+    else:
+        logger.info("🚀 Bot avviato! In attesa di comandi dagli amministratori...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
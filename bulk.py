@@ -0,0 +1,227 @@
+import os
+import re
+import logging
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ContextTypes, MessageHandler, CallbackQueryHandler, filters
+
+from handlers import (
+    admin_only,
+    make_draft,
+    submit_drafts,
+    send_product_photo,
+)
+from rendering import build_final_message
+from extractors import parse_price_text
+from utils import get_many_product_details_async
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+BULK_MAX_LINKS = int(os.environ.get("BULK_MAX_LINKS", "100"))
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", "5"))
+
+LINK_RE = re.compile(r'https?://(?:amzn\.[a-z]{2,3}|www\.amazon\.[a-z]{2,3})[^\s,;]*', re.IGNORECASE)
+# Prezzi: "1.299,99" (migliaia all'italiana) oppure "129.99" / "129,99"
+PRICE_RE = re.compile(r'\d{1,3}(?:\.\d{3})+(?:,\d{1,2})?|\d+(?:[.,]\d{1,2})?')
+
+# Messaggio con almeno due link Amazon su righe diverse => modalità bulk
+BULK_TEXT_FILTER = filters.TEXT & ~filters.COMMAND & filters.Regex(
+    r'(?is)https?://(?:amzn\.|www\.amazon\.).*\n.*https?://(?:amzn\.|www\.amazon\.)'
+)
+BULK_FILE_FILTER = filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv")
+
+def parse_bulk_lines(text: str) -> tuple:
+    """
+    Una riga per prodotto: <link> <prezzo iniziale> <prezzo attuale>
+    (separatori: spazio, virgola o punto e virgola, come in un CSV).
+    Restituisce (voci valide, righe scartate con motivo).
+    """
+    entries, errors = [], []
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        link_match = LINK_RE.search(line)
+        if not link_match:
+            # Intestazione CSV o riga senza link: la ignoriamo solo se non contiene prezzi
+            if PRICE_RE.search(line):
+                errors.append((line_no, "link mancante"))
+            continue
+
+        rest = line[:link_match.start()] + " " + line[link_match.end():]
+        prices = PRICE_RE.findall(rest)
+        if len(prices) < 2:
+            errors.append((line_no, "servono prezzo iniziale e prezzo attuale"))
+            continue
+
+        prezzo_precedente = parse_price_text(prices[0])
+        prezzo_attuale = parse_price_text(prices[1])
+        if prezzo_precedente is None or prezzo_attuale is None:
+            errors.append((line_no, "prezzo non valido"))
+            continue
+
+        entries.append({
+            'line': line_no,
+            'url': link_match.group(0),
+            'prezzo_precedente': prezzo_precedente,
+            'prezzo_attuale': prezzo_attuale,
+        })
+    return entries, errors
+
+async def build_bulk_drafts(entries: list) -> tuple:
+    """Scarica in parallelo (pool limitato) i dettagli di tutti i link e crea le bozze."""
+    results = await get_many_product_details_async([e['url'] for e in entries], concurrency=BULK_CONCURRENCY)
+
+    drafts, failed = [], []
+    for entry, product_data in zip(entries, results):
+        if product_data and product_data.get('title'):
+            draft = make_draft(product_data)
+            draft['prezzo_precedente'] = entry['prezzo_precedente']
+            draft['prezzo_attuale'] = entry['prezzo_attuale']
+            drafts.append(draft)
+        else:
+            failed.append((entry['line'], "scraping fallito"))
+    return drafts, failed
+
+def _bulk_keyboard(remaining: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Pubblica", callback_data="bulk:send"),
+         InlineKeyboardButton("⏭️ Salta", callback_data="bulk:skip")],
+        [InlineKeyboardButton(f"🚀 Pubblica tutte ({remaining})", callback_data="bulk:all"),
+         InlineKeyboardButton("❌ Annulla tutto", callback_data="bulk:cancel")],
+    ])
+
+async def _show_next_draft(bot, chat_id: int, user_data: dict) -> None:
+    """Mostra l'anteprima della prossima bozza in coda con i pulsanti di approvazione."""
+    queue = user_data.get('bulk_queue') or []
+    if not queue:
+        await bot.send_message(chat_id=chat_id, text="🏁 Coda bulk completata.")
+        return
+
+    draft = queue[0]
+    caption, reply_markup = build_final_message(draft)
+    await send_product_photo(bot, chat_id, draft.get('image_url'), draft.get('asin'), caption=caption, reply_markup=reply_markup, parse_mode='MarkdownV2')
+
+    await bot.send_message(
+        chat_id=chat_id,
+        text=f"Bozza 1 di {len(queue)} in coda. Pubblico?",
+        reply_markup=_bulk_keyboard(len(queue)),
+    )
+
+async def _start_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
+    entries, errors = parse_bulk_lines(text)
+    if not entries:
+        await update.message.reply_text("⚠️ Nessuna riga valida. Formato: <link> <prezzo iniziale> <prezzo attuale>")
+        return
+    if len(entries) > BULK_MAX_LINKS:
+        await update.message.reply_text(f"⚠️ Troppi link: massimo {BULK_MAX_LINKS} per invio.")
+        return
+
+    await update.message.reply_text(f"🔎 Analizzo {len(entries)} link in parallelo...")
+    drafts, failed = await build_bulk_drafts(entries)
+    errors.extend(failed)
+
+    # Si accoda a quanto già in attesa (bozze del watcher prezzi o dei feed, vedi offer_drafts)
+    queue = context.user_data.setdefault('bulk_queue', [])
+    was_empty = not queue
+    queue.extend(drafts)
+    summary = f"✅ {len(drafts)} bozze pronte"
+    if not was_empty:
+        summary += f", aggiunte in fondo alla coda ({len(queue)} in attesa)"
+    if errors:
+        details = "\n".join(f"• riga {line}: {reason}" for line, reason in sorted(errors))
+        summary += f"\n⚠️ {len(errors)} righe scartate:\n{details}"
+    await update.message.reply_text(summary)
+
+    if was_empty:
+        await _show_next_draft(context.bot, update.effective_chat.id, context.user_data)
+
+async def offer_drafts(application, user_id: int, drafts: list, intro: str = None) -> None:
+    """
+    Aggiunge bozze generate automaticamente (watcher prezzi, feed) alla coda di approvazione
+    di un admin, la stessa usata dalla modalità bulk. Se la coda era vuota mostra subito la prima.
+    """
+    if not drafts:
+        return
+    user_data = application.user_data[user_id]
+    queue = user_data.setdefault('bulk_queue', [])
+    was_empty = not queue
+    queue.extend(drafts)
+    # Fuori da un update PTB non sa che user_data è cambiato: lo segnaliamo alla persistenza
+    application.mark_data_for_update_persistence(user_ids=[user_id])
+
+    if intro:
+        await application.bot.send_message(chat_id=user_id, text=intro)
+    if was_empty:
+        await _show_next_draft(application.bot, user_id, user_data)
+
+@admin_only
+async def bulk_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.info(f"Ricevuto messaggio bulk da {update.effective_user.id}")
+    await _start_bulk(update, context, update.message.text)
+
+@admin_only
+async def bulk_file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    document = update.message.document
+    logger.info(f"Ricevuto file bulk {document.file_name} da {update.effective_user.id}")
+    telegram_file = await document.get_file()
+    data = await telegram_file.download_as_bytearray()
+    await _start_bulk(update, context, bytes(data).decode('utf-8-sig', errors='replace'))
+
+async def bulk_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    action = query.data.split(':', 1)[1]
+    queue = context.user_data.get('bulk_queue') or []
+
+    if not queue:
+        await query.edit_message_text("ℹ️ Nessuna bozza in coda.")
+        return
+    if action == "cancel":
+        context.user_data.pop('bulk_queue', None)
+        await query.edit_message_text(f"❌ Coda annullata ({len(queue)} bozze scartate).")
+        return
+
+    if action == "all":
+        # Tutta la coda in un solo INSERT: il dispatcher la pubblica rispettando i limiti di Telegram.
+        # Le bozze escono dalla coda solo a invio riuscito (nel frattempo altre possono esservi state aggiunte in fondo)
+        drafts = list(queue)
+        try:
+            esito = await submit_drafts(context, drafts, update.effective_user.id)
+        except Exception as e:
+            logger.error(f"Errore pubblicazione bulk: {e}")
+            await query.edit_message_text(
+                f"❌ Errore invio: {e}\nLe {len(drafts)} bozze restano in coda, riprova.",
+                reply_markup=_bulk_keyboard(len(queue)),
+            )
+            return
+        del queue[:len(drafts)]
+        await query.edit_message_text(esito)
+        if queue:
+            await _show_next_draft(context.bot, update.effective_chat.id, context.user_data)
+        return
+
+    draft = queue[0]
+    if action == "send":
+        try:
+            esito = await submit_drafts(context, [draft], update.effective_user.id)
+        except Exception as e:
+            # La bozza resta in testa alla coda: l'anteprima qui sotto permette di riprovare
+            logger.error(f"Errore pubblicazione bozza bulk: {e}")
+            await query.edit_message_text(f"❌ Errore invio: {e}")
+        else:
+            queue.remove(draft)
+            await query.edit_message_text(f"{esito}\n{draft['title'][:60]}")
+    else:
+        queue.remove(draft)
+        await query.edit_message_text(f"⏭️ Saltato: {draft['title'][:60]}")
+
+    await _show_next_draft(context.bot, update.effective_chat.id, context.user_data)
+
+# Da registrare PRIMA di conv_handler, così i messaggi multi-link non avviano il flusso singolo
+bulk_handlers = [
+    MessageHandler(BULK_TEXT_FILTER, bulk_text_handler),
+    MessageHandler(BULK_FILE_FILTER, bulk_file_handler),
+    CallbackQueryHandler(bulk_callback_handler, pattern=r'^bulk:'),
+]
@@ -0,0 +1,278 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+import database
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione della cache prodotti ---
+PRODUCT_CACHE_TTL = int(os.environ.get("PRODUCT_CACHE_TTL", "21600"))            # 6 ore
+PRODUCT_CACHE_SIZE = int(os.environ.get("PRODUCT_CACHE_SIZE", "2000"))
+PRODUCT_CACHE_NEGATIVE_TTL = int(os.environ.get("PRODUCT_CACHE_NEGATIVE_TTL", "300"))  # 5 minuti
+PRODUCT_CACHE_PERSIST = os.environ.get("PRODUCT_CACHE_PERSIST", "1") == "1"
+
+# --- Configurazione della cache dei link corti (amzn.to / amzn.eu) ---
+SHORT_LINK_CACHE_TTL = int(os.environ.get("SHORT_LINK_CACHE_TTL", "2592000"))     # 30 giorni
+SHORT_LINK_CACHE_SIZE = int(os.environ.get("SHORT_LINK_CACHE_SIZE", "10000"))
+
+# --- Configurazione della cache dei file_id Telegram delle immagini ---
+IMAGE_CACHE_TTL = int(os.environ.get("IMAGE_CACHE_TTL", "2592000"))               # 30 giorni
+IMAGE_CACHE_SIZE = int(os.environ.get("IMAGE_CACHE_SIZE", "5000"))
+
+# Voci recenti da precaricare dal DB all'avvio (0 = nessun warm-up)
+CACHE_WARM_SIZE = int(os.environ.get("CACHE_WARM_SIZE", "500"))
+
+class TTLCache:
+    """
+    Cache in memoria con scadenza (TTL) e rimozione LRU quando si supera max_size.
+    Thread-safe: può essere usata sia dall'event loop sia da asyncio.to_thread.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+class ProductCache:
+    """
+    Cache dei dettagli prodotto indicizzata per ASIN.
+    Livello 1: memoria (TTL + LRU). Livello 2 (opzionale): tabella product_cache su Postgres.
+    Gli ASIN falliti di recente vengono ricordati (cache negativa) per non martellare Amazon.
+    """
+
+    # Solo questi campi dipendono dall'ASIN; original_link dipende dal messaggio dell'admin
+    FIELDS = ("title", "image_url", "asin", "clean_product_link")
+
+    def __init__(self, max_size=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL,
+                 negative_ttl=PRODUCT_CACHE_NEGATIVE_TTL, persist=PRODUCT_CACHE_PERSIST):
+        self.ttl = ttl
+        self.persist = persist
+        self._memory = TTLCache(max_size, ttl)
+        self._failures = TTLCache(max_size, negative_ttl)
+
+    def get(self, asin: str) -> dict or None:
+        """Lettura dal solo livello in memoria (sincrona, nessun I/O)."""
+        cached = self._memory.get(asin)
+        return dict(cached) if cached else None
+
+    def put(self, product_data: dict) -> None:
+        entry = {field: product_data.get(field) for field in self.FIELDS}
+        self._memory.set(product_data["asin"], entry)
+        self._failures.delete(product_data["asin"])
+
+    def is_failed(self, asin: str) -> bool:
+        return asin in self._failures
+
+    def mark_failed(self, asin: str) -> None:
+        self._failures.set(asin, True)
+
+    async def get_async(self, asin: str) -> dict or None:
+        """Cerca prima in memoria, poi (se abilitato) su Postgres senza bloccare l'event loop."""
+        cached = self.get(asin)
+        if cached or not self.persist:
+            return cached
+
+        try:
+            row = await database.db_call(database.get_cached_product, asin, self.ttl)
+        except Exception as e:
+            logger.error(f"Errore lettura cache prodotti su DB per {asin}: {e}")
+            return None
+
+        if row:
+            self._memory.set(asin, row)
+            return dict(row)
+        return None
+
+    async def put_async(self, product_data: dict) -> None:
+        self.put(product_data)
+        if not self.persist:
+            return
+        try:
+            await database.db_call(database.save_cached_product, product_data)
+        except Exception as e:
+            logger.error(f"Errore scrittura cache prodotti su DB per {product_data.get('asin')}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._memory),
+            "hits": self._memory.hits,
+            "misses": self._memory.misses,
+            "negative": len(self._failures),
+        }
+
+class ShortLinkCache:
+    """
+    Memoizza la risoluzione link corto -> ASIN.
+    Un link amzn.to non cambia destinazione: TTL lungo in memoria e copia persistente su Postgres.
+    """
+
+    def __init__(self, max_size=SHORT_LINK_CACHE_SIZE, ttl=SHORT_LINK_CACHE_TTL, persist=PRODUCT_CACHE_PERSIST):
+        self.persist = persist
+        self._memory = TTLCache(max_size, ttl)
+
+    def get(self, short_url: str) -> str or None:
+        return self._memory.get(short_url)
+
+    def put(self, short_url: str, asin: str) -> None:
+        self._memory.set(short_url, asin)
+
+    async def get_async(self, short_url: str) -> str or None:
+        asin = self.get(short_url)
+        if asin or not self.persist:
+            return asin
+
+        try:
+            asin = await database.db_call(database.get_short_link_asin, short_url)
+        except Exception as e:
+            logger.error(f"Errore lettura link corto {short_url} dal DB: {e}")
+            return None
+
+        if asin:
+            self._memory.set(short_url, asin)
+        return asin
+
+    async def put_async(self, short_url: str, asin: str) -> None:
+        self.put(short_url, asin)
+        if not self.persist:
+            return
+        try:
+            await database.db_call(database.save_short_link, short_url, asin)
+        except Exception as e:
+            logger.error(f"Errore salvataggio link corto {short_url} sul DB: {e}")
+
+    def stats(self) -> dict:
+        return {"size": len(self._memory), "hits": self._memory.hits, "misses": self._memory.misses}
+
+class ImageFileIdCache:
+    """
+    Associa l'URL di un'immagine Amazon al file_id restituito da Telegram dopo il primo invio:
+    gli invii successivi (anteprime, pubblicazione, altri canali) non fanno riscaricare la foto.
+    """
+
+    def __init__(self, max_size=IMAGE_CACHE_SIZE, ttl=IMAGE_CACHE_TTL, persist=PRODUCT_CACHE_PERSIST):
+        self.persist = persist
+        self._memory = TTLCache(max_size, ttl)
+
+    async def get_async(self, image_url: str) -> str or None:
+        if not image_url:
+            return None
+        file_id = self._memory.get(image_url)
+        if file_id or not self.persist:
+            return file_id
+
+        try:
+            file_id = await database.db_call(database.get_image_file_id, image_url)
+        except Exception as e:
+            logger.error(f"Errore lettura file_id immagine dal DB: {e}")
+            return None
+
+        if file_id:
+            self._memory.set(image_url, file_id)
+        return file_id
+
+    def peek(self, image_url: str) -> str or None:
+        """Solo memoria, senza DB: per chi deve rispondere subito (query inline)."""
+        return self._memory.get(image_url) if image_url else None
+
+    async def put_async(self, image_url: str, file_id: str, asin: str = None) -> None:
+        if not image_url or not file_id:
+            return
+        self._memory.set(image_url, file_id)
+        if not self.persist:
+            return
+        try:
+            await database.db_call(database.save_image_file_id, image_url, file_id, asin)
+        except Exception as e:
+            logger.error(f"Errore salvataggio file_id immagine sul DB: {e}")
+
+    async def invalidate_async(self, image_url: str) -> None:
+        """Da chiamare quando Telegram rifiuta un file_id (scaduto o di un altro bot)."""
+        self._memory.delete(image_url)
+        if not self.persist:
+            return
+        try:
+            await database.db_call(database.delete_image_file_id, image_url)
+        except Exception as e:
+            logger.error(f"Errore rimozione file_id immagine dal DB: {e}")
+
+    def stats(self) -> dict:
+        return {"size": len(self._memory), "hits": self._memory.hits, "misses": self._memory.misses}
+
+# Istanze condivise usate da utils.py e handlers.py
+product_cache = ProductCache()
+short_link_cache = ShortLinkCache()
+image_file_id_cache = ImageFileIdCache()
+
+async def warm_caches(limit: int = CACHE_WARM_SIZE) -> int:
+    """
+    Precarica in memoria i prodotti e i file_id più recenti da Postgres (in background all'avvio):
+    i primi link dopo un riavvio non pagano il giro sul DB. Restituisce le voci caricate.
+    """
+    if not PRODUCT_CACHE_PERSIST or not limit:
+        return 0
+    products, file_ids = await asyncio.gather(
+        database.db_call(database.get_recent_cached_products, product_cache.ttl, limit),
+        database.db_call(database.get_recent_image_file_ids, limit),
+    )
+    for product, age in products or []:
+        product_cache._memory.set(product["asin"], product, ttl=max(1, product_cache.ttl - age))
+    for image_url, file_id in file_ids or []:
+        image_file_id_cache._memory.set(image_url, file_id)
+    return len(products or []) + len(file_ids or [])
+
+def _cache_samples() -> list:
+    """Esposizione delle statistiche delle cache (vedi metrics.py)."""
+    samples = []
+    for name, cache in (("product", product_cache), ("short_link", short_link_cache), ("image_file_id", image_file_id_cache)):
+        stats = cache.stats()
+        samples.append(("cache_hits_total", "counter", {"cache": name}, stats["hits"]))
+        samples.append(("cache_misses_total", "counter", {"cache": name}, stats["misses"]))
+        samples.append(("cache_entries", "gauge", {"cache": name}, stats["size"]))
+    return samples
+
+metrics.register_collector(_cache_samples)
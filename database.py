@@ -1,26 +1,150 @@
 import os
+import time
+import asyncio
+import threading
 import psycopg2
+from psycopg2 import pool, extensions, extras
 import logging
 
+from metrics import metrics
+
 logger = logging.getLogger(__name__)
 
+# --- Pool di connessioni ---
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+# Attesa massima (secondi) per una connessione libera quando il pool è pieno
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+# Una connessione inattiva da più di N secondi viene verificata con SELECT 1 prima dell'uso
+DB_HEALTHCHECK_IDLE = float(os.environ.get("DB_HEALTHCHECK_IDLE", "60"))
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool solleva PoolError se esaurito: il semaforo fa invece attendere
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_last_used = {}
+
+def _get_pool():
+    """Crea il pool alla prima richiesta (thread-safe)."""
+    global _pool
+    if _pool is not None:
+        return _pool
+    with _pool_lock:
+        if _pool is None:
+            database_url = os.environ.get("DATABASE_URL")
+            if not database_url:
+                logger.error("DATABASE_URL non impostata nelle variabili d'ambiente!")
+                return None
+            _pool = pool.ThreadedConnectionPool(
+                DB_POOL_MIN, DB_POOL_MAX, database_url,
+                keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+            )
+            logger.info(f"Pool DB creato (min={DB_POOL_MIN}, max={DB_POOL_MAX}).")
+    return _pool
+
+def _is_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    # Connessione appena aperta (mai restituita) o usata di recente: niente round-trip
+    last_used = _last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE:
+        return True
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_db_connection():
-    """Stabilisce la connessione al database Postgres su Neon."""
-    database_url = os.environ.get("DATABASE_URL")
-    if not database_url:
-        logger.error("DATABASE_URL non impostata nelle variabili d'ambiente!")
+    """Preleva una connessione sana dal pool verso il database Postgres su Neon."""
+    try:
+        db_pool = _get_pool()
+    except Exception as e:
+        logger.error(f"Errore connessione DB: {e}")
+        return None
+    if db_pool is None:
+        return None
+
+    with metrics.span("db_pool_wait"):
+        acquired = _pool_slots.acquire(timeout=DB_POOL_TIMEOUT)
+    if not acquired:
+        metrics.inc("db_pool_exhausted_total")
+        logger.error("Pool DB esaurito: nessuna connessione libera.")
         return None
     try:
-        conn = psycopg2.connect(database_url)
-        return conn
+        # Al massimo un tentativo per connessione del pool, più uno per una connessione nuova
+        for _ in range(DB_POOL_MAX + 1):
+            conn = db_pool.getconn()
+            if _is_healthy(conn):
+                return conn
+            logger.warning("Connessione DB non valida scartata dal pool.")
+            _last_used.pop(id(conn), None)
+            db_pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("nessuna connessione sana disponibile")
     except Exception as e:
+        _pool_slots.release()
         logger.error(f"Errore connessione DB: {e}")
         return None
 
+def release_connection(conn):
+    """Restituisce la connessione al pool (annullando eventuali transazioni rimaste aperte)."""
+    db_pool = _pool
+    broken = conn.closed != 0
+    if not broken and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+    try:
+        if broken:
+            _last_used.pop(id(conn), None)
+        else:
+            _last_used[id(conn)] = time.monotonic()
+        if db_pool is not None:
+            db_pool.putconn(conn, close=broken)
+        elif not conn.closed:
+            # Pool già chiuso (close_pool) mentre la connessione era in uso: la si chiude e basta
+            _last_used.pop(id(conn), None)
+            conn.close()
+    finally:
+        _pool_slots.release()
+
+def close_pool():
+    """Chiude tutte le connessioni del pool (alla chiusura del bot)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
+            logger.info("Pool DB chiuso.")
+
+async def db_call(func, *args, **kwargs):
+    """Esegue una funzione di questo modulo in un thread, senza bloccare l'event loop."""
+    async with metrics.span("db_call", func=func.__name__):
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+# Creata anche da load_persistence: lo stato si legge in Application.initialize, prima di init_db
+PERSISTENCE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS bot_persistence (
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        data JSONB NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (kind, key)
+    )
+'''
+
 def init_db():
-    """Crea la tabella per i canali se non esiste."""
+    """
+    Crea tutte le tabelle del bot (canali, cache, post, coda, immagini, watchlist, stato) se non esistono.
+    Restituisce True se lo schema è pronto (startup.py ritenta finché non lo è).
+    """
     conn = get_db_connection()
-    if not conn: return
+    if not conn: return False
     try:
         cursor = conn.cursor()
         cursor.execute('''
@@ -29,13 +153,136 @@ def init_db():
                 channel_name TEXT
             )
         ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS product_cache (
+                asin TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                image_url TEXT,
+                clean_product_link TEXT,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS short_links (
+                short_url TEXT PRIMARY KEY,
+                asin TEXT NOT NULL,
+                resolved_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS posts (
+                id BIGSERIAL PRIMARY KEY,
+                asin TEXT NOT NULL,
+                title TEXT,
+                prezzo_precedente NUMERIC(10, 2),
+                prezzo_attuale NUMERIC(10, 2) NOT NULL,
+                sconto SMALLINT NOT NULL DEFAULT 0,
+                channel_id BIGINT,
+                message_id BIGINT,
+                published_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        ''')
+        # Dedup per ASIN e minimo storico: l'indice composto evita di scansionare la tabella
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_asin_published ON posts (asin, published_at DESC)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_published ON posts (published_at)")
+        # Caricamento incrementale dell'indice di ricerca inline (keyset su updated_at, asin)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_cache_updated ON product_cache (updated_at, asin)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS publish_queue (
+                id BIGSERIAL PRIMARY KEY,
+                chat_id TEXT NOT NULL,
+                draft JSONB NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts SMALLINT NOT NULL DEFAULT 0,
+                not_before TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                last_error TEXT,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        ''')
+        # Admin che ha approvato il post: riceve l'esito della pubblicazione per ogni canale
+        cursor.execute("ALTER TABLE publish_queue ADD COLUMN IF NOT EXISTS requested_by BIGINT")
+        # Solo le righe in attesa sono interessanti per il dispatcher: indice parziale
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_publish_queue_due ON publish_queue (not_before, id) WHERE status = 'pending'")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS image_file_ids (
+                image_url TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                asin TEXT,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS watchlist (
+                asin TEXT PRIMARY KEY,
+                threshold NUMERIC(10, 2),
+                added_by BIGINT,
+                hot BOOLEAN NOT NULL DEFAULT FALSE,
+                last_price NUMERIC(10, 2),
+                max_price NUMERIC(10, 2),
+                last_alert_price NUMERIC(10, 2),
+                last_checked_at TIMESTAMPTZ,
+                next_check_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        ''')
+        # Il watcher legge solo gli ASIN scaduti, i "caldi" per primi
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_watchlist_due ON watchlist (next_check_at)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS price_history (
+                asin TEXT NOT NULL,
+                price NUMERIC(10, 2) NOT NULL,
+                checked_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_history_asin ON price_history (asin, checked_at DESC)")
+        # Stato dell'Application (conversazioni, user_data, bot_data) che sopravvive ai riavvii
+        cursor.execute(PERSISTENCE_TABLE_SQL)
+        # Feed RSS/Atom da cui raccogliere offerte, con i validatori per le GET condizionali
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS feeds (
+                url TEXT PRIMARY KEY,
+                added_by BIGINT,
+                etag TEXT,
+                last_modified TEXT,
+                last_status INTEGER,
+                last_checked_at TIMESTAMPTZ,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        ''')
+        # ASIN già visti nei feed: un ASIN torna proponibile solo dopo FEED_DEDUP_DAYS
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS feed_seen_asins (
+                asin TEXT PRIMARY KEY,
+                seen_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_feed_seen_asins_seen_at ON feed_seen_asins (seen_at)")
+        # Coda di scraping condivisa tra bot e worker (SCRAPE_BACKEND=postgres, vedi workers.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scrape_jobs (
+                id BIGSERIAL PRIMARY KEY,
+                url TEXT NOT NULL,
+                use_cache BOOLEAN NOT NULL DEFAULT TRUE,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                locked_until TIMESTAMPTZ,
+                result JSONB,
+                error TEXT,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMPTZ
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_scrape_jobs_queued ON scrape_jobs (id) WHERE status = 'queued'")
         conn.commit()
         cursor.close()
         logger.info("Database inizializzato con successo.")
+        return True
     except Exception as e:
         logger.error(f"Errore init_db: {e}")
+        return False
     finally:
-        conn.close()
+        release_connection(conn)
 
 def add_channel(channel_id, name):
     conn = get_db_connection()
@@ -46,7 +293,7 @@ def add_channel(channel_id, name):
         conn.commit()
         cursor.close()
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_all_channels():
     conn = get_db_connection()
@@ -58,4 +305,794 @@ def get_all_channels():
         cursor.close()
         return rows
     finally:
-        conn.close()
+        release_connection(conn)
+
+def get_cached_product(asin, max_age_seconds):
+    """Legge un prodotto dalla cache persistente se più recente di max_age_seconds."""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT asin, title, image_url, clean_product_link FROM product_cache "
+            "WHERE asin = %s AND updated_at > NOW() - make_interval(secs => %s)",
+            (asin, max_age_seconds)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        if not row:
+            return None
+        return {"asin": row[0], "title": row[1], "image_url": row[2], "clean_product_link": row[3]}
+    finally:
+        release_connection(conn)
+
+def save_cached_product(product_data):
+    """Salva (o aggiorna) i dettagli di un prodotto nella cache persistente."""
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO product_cache (asin, title, image_url, clean_product_link, updated_at) "
+            "VALUES (%s, %s, %s, %s, NOW()) "
+            "ON CONFLICT (asin) DO UPDATE SET title = EXCLUDED.title, image_url = EXCLUDED.image_url, "
+            "clean_product_link = EXCLUDED.clean_product_link, updated_at = NOW()",
+            (product_data["asin"], product_data["title"], product_data.get("image_url"), product_data.get("clean_product_link"))
+        )
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+def get_short_link_asin(short_url):
+    """Restituisce l'ASIN già risolto per un link corto, se presente."""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT asin FROM short_links WHERE short_url = %s", (short_url,))
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row else None
+    finally:
+        release_connection(conn)
+
+def save_short_link(short_url, asin):
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO short_links (short_url, asin) VALUES (%s, %s) "
+            "ON CONFLICT (short_url) DO UPDATE SET asin = EXCLUDED.asin, resolved_at = NOW()",
+            (short_url, asin)
+        )
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+def get_image_file_id(image_url):
+    """file_id Telegram già ottenuto per questa immagine, se presente."""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT file_id FROM image_file_ids WHERE image_url = %s", (image_url,))
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row else None
+    finally:
+        release_connection(conn)
+
+def get_recent_cached_products(max_age_seconds, limit):
+    """
+    I prodotti aggiornati più di recente, per precaricare la cache in memoria all'avvio.
+    Restituisce coppie (prodotto, età in secondi) così la copia in memoria scade insieme a quella su DB.
+    """
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT asin, title, image_url, clean_product_link, EXTRACT(EPOCH FROM NOW() - updated_at) FROM product_cache "
+            "WHERE updated_at > NOW() - make_interval(secs => %s) ORDER BY updated_at DESC LIMIT %s",
+            (max_age_seconds, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        return [({"asin": r[0], "title": r[1], "image_url": r[2], "clean_product_link": r[3]}, float(r[4])) for r in rows]
+    finally:
+        release_connection(conn)
+
+def get_recent_image_file_ids(limit):
+    """Le associazioni immagine -> file_id più recenti, come coppie (image_url, file_id)."""
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT image_url, file_id FROM image_file_ids ORDER BY updated_at DESC LIMIT %s", (limit,))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+    finally:
+        release_connection(conn)
+
+def save_image_file_id(image_url, file_id, asin=None):
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO image_file_ids (image_url, file_id, asin) VALUES (%s, %s, %s) "
+            "ON CONFLICT (image_url) DO UPDATE SET file_id = EXCLUDED.file_id, "
+            "asin = COALESCE(EXCLUDED.asin, image_file_ids.asin), updated_at = NOW()",
+            (image_url, file_id, asin)
+        )
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+def delete_image_file_id(image_url):
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM image_file_ids WHERE image_url = %s", (image_url,))
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+# --- Storico dei post pubblicati ---
+
+POST_COLUMNS = ("asin", "title", "prezzo_precedente", "prezzo_attuale", "sconto", "channel_id", "message_id")
+
+def save_posts(posts):
+    """Inserisce più post in un solo round-trip (execute_values). posts: lista di dict con POST_COLUMNS."""
+    if not posts: return
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        extras.execute_values(
+            cursor,
+            f"INSERT INTO posts ({', '.join(POST_COLUMNS)}) VALUES %s",
+            [tuple(post.get(column) for column in POST_COLUMNS) for post in posts]
+        )
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+def get_last_post(asin, days):
+    """Ultimo post dello stesso ASIN negli ultimi `days` giorni: (published_at, prezzo_attuale) o None."""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT published_at, prezzo_attuale FROM posts "
+            "WHERE asin = %s AND published_at > NOW() - make_interval(days => %s) "
+            "ORDER BY published_at DESC LIMIT 1",
+            (asin, days)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+        return (row[0], float(row[1])) if row else None
+    finally:
+        release_connection(conn)
+
+def get_lowest_price(asin):
+    """Prezzo più basso mai pubblicato per l'ASIN, o None se mai pubblicato."""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MIN(prezzo_attuale) FROM posts WHERE asin = %s", (asin,))
+        row = cursor.fetchone()
+        cursor.close()
+        return float(row[0]) if row and row[0] is not None else None
+    finally:
+        release_connection(conn)
+
+# --- Coda di pubblicazione ---
+
+def enqueue_posts(drafts, chat_ids, requested_by=None):
+    """
+    Accoda bozze approvate: una riga per ogni coppia (bozza, canale), così ogni canale
+    ha il proprio stato e i propri ritentativi. Restituisce gli id (lista vuota se DB non disponibile).
+    """
+    if not drafts or not chat_ids: return []
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        rows = extras.execute_values(
+            cursor,
+            "INSERT INTO publish_queue (chat_id, draft, requested_by) VALUES %s RETURNING id",
+            [(str(chat_id), extras.Json(draft), requested_by) for draft in drafts for chat_id in chat_ids],
+            fetch=True
+        )
+        conn.commit()
+        cursor.close()
+        return [row[0] for row in rows]
+    finally:
+        release_connection(conn)
+
+def claim_due_posts(limit):
+    """
+    Prende in carico fino a `limit` post scaduti (stato -> 'sending').
+    SKIP LOCKED permette a più dispatcher di lavorare senza pubblicare due volte lo stesso post.
+    """
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE publish_queue SET status = 'sending', attempts = attempts + 1 "
+            "WHERE id IN (SELECT id FROM publish_queue WHERE status = 'pending' AND not_before <= NOW() "
+            "ORDER BY not_before, id LIMIT %s FOR UPDATE SKIP LOCKED) "
+            "RETURNING id, chat_id, draft, attempts, requested_by",
+            (limit,)
+        )
+        rows = sorted(cursor.fetchall())
+        conn.commit()
+        cursor.close()
+        return rows
+    finally:
+        release_connection(conn)
+
+def mark_post_sent(queue_id):
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE publish_queue SET status = 'sent', last_error = NULL WHERE id = %s", (queue_id,))
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+def reschedule_post(queue_id, delay_seconds, error):
+    """Rimette il post in attesa dopo `delay_seconds` (es. RetryAfter di Telegram)."""
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE publish_queue SET status = 'pending', not_before = NOW() + make_interval(secs => %s), "
+            "last_error = %s WHERE id = %s",
+            (delay_seconds, error, queue_id)
+        )
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+def mark_post_failed(queue_id, error):
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE publish_queue SET status = 'failed', last_error = %s WHERE id = %s", (error, queue_id))
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+def requeue_stale_posts():
+    """All'avvio: i post rimasti 'sending' (crash durante l'invio) tornano in attesa."""
+    conn = get_db_connection()
+    if not conn: return 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE publish_queue SET status = 'pending' WHERE status = 'sending'")
+        count = cursor.rowcount
+        conn.commit()
+        cursor.close()
+        return count
+    finally:
+        release_connection(conn)
+
+def count_pending_posts():
+    conn = get_db_connection()
+    if not conn: return 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM publish_queue WHERE status = 'pending'")
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+    finally:
+        release_connection(conn)
+
+# --- Watchlist e storico prezzi ---
+
+def add_to_watchlist(asin, threshold, added_by):
+    """Aggiunge (o aggiorna) un ASIN da controllare; il primo controllo avviene subito."""
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO watchlist (asin, threshold, added_by) VALUES (%s, %s, %s) "
+            "ON CONFLICT (asin) DO UPDATE SET threshold = EXCLUDED.threshold, added_by = EXCLUDED.added_by, "
+            "last_alert_price = NULL, next_check_at = NOW()",
+            (asin, threshold, added_by)
+        )
+        conn.commit()
+        cursor.close()
+        return True
+    finally:
+        release_connection(conn)
+
+def remove_from_watchlist(asin):
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM watchlist WHERE asin = %s", (asin,))
+        removed = cursor.rowcount > 0
+        conn.commit()
+        cursor.close()
+        return removed
+    finally:
+        release_connection(conn)
+
+def get_watchlist_summary(limit):
+    """(totale, primi `limit` ASIN con soglia e ultimo prezzo) per il comando /seguiti."""
+    conn = get_db_connection()
+    if not conn: return 0, []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM watchlist")
+        total = cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT asin, threshold, last_price, hot FROM watchlist ORDER BY hot DESC, created_at DESC LIMIT %s",
+            (limit,)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        return total, rows
+    finally:
+        release_connection(conn)
+
+def claim_due_watch_items(limit, lease_seconds):
+    """
+    Prende i prossimi `limit` ASIN da controllare (prima i caldi) e ne sposta in avanti
+    next_check_at di `lease_seconds`: se il processo cade, verranno ripresi alla scadenza.
+    """
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE watchlist SET next_check_at = NOW() + make_interval(secs => %s) "
+            "WHERE asin IN (SELECT asin FROM watchlist WHERE next_check_at <= NOW() "
+            "ORDER BY hot DESC, next_check_at LIMIT %s FOR UPDATE SKIP LOCKED) "
+            "RETURNING asin, threshold, added_by, hot, last_price, max_price, last_alert_price",
+            (lease_seconds, limit)
+        )
+        rows = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+        return [
+            {
+                "asin": row[0],
+                "threshold": float(row[1]) if row[1] is not None else None,
+                "added_by": row[2],
+                "hot": row[3],
+                "last_price": float(row[4]) if row[4] is not None else None,
+                "max_price": float(row[5]) if row[5] is not None else None,
+                "last_alert_price": float(row[6]) if row[6] is not None else None,
+            }
+            for row in rows
+        ]
+    finally:
+        release_connection(conn)
+
+def save_watch_results(results):
+    """
+    Salva in blocco l'esito di un giro di controlli: aggiorna la watchlist e
+    aggiunge i prezzi rilevati a price_history (due sole query per tutto il lotto).
+    results: lista di dict con asin, price (None se fallito), hot, next_check_in, alert_price.
+    """
+    if not results: return
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        extras.execute_values(
+            cursor,
+            "UPDATE watchlist AS w SET "
+            "last_price = COALESCE(v.price, w.last_price), "
+            "max_price = GREATEST(w.max_price, v.price), "
+            "hot = v.hot, "
+            "last_alert_price = COALESCE(v.alert_price, w.last_alert_price), "
+            "last_checked_at = NOW(), "
+            "next_check_at = NOW() + make_interval(secs => v.next_check_in) "
+            "FROM (VALUES %s) AS v (asin, price, hot, next_check_in, alert_price) "
+            "WHERE w.asin = v.asin",
+            [(r["asin"], r["price"], r["hot"], r["next_check_in"], r.get("alert_price")) for r in results],
+            template="(%s, %s::numeric, %s::boolean, %s::double precision, %s::numeric)"
+        )
+        priced = [(r["asin"], r["price"]) for r in results if r["price"] is not None]
+        if priced:
+            extras.execute_values(cursor, "INSERT INTO price_history (asin, price) VALUES %s", priced)
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+# --- Persistenza dell'Application (vedi persistence.py) ---
+
+def load_persistence():
+    """
+    Tutto lo stato salvato, in una sola query: lista di (kind, key, data).
+    Su un database nuovo crea la tabella; solleva se il DB non risponde (il chiamante ritenta).
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise psycopg2.OperationalError("database non disponibile")
+    try:
+        cursor = conn.cursor()
+        cursor.execute(PERSISTENCE_TABLE_SQL)
+        cursor.execute("SELECT kind, key, data FROM bot_persistence")
+        rows = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+        return rows
+    finally:
+        release_connection(conn)
+
+def save_persistence(upserts, deletes):
+    """
+    Scrive in una sola transazione le modifiche accumulate.
+    upserts: lista di (kind, key, json_string); deletes: lista di (kind, key).
+    """
+    if not upserts and not deletes: return
+    conn = get_db_connection()
+    if not conn:
+        raise psycopg2.OperationalError("database non disponibile")
+    try:
+        cursor = conn.cursor()
+        if upserts:
+            extras.execute_values(
+                cursor,
+                "INSERT INTO bot_persistence (kind, key, data) VALUES %s "
+                "ON CONFLICT (kind, key) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()",
+                upserts,
+                template="(%s, %s, %s::jsonb)"
+            )
+        if deletes:
+            extras.execute_values(
+                cursor,
+                "DELETE FROM bot_persistence AS p USING (VALUES %s) AS d (kind, key) "
+                "WHERE p.kind = d.kind AND p.key = d.key",
+                deletes
+            )
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+# --- Indice di ricerca inline ---
+
+def get_indexable_products(since, after_asin, limit):
+    """
+    Pagina di product_cache successiva a (since, after_asin) in ordine di aggiornamento.
+    Restituisce [(asin, title, image_url, clean_product_link, updated_epoch, updated_at)].
+    """
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT asin, title, image_url, clean_product_link, EXTRACT(EPOCH FROM updated_at), updated_at "
+            "FROM product_cache WHERE (updated_at, asin) > (%s::timestamptz, %s) "
+            "ORDER BY updated_at, asin LIMIT %s",
+            (since, after_asin, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        return [(r[0], r[1], r[2], r[3], float(r[4]), r[5]) for r in rows]
+    finally:
+        release_connection(conn)
+
+def get_indexable_posts(after_id, limit):
+    """Post pubblicati con id > after_id: [(id, asin, title, prezzo_precedente, prezzo_attuale, published_epoch)]."""
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, asin, title, prezzo_precedente, prezzo_attuale, EXTRACT(EPOCH FROM published_at) "
+            "FROM posts WHERE id > %s ORDER BY id LIMIT %s",
+            (after_id, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        return [
+            (r[0], r[1], r[2], float(r[3]) if r[3] is not None else None, float(r[4]), float(r[5]))
+            for r in rows
+        ]
+    finally:
+        release_connection(conn)
+
+# --- Feed di offerte ---
+
+def add_feed(url, added_by):
+    """Aggiunge un feed; False se era già presente o il DB non è disponibile."""
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO feeds (url, added_by) VALUES (%s, %s) ON CONFLICT (url) DO NOTHING",
+            (url, added_by)
+        )
+        added = cursor.rowcount > 0
+        conn.commit()
+        cursor.close()
+        return added
+    finally:
+        release_connection(conn)
+
+def remove_feed(url):
+    conn = get_db_connection()
+    if not conn: return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM feeds WHERE url = %s", (url,))
+        removed = cursor.rowcount > 0
+        conn.commit()
+        cursor.close()
+        return removed
+    finally:
+        release_connection(conn)
+
+def get_feeds():
+    """Tutti i feed con i validatori dell'ultima risposta (etag, last_modified) e l'ultimo stato HTTP."""
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT url, etag, last_modified, last_status, last_checked_at FROM feeds ORDER BY created_at")
+        rows = cursor.fetchall()
+        cursor.close()
+        return [
+            {"url": row[0], "etag": row[1], "last_modified": row[2], "last_status": row[3], "last_checked_at": row[4]}
+            for row in rows
+        ]
+    finally:
+        release_connection(conn)
+
+def save_feed_states(states):
+    """
+    Salva in blocco l'esito di un giro di polling (una sola query).
+    states: lista di (url, etag, last_modified, status); i feed non presenti in tabella vengono ignorati.
+    """
+    if not states: return
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        extras.execute_values(
+            cursor,
+            "UPDATE feeds AS f SET etag = v.etag, last_modified = v.last_modified, "
+            "last_status = v.status, last_checked_at = NOW() "
+            "FROM (VALUES %s) AS v (url, etag, last_modified, status) WHERE f.url = v.url",
+            states,
+            template="(%s, %s, %s, %s::integer)"
+        )
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+def load_seen_asins(max_age_days):
+    """Elimina gli ASIN più vecchi della finestra di deduplica e restituisce gli altri."""
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM feed_seen_asins WHERE seen_at < NOW() - make_interval(days => %s)", (max_age_days,))
+        cursor.execute("SELECT asin FROM feed_seen_asins")
+        rows = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        cursor.close()
+        return rows
+    finally:
+        release_connection(conn)
+
+def claim_new_asins(asins, max_age_days):
+    """
+    Registra gli ASIN come visti e restituisce solo quelli davvero nuovi (mai visti o fuori finestra).
+    L'INSERT ... RETURNING è atomico: due istanze del bot non propongono lo stesso ASIN.
+    Solleva un'eccezione se il DB non è disponibile (il chiamante ripiega sulla sola memoria).
+    """
+    if not asins: return []
+    conn = get_db_connection()
+    if not conn:
+        raise psycopg2.OperationalError("database non disponibile")
+    try:
+        cursor = conn.cursor()
+        # execute_values lega solo il %s di VALUES: la finestra viene legata prima con mogrify
+        expired = cursor.mogrify("feed_seen_asins.seen_at < NOW() - make_interval(days => %s)", (max_age_days,))
+        rows = extras.execute_values(
+            cursor,
+            b"INSERT INTO feed_seen_asins (asin) VALUES %s "
+            b"ON CONFLICT (asin) DO UPDATE SET seen_at = NOW() "
+            b"WHERE " + expired + b" RETURNING asin",
+            [(asin,) for asin in asins],
+            fetch=True
+        )
+        conn.commit()
+        cursor.close()
+        return [row[0] for row in rows]
+    finally:
+        release_connection(conn)
+
+def release_asins(asins):
+    """Annulla claim_new_asins per gli ASIN che non sono diventati bozze (es. scraping fallito)."""
+    if not asins: return
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM feed_seen_asins WHERE asin = ANY(%s)", (list(asins),))
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+# --- Coda di scraping (worker su più processi/VM) ---
+
+def enqueue_scrape_jobs(jobs):
+    """Accoda i job [(url, use_cache)] e restituisce i loro id nello stesso ordine."""
+    if not jobs: return []
+    conn = get_db_connection()
+    if not conn:
+        raise psycopg2.OperationalError("database non disponibile")
+    try:
+        cursor = conn.cursor()
+        rows = extras.execute_values(
+            cursor,
+            "INSERT INTO scrape_jobs (url, use_cache) VALUES %s RETURNING id",
+            jobs,
+            fetch=True
+        )
+        conn.commit()
+        cursor.close()
+        return [row[0] for row in rows]
+    finally:
+        release_connection(conn)
+
+def take_finished_scrape_jobs(job_ids):
+    """
+    Ritira i job conclusi tra quelli indicati: li cancella e ne restituisce l'esito
+    come (id, status, result, error). Una sola query per tutti i job in attesa.
+    """
+    if not job_ids: return []
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM scrape_jobs WHERE id = ANY(%s) AND status IN ('done', 'failed') "
+            "RETURNING id, status, result, error",
+            (list(job_ids),)
+        )
+        rows = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+        return rows
+    finally:
+        release_connection(conn)
+
+def cancel_scrape_jobs(job_ids):
+    """Elimina job di cui nessuno attende più il risultato (timeout lato bot)."""
+    if not job_ids: return
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM scrape_jobs WHERE id = ANY(%s)", (list(job_ids),))
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+def claim_scrape_jobs(limit, lease_seconds, worker, max_attempts):
+    """
+    Prende fino a `limit` job in coda (o rimasti a un worker caduto, a lease scaduto) per questo worker.
+    FOR UPDATE SKIP LOCKED: più worker possono prelevare in parallelo senza mai prendere lo stesso job.
+    I job che hanno già esaurito i tentativi vengono chiusi come falliti.
+    Restituisce [(id, url, use_cache)].
+    """
+    conn = get_db_connection()
+    if not conn: return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE scrape_jobs SET status = 'failed', error = 'tentativi esauriti', finished_at = NOW() "
+            "WHERE status = 'running' AND locked_until < NOW() AND attempts >= %s",
+            (max_attempts,)
+        )
+        cursor.execute(
+            "UPDATE scrape_jobs SET status = 'running', attempts = attempts + 1, worker = %s, "
+            "locked_until = NOW() + make_interval(secs => %s) "
+            "WHERE id IN (SELECT id FROM scrape_jobs "
+            "WHERE status = 'queued' OR (status = 'running' AND locked_until < NOW()) "
+            "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) "
+            "RETURNING id, url, use_cache",
+            (worker, lease_seconds, limit)
+        )
+        rows = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+        return rows
+    finally:
+        release_connection(conn)
+
+def complete_scrape_jobs(results):
+    """Salva in blocco l'esito dei job: results è una lista di (id, status, result_json, error)."""
+    if not results: return
+    conn = get_db_connection()
+    if not conn: return
+    try:
+        cursor = conn.cursor()
+        extras.execute_values(
+            cursor,
+            "UPDATE scrape_jobs AS j SET status = v.status, result = v.result, error = v.error, "
+            "finished_at = NOW(), locked_until = NULL "
+            "FROM (VALUES %s) AS v (id, status, result, error) WHERE j.id = v.id",
+            results,
+            template="(%s::bigint, %s, %s::jsonb, %s)"
+        )
+        conn.commit()
+        cursor.close()
+    finally:
+        release_connection(conn)
+
+def prune_scrape_jobs(max_age_seconds):
+    """Elimina i job orfani (il bot che li attendeva è stato riavviato)."""
+    conn = get_db_connection()
+    if not conn: return 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM scrape_jobs WHERE created_at < NOW() - make_interval(secs => %s)",
+            (max_age_seconds,)
+        )
+        deleted = cursor.rowcount
+        conn.commit()
+        cursor.close()
+        return deleted
+    finally:
+        release_connection(conn)
+
+# --- Wrapper asincroni per gli handler ---
+
+async def init_db_async():
+    await db_call(init_db)
+
+async def add_channel_async(channel_id, name):
+    await db_call(add_channel, channel_id, name)
+
+async def get_all_channels_async():
+    return await db_call(get_all_channels)
+
+async def save_posts_async(posts):
+    await db_call(save_posts, posts)
+
+async def get_last_post_async(asin, days):
+    return await db_call(get_last_post, asin, days)
+
+async def get_lowest_price_async(asin):
+    return await db_call(get_lowest_price, asin)
+
+async def enqueue_posts_async(drafts, chat_ids, requested_by=None):
+    return await db_call(enqueue_posts, drafts, chat_ids, requested_by)
@@ -0,0 +1,265 @@
+import os
+import re
+import html
+import logging
+from abc import ABC, abstractmethod
+from html.parser import HTMLParser
+
+# lxml è opzionale: se installato viene usato come secondo livello
+try:
+    import lxml.html
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Ordine degli estrattori: "auto" (streaming -> lxml -> soup) oppure un nome singolo
+HTML_EXTRACTOR = os.environ.get("HTML_EXTRACTOR", "auto")
+
+# Dimensione dei blocchi passati al parser incrementale
+STREAMING_CHUNK_SIZE = 64 * 1024
+
+TITLE_ID = 'productTitle'
+IMAGE_IDS = ('landingImage', 'imgBliss')
+
+DYNAMIC_IMAGE_RE = re.compile(r'"(https?://[^"]+)"')
+# Varianti di data-a-dynamic-image con le dimensioni: "url":[larghezza,altezza]
+DYNAMIC_VARIANT_RE = re.compile(r'"(https?://[^"]+)"\s*:\s*\[\s*(\d+)\s*,\s*(\d+)\s*\]')
+# Lato minimo desiderato dell'immagine: si sceglie la variante più piccola che lo raggiunge
+IMAGE_TARGET_SIZE = int(os.environ.get("IMAGE_TARGET_SIZE", "800"))
+
+# Contenitori del prezzo principale (layout nuovo e vecchio della pagina prodotto)
+PRICE_CONTAINER_IDS = ('corePrice_feature_div', 'corePriceDisplay_desktop_feature_div', 'apex_desktop')
+LEGACY_PRICE_RE = re.compile(r'id="(?:priceblock_dealprice|priceblock_ourprice)"[^>]*>([^<]+)<')
+OFFSCREEN_PRICE_RE = re.compile(r'<span class="a-offscreen">([^<]+)</span>')
+# Tutto ciò che non è cifra o separatore ("€", "&nbsp;", spazi)
+PRICE_NOISE_RE = re.compile(r'[^\d,.]')
+# Punto seguito da esattamente tre cifre: separatore delle migliaia ("1.299"), non decimali
+THOUSANDS_DOT_RE = re.compile(r'\.(?=\d{3}(?!\d))')
+# Quanto testo guardare dopo l'inizio del contenitore del prezzo
+PRICE_SEARCH_WINDOW = 4096
+
+def best_image_variant(image_url_data: str, target: int = IMAGE_TARGET_SIZE) -> str:
+    """
+    Sceglie da data-a-dynamic-image la variante più piccola con il lato lungo >= target
+    (o la più grande, se nessuna lo raggiunge): niente download di immagini enormi da ridurre.
+    """
+    variants = [(max(int(width), int(height)), url) for url, width, height in DYNAMIC_VARIANT_RE.findall(image_url_data)]
+    if not variants:
+        match = DYNAMIC_IMAGE_RE.search(image_url_data)
+        return match.group(1) if match else ""
+    large_enough = [variant for variant in variants if variant[0] >= target]
+    return min(large_enough)[1] if large_enough else max(variants)[1]
+
+def image_url_from_attrs(attrs: dict) -> str:
+    """Ricava l'URL immagine da data-a-dynamic-image (variante più adatta) o, in mancanza, da src."""
+    image_url_data = attrs.get('data-a-dynamic-image')
+    if image_url_data:
+        return best_image_variant(html.unescape(image_url_data))
+    return attrs.get('src') or ""
+
+def parse_price_text(text: str) -> float or None:
+    """
+    Converte un prezzo in formato italiano ('1.299,99 €', '1.299 €', '79,99&nbsp;€', '129.99') in float.
+    Unico parser dei prezzi: lo usano scraper, feed, modalità bulk e i prezzi inseriti a mano.
+    """
+    cleaned = PRICE_NOISE_RE.sub('', html.unescape(text))
+    if not cleaned:
+        return None
+    # Formato italiano: punto per le migliaia, virgola per i decimali
+    if ',' in cleaned:
+        cleaned = cleaned.replace('.', '').replace(',', '.')
+    else:
+        # Senza decimali il punto delle migliaia resta ambiguo: tre cifre dopo il punto = migliaia
+        cleaned = THOUSANDS_DOT_RE.sub('', cleaned)
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+def extract_price(content) -> float or None:
+    """
+    Prezzo attuale del prodotto. Non serve un parser: si cerca il contenitore del prezzo
+    con str.find e poi il primo <span class="a-offscreen"> nelle vicinanze.
+    """
+    text = _to_text(content)
+    for container_id in PRICE_CONTAINER_IDS:
+        start = text.find(f'id="{container_id}"')
+        if start == -1:
+            continue
+        match = OFFSCREEN_PRICE_RE.search(text, start, start + PRICE_SEARCH_WINDOW)
+        if match:
+            return parse_price_text(match.group(1))
+
+    match = LEGACY_PRICE_RE.search(text)
+    return parse_price_text(match.group(1)) if match else None
+
+def _to_text(content) -> str:
+    if isinstance(content, (bytes, bytearray)):
+        return content.decode('utf-8', errors='replace')
+    return content
+
+class BaseExtractor(ABC):
+    """Interfaccia comune: extract() restituisce {'title', 'image_url'} oppure None se manca il titolo."""
+
+    name = "base"
+
+    @abstractmethod
+    def extract(self, content) -> dict or None:
+        ...
+
+class _ProductPageParser(HTMLParser):
+    """Parser incrementale che registra solo #productTitle e #landingImage/#imgBliss."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title_parts = []
+        self.title_done = False
+        self.images = {}
+        self._in_title = False
+        self._span_depth = 0
+
+    @property
+    def done(self) -> bool:
+        # landingImage ha la priorità: con imgBliss continuiamo a cercare fino alla fine
+        return self.title_done and IMAGE_IDS[0] in self.images
+
+    def handle_starttag(self, tag, attrs):
+        if self._in_title:
+            if tag == 'span':
+                self._span_depth += 1
+            return
+
+        if tag == 'span' and not self.title_done:
+            if dict(attrs).get('id') == TITLE_ID:
+                self._in_title = True
+                self._span_depth = 1
+        elif tag == 'img':
+            attrs = dict(attrs)
+            image_id = attrs.get('id')
+            if image_id in IMAGE_IDS and image_id not in self.images:
+                self.images[image_id] = attrs
+
+    def handle_endtag(self, tag):
+        if self._in_title and tag == 'span':
+            self._span_depth -= 1
+            if self._span_depth == 0:
+                self._in_title = False
+                self.title_done = True
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title_parts.append(data)
+
+class StreamingExtractor(BaseExtractor):
+    """
+    Percorso veloce: analizza l'HTML a blocchi con html.parser (libreria standard)
+    e si ferma appena trovati titolo e immagine, senza costruire l'albero del documento.
+    """
+
+    name = "streaming"
+
+    def extract(self, content) -> dict or None:
+        text = _to_text(content)
+        parser = _ProductPageParser()
+
+        for start in range(0, len(text), STREAMING_CHUNK_SIZE):
+            parser.feed(text[start:start + STREAMING_CHUNK_SIZE])
+            if parser.done:
+                break
+
+        # Stesso risultato di get_text(strip=True) di BeautifulSoup
+        title = "".join(part.strip() for part in parser.title_parts)
+        if not parser.title_done or not title:
+            return None
+
+        image_attrs = parser.images.get(IMAGE_IDS[0]) or parser.images.get(IMAGE_IDS[1])
+        return {"title": title, "image_url": image_url_from_attrs(image_attrs) if image_attrs else ""}
+
+class LxmlExtractor(BaseExtractor):
+    """Albero C di lxml: molto più rapido di html.parser quando la libreria è disponibile."""
+
+    name = "lxml"
+
+    def extract(self, content) -> dict or None:
+        root = lxml.html.fromstring(content)
+
+        title_nodes = root.xpath(f'//span[@id="{TITLE_ID}"]')
+        if not title_nodes:
+            return None
+        title = "".join(part.strip() for part in title_nodes[0].itertext())
+        if not title:
+            return None
+
+        image_url = ""
+        for image_id in IMAGE_IDS:
+            image_nodes = root.xpath(f'//img[@id="{image_id}"]')
+            if image_nodes:
+                image_url = image_url_from_attrs(dict(image_nodes[0].attrib))
+                break
+
+        return {"title": title, "image_url": image_url}
+
+def load_beautifulsoup():
+    """
+    Import ritardato di bs4: serve solo come ultima risorsa, quindi non pesa sull'avvio del bot.
+    Il warm-up (startup.py) lo chiama in un thread in background.
+    """
+    from bs4 import BeautifulSoup
+    return BeautifulSoup
+
+class SoupExtractor(BaseExtractor):
+    """Logica originale con BeautifulSoup: la più tollerante, usata come ultima risorsa."""
+
+    name = "soup"
+
+    def extract(self, content) -> dict or None:
+        soup = load_beautifulsoup()(content, 'html.parser')
+
+        title_element = soup.find('span', {'id': TITLE_ID})
+        if not title_element:
+            return None
+
+        image_element = soup.find('img', {'id': IMAGE_IDS[0]}) or soup.find('img', {'id': IMAGE_IDS[1]})
+        image_url = image_url_from_attrs(image_element.attrs) if image_element else ""
+        return {"title": title_element.get_text(strip=True), "image_url": image_url}
+
+EXTRACTORS = {
+    StreamingExtractor.name: StreamingExtractor,
+    LxmlExtractor.name: LxmlExtractor,
+    SoupExtractor.name: SoupExtractor,
+}
+
+def get_extractor_chain(mode: str = None) -> list:
+    """Restituisce gli estrattori da provare in ordine, in base a HTML_EXTRACTOR."""
+    mode = mode or HTML_EXTRACTOR
+    if mode in EXTRACTORS:
+        if mode == LxmlExtractor.name and not LXML_AVAILABLE:
+            logger.warning("HTML_EXTRACTOR=lxml ma lxml non è installato: uso BeautifulSoup.")
+            return [SoupExtractor()]
+        return [EXTRACTORS[mode]()]
+
+    chain = [StreamingExtractor()]
+    if LXML_AVAILABLE:
+        chain.append(LxmlExtractor())
+    chain.append(SoupExtractor())
+    return chain
+
+_default_chain = get_extractor_chain()
+
+def extract_product_fields(content, chain: list = None) -> dict or None:
+    """
+    Prova gli estrattori in ordine e restituisce il primo risultato con un titolo.
+    Un errore in un estrattore veloce non blocca il fallback su quelli successivi.
+    """
+    for extractor in chain or _default_chain:
+        try:
+            fields = extractor.extract(content)
+        except Exception as e:
+            logger.warning(f"Estrattore {extractor.name} fallito: {e}")
+            continue
+        if fields:
+            fields["price"] = extract_price(content)
+            return fields
+    return None
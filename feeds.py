@@ -0,0 +1,387 @@
+"""
+Raccolta automatica di offerte da feed RSS/Atom.
+
+Ogni FEED_POLL_INTERVAL secondi:
+    GET condizionali in parallelo (If-None-Match / If-Modified-Since: un feed invariato costa un 304)
+    -> parsing con feedparser in un thread -> link Amazon delle ultime voci -> ASIN
+    -> deduplica (set in memoria + tabella feed_seen_asins) -> scraping dei soli ASIN nuovi
+    -> bozze nella coda di approvazione degli admin (la stessa della modalità bulk).
+
+I feed sono quelli di FEED_URLS più quelli aggiunti con /aggiungi_feed. Nulla di tutto questo
+gira sull'event loop in modo bloccante: download con aiohttp, parsing in asyncio.to_thread.
+"""
+import os
+import re
+import html
+import time
+import asyncio
+import logging
+
+import aiohttp
+from telegram import Update
+from telegram.ext import ContextTypes, CommandHandler, Application
+
+import database
+from handlers import admin_only, make_draft, ADMIN_IDS
+from bulk import offer_drafts
+from extractors import parse_price_text
+from metrics import metrics
+from request_controller import CircuitOpenError
+from utils import get_product_asin_async, get_many_product_details_async, product_page_url
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione dei feed ---
+# Feed sempre attivi, separati da virgola o spazio (si sommano a quelli salvati con /aggiungi_feed)
+FEED_URLS = [url for url in re.split(r'[\s,]+', os.environ.get("FEED_URLS", "")) if url]
+FEED_POLL_INTERVAL = float(os.environ.get("FEED_POLL_INTERVAL", "600"))
+# Feed scaricati contemporaneamente (e connessioni massime della sessione dei feed)
+FEED_CONCURRENCY = int(os.environ.get("FEED_CONCURRENCY", "20"))
+FEED_TIMEOUT = float(os.environ.get("FEED_TIMEOUT", "20"))
+# Un feed più grande viene scartato: protegge la memoria da risposte anomale
+FEED_MAX_BYTES = int(os.environ.get("FEED_MAX_BYTES", str(5 * 1024 * 1024)))
+# Voci lette per feed (le più recenti): i feed di offerte ripubblicano spesso le stesse voci
+FEED_MAX_ENTRIES = int(os.environ.get("FEED_MAX_ENTRIES", "50"))
+# Un ASIN già visto torna proponibile dopo questi giorni
+FEED_DEDUP_DAYS = int(os.environ.get("FEED_DEDUP_DAYS", "7"))
+# Bozze proposte al massimo per giro: gli ASIN in eccesso restano per il giro successivo
+FEED_MAX_DRAFTS = int(os.environ.get("FEED_MAX_DRAFTS", "30"))
+FEED_SCRAPE_CONCURRENCY = int(os.environ.get("FEED_SCRAPE_CONCURRENCY", "4"))
+# Dimensione massima del set in memoria e ogni quanto ricaricarlo dal DB (che scarta gli ASIN scaduti)
+FEED_SEEN_MAX = int(os.environ.get("FEED_SEEN_MAX", "200000"))
+FEED_SEEN_RELOAD = float(os.environ.get("FEED_SEEN_RELOAD", "86400"))
+
+FEED_USER_AGENT = "Mozilla/5.0 (compatible; LegioneRisparmiatoriBot/1.0; +https://t.me/legionedeirisparmiatori)"
+
+# Link Amazon anche dentro l'HTML delle voci: si ferma a virgolette e tag
+FEED_LINK_RE = re.compile(r'https?://(?:amzn\.[a-z]{2,3}|www\.amazon\.[a-z]{2,3})[^\s"\'<>]*', re.IGNORECASE)
+# Prezzi in euro nel testo della voce: "€ 19,99", "19,99€", "19.99 euro"
+EURO_PRICE_RE = re.compile(
+    r'€\s*(\d{1,3}(?:\.\d{3})+(?:,\d{1,2})?|\d+(?:[.,]\d{1,2})?)'
+    r'|(\d{1,3}(?:\.\d{3})+(?:,\d{1,2})?|\d+(?:[.,]\d{1,2})?)\s*(?:€|euro\b)',
+    re.IGNORECASE
+)
+TAG_RE = re.compile(r'<[^>]+>')
+
+class SeenAsins:
+    """
+    ASIN già visti nei feed. In memoria ogni ASIN è un int (base 36, ~28 byte contro ~60 di una str):
+    il set fa da filtro veloce, la tabella feed_seen_asins è la fonte di verità condivisa.
+    Senza DB resta solo la memoria (deduplica fino al riavvio).
+    """
+
+    def __init__(self):
+        self._seen = set()
+        self._loaded_at = None
+
+    @staticmethod
+    def _key(asin: str) -> int:
+        return int(asin, 36)
+
+    def __contains__(self, asin: str) -> bool:
+        return self._key(asin) in self._seen
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def _add(self, asins) -> None:
+        if len(self._seen) + len(asins) > FEED_SEEN_MAX:
+            # Meglio ricominciare che crescere senza limiti: il DB continua a deduplicare
+            self._seen.clear()
+        self._seen.update(self._key(asin) for asin in asins)
+
+    async def load(self) -> None:
+        """Carica (o ricarica, una volta al giorno) gli ASIN ancora nella finestra di deduplica."""
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < FEED_SEEN_RELOAD:
+            return
+        try:
+            asins = await database.db_call(database.load_seen_asins, FEED_DEDUP_DAYS)
+        except Exception as e:
+            logger.error(f"Errore lettura degli ASIN già visti nei feed: {e}")
+            return
+        self._seen.clear()
+        self._add(asins)
+        self._loaded_at = time.monotonic()
+
+    async def claim(self, asins: list) -> list:
+        """Restituisce gli ASIN davvero nuovi e li segna come visti."""
+        candidates = [asin for asin in dict.fromkeys(asins) if asin not in self]
+        if not candidates:
+            return []
+        try:
+            new = await database.db_call(database.claim_new_asins, candidates, FEED_DEDUP_DAYS)
+        except Exception as e:
+            logger.warning(f"Deduplica dei feed solo in memoria ({e})")
+            new = candidates
+        self._add(candidates)
+        return new
+
+    async def release(self, asins: list) -> None:
+        """Rende di nuovo proponibili gli ASIN che non sono diventati bozze."""
+        if not asins:
+            return
+        keys = {self._key(asin) for asin in asins}
+        self._seen.difference_update(keys)
+        try:
+            await database.db_call(database.release_asins, asins)
+        except Exception as e:
+            logger.error(f"Errore rilascio degli ASIN dei feed: {e}")
+
+seen_asins = SeenAsins()
+
+# Validatori dell'ultima risposta di ogni feed: url -> (etag, last_modified)
+_validators = {}
+_feed_session = None
+_poll_lock = asyncio.Lock()
+
+async def get_feed_session() -> aiohttp.ClientSession:
+    """Sessione separata da quella dello scraper: i feed non consumano gli slot verso Amazon."""
+    global _feed_session
+    if _feed_session is None or _feed_session.closed:
+        timeout = aiohttp.ClientTimeout(total=FEED_TIMEOUT)
+        connector = aiohttp.TCPConnector(limit=FEED_CONCURRENCY, limit_per_host=2, ttl_dns_cache=300)
+        _feed_session = aiohttp.ClientSession(
+            headers={"User-Agent": FEED_USER_AGENT, "Accept-Encoding": "gzip, deflate"},
+            timeout=timeout,
+            connector=connector,
+        )
+    return _feed_session
+
+async def close_feed_session(*_args) -> None:
+    global _feed_session
+    if _feed_session is not None and not _feed_session.closed:
+        await _feed_session.close()
+    _feed_session = None
+
+# --- Download e parsing ---
+
+async def fetch_feed(session: aiohttp.ClientSession, url: str, etag: str = None, last_modified: str = None) -> tuple:
+    """
+    GET condizionale di un feed: (stato, corpo, etag, last_modified).
+    Il corpo è None se il feed non è cambiato (304) o la risposta non è utilizzabile.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    async with session.get(url, headers=headers) as response:
+        if response.status != 200:
+            return response.status, None, etag, last_modified
+        if response.content_length and response.content_length > FEED_MAX_BYTES:
+            raise ValueError(f"feed troppo grande ({response.content_length} byte)")
+        chunks, size = [], 0
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            size += len(chunk)
+            if size > FEED_MAX_BYTES:
+                raise ValueError(f"feed oltre {FEED_MAX_BYTES} byte")
+            chunks.append(chunk)
+        return 200, b"".join(chunks), response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+def parse_feed_entries(body: bytes) -> list:
+    """
+    Parsing (CPU, da eseguire in un thread): per ogni voce recente i link Amazon e i prezzi citati.
+    Restituisce [(link, [prezzi])].
+    """
+    import feedparser
+
+    parsed = feedparser.parse(body)
+    results = []
+    for entry in parsed.entries[:FEED_MAX_ENTRIES]:
+        hrefs = [entry.get("link")] + [link.get("href") for link in entry.get("links", [])]
+        texts = [entry.get("summary", "")] + [content.get("value", "") for content in entry.get("content", [])]
+
+        links = {href for href in hrefs if href and FEED_LINK_RE.match(href)}
+        for text in texts:
+            links.update(html.unescape(match) for match in FEED_LINK_RE.findall(text))
+        if not links:
+            continue
+
+        plain = html.unescape(TAG_RE.sub(" ", " ".join([entry.get("title", "")] + texts)))
+        prices = []
+        for match in EURO_PRICE_RE.finditer(plain):
+            price = parse_price_text(match.group(1) or match.group(2))
+            if price:
+                prices.append(price)
+        for link in links:
+            results.append((link, prices))
+    return results
+
+async def _poll_one(session: aiohttp.ClientSession, url: str, semaphore: asyncio.Semaphore) -> tuple:
+    """Scarica e analizza un feed: (stato, [(link, prezzi)]). Non solleva mai eccezioni."""
+    etag, last_modified = _validators.get(url, (None, None))
+    async with semaphore:
+        try:
+            async with metrics.span("feed_fetch"):
+                status, body, etag, last_modified = await fetch_feed(session, url, etag, last_modified)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Feed {url} non scaricato: {e}")
+            metrics.inc("feed_fetches_total", status="error")
+            return None, []
+
+    metrics.inc("feed_fetches_total", status=status)
+    _validators[url] = (etag, last_modified)
+    if body is None:
+        if status != 304:
+            logger.warning(f"Feed {url}: risposta HTTP {status}")
+        return status, []
+
+    try:
+        async with metrics.span("feed_parse"):
+            entries = await asyncio.to_thread(parse_feed_entries, body)
+    except Exception as e:
+        logger.warning(f"Feed {url} non analizzabile: {e}")
+        return status, []
+    return status, entries
+
+async def _resolve_candidates(entries: list, semaphore: asyncio.Semaphore) -> dict:
+    """ASIN -> prezzi citati nel feed. I link completi si risolvono con una regex, i corti con una HEAD."""
+    candidates = {}
+
+    async def _resolve(link, prices):
+        async with semaphore:
+            try:
+                asin = await get_product_asin_async(link)
+            except CircuitOpenError:
+                return
+        if asin:
+            candidates.setdefault(asin, []).extend(prices)
+
+    await asyncio.gather(*(_resolve(link, prices) for link, prices in entries))
+    return candidates
+
+def _draft_prices(product: dict, feed_prices: list) -> tuple:
+    """
+    (prezzo_precedente, prezzo_attuale): vale il prezzo letto su Amazon; il prezzo "di listino"
+    è il più alto citato nel feed, se superiore. None se non c'è nessun prezzo.
+    """
+    current = product.get("price") or (min(feed_prices) if feed_prices else None)
+    if current is None:
+        return None
+    return max([current] + feed_prices), current
+
+async def poll_feeds(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Un giro di raccolta dai feed; restituisce il numero di bozze proposte."""
+    if _poll_lock.locked():
+        return 0
+
+    async with _poll_lock:
+        try:
+            stored = await database.db_call(database.get_feeds)
+        except Exception as e:
+            logger.error(f"Errore lettura dei feed: {e}")
+            stored = []
+        for feed in stored:
+            _validators.setdefault(feed["url"], (feed["etag"], feed["last_modified"]))
+        urls = list(dict.fromkeys(FEED_URLS + [feed["url"] for feed in stored]))
+        if not urls:
+            return 0
+
+        session = await get_feed_session()
+        semaphore = asyncio.Semaphore(FEED_CONCURRENCY)
+        async with metrics.span("feed_poll"):
+            polled = await asyncio.gather(*(_poll_one(session, url, semaphore) for url in urls))
+
+        states = [(url, *_validators[url], status) for url, (status, _) in zip(urls, polled) if status is not None]
+        try:
+            await database.db_call(database.save_feed_states, states)
+        except Exception as e:
+            logger.error(f"Errore salvataggio dello stato dei feed: {e}")
+
+        entries = [entry for _, feed_entries in polled for entry in feed_entries]
+        if not entries:
+            logger.info(f"Feed: {len(urls)} controllati, nessuna voce nuova.")
+            return 0
+
+        candidates = await _resolve_candidates(entries, asyncio.Semaphore(FEED_SCRAPE_CONCURRENCY))
+        await seen_asins.load()
+        new_asins = await seen_asins.claim(list(candidates))
+        # Oltre il limite per giro: rilasciati, verranno ripresi al prossimo giro se il feed li contiene ancora
+        new_asins, deferred = new_asins[:FEED_MAX_DRAFTS], new_asins[FEED_MAX_DRAFTS:]
+        await seen_asins.release(deferred)
+        metrics.inc("feed_new_asins_total", len(new_asins))
+
+        products = await get_many_product_details_async(
+            [product_page_url(asin) for asin in new_asins], concurrency=FEED_SCRAPE_CONCURRENCY
+        )
+        drafts, failed = [], []
+        for asin, product in zip(new_asins, products):
+            prices = _draft_prices(product, candidates[asin]) if product and product.get("title") else None
+            if prices is None:
+                failed.append(asin)
+                continue
+            draft = make_draft(product)
+            draft['prezzo_precedente'], draft['prezzo_attuale'] = prices
+            drafts.append(draft)
+        # Scraping fallito (o Amazon ci blocca): l'ASIN potrà essere riproposto
+        await seen_asins.release(failed)
+
+        for admin_id in ADMIN_IDS:
+            try:
+                await offer_drafts(context.application, admin_id, drafts, f"📰 {len(drafts)} nuove offerte dai feed!")
+            except Exception as e:
+                logger.error(f"Impossibile proporre le bozze dei feed all'admin {admin_id}: {e}")
+
+        logger.info(
+            f"Feed: {len(urls)} controllati, {len(entries)} link, {len(new_asins)} ASIN nuovi, "
+            f"{len(drafts)} bozze proposte, {len(failed)} scraping falliti."
+        )
+        return len(drafts)
+
+# --- Comandi ---
+
+@admin_only
+async def aggiungi_feed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/aggiungi_feed <url>: aggiunge un feed RSS/Atom da cui raccogliere offerte."""
+    url = context.args[0].strip() if context.args else ""
+    if not url.startswith(("http://", "https://")):
+        await update.message.reply_text("Uso: /aggiungi_feed <url del feed RSS/Atom>")
+        return
+    added = await database.db_call(database.add_feed, url, update.effective_user.id)
+    await update.message.reply_text(f"📰 Feed aggiunto: {url}" if added else "ℹ️ Feed già presente o database non disponibile.")
+
+@admin_only
+async def rimuovi_feed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/rimuovi_feed <url>"""
+    if not context.args:
+        await update.message.reply_text("Uso: /rimuovi_feed <url>")
+        return
+    url = context.args[0].strip()
+    removed = await database.db_call(database.remove_feed, url)
+    _validators.pop(url, None)
+    await update.message.reply_text("✅ Feed rimosso." if removed else "ℹ️ Feed non trovato.")
+
+@admin_only
+async def lista_feed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    stored = await database.db_call(database.get_feeds)
+    if not stored and not FEED_URLS:
+        await update.message.reply_text("Nessun feed configurato. Usa /aggiungi_feed <url>.")
+        return
+    lines = [f"📰 Feed ({len(seen_asins)} ASIN già visti in memoria):"]
+    lines += [f"• {url} (da configurazione)" for url in FEED_URLS]
+    for feed in stored:
+        stato = f"HTTP {feed['last_status']}" if feed["last_status"] else "mai controllato"
+        lines.append(f"• {feed['url']} ({stato})")
+    await update.message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
+def setup_feed_ingestion(application: Application) -> None:
+    """Avvia il polling periodico dei feed."""
+    if not ADMIN_IDS:
+        logger.warning("Raccolta dai feed disattivata: nessun ADMIN_IDS a cui proporre le bozze.")
+        return
+    application.job_queue.run_repeating(
+        poll_feeds,
+        interval=FEED_POLL_INTERVAL,
+        first=60,
+        name="feed_ingestion",
+        job_kwargs={"max_instances": 1, "coalesce": True},
+    )
+
+feed_handlers = [
+    CommandHandler("aggiungi_feed", aggiungi_feed),
+    CommandHandler("rimuovi_feed", rimuovi_feed),
+    CommandHandler("feed", lista_feed),
+]
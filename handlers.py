@@ -1,8 +1,8 @@
 import re
 import urllib.parse
 import os
-import random
 import asyncio
+import logging
 from functools import wraps
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -15,18 +15,27 @@ from telegram.ext import (
 )
 import telegram.error 
 
+import database
+from cache import image_file_id_cache, product_cache, short_link_cache
+from metrics import metrics
+from rendering import escape_markdown_v2, calculate_discount, build_final_message
+from extractors import parse_price_text
+from persistence import PERSISTENCE_ENABLED
+from utils import get_amazon_product_details_async, session_pool
+from images import get_product_image, image_disk_cache
+from search_index import deal_index
+from request_controller import CircuitOpenError, amazon_controller
+
+logger = logging.getLogger(__name__)
+
 # --- Configurazione ---
 ADMIN_IDS_STR = os.environ.get("ADMIN_IDS", "")
 AMAZON_AFFILIATE_TAG = os.environ.get("AMAZON_AFFILIATE_TAG", "")
 CHANNEL_ID = os.environ.get("CHANNEL_ID") 
-
-HEADLINE_PHRASES = [
-    "🔥 SCONTO DA NON PERDERE!", "🚨 PREZZO MINIMO STORICO!", "💰 RISPARMIA ORA!",
-    "✨ GRANDE AFFARE SU AMAZON!", "🎉 OFFERTA ESCLUSIVA!", "💥 LEGIONARI, ALL'ATTACCO!",
-    "🔍 TROVATO UN SUPER AFFARE!", "💸 MAI VISTO UN PREZZO COSÌ!",
-    "🎖️ Vittoria sul Prezzo: MAXI SCONTO!", "⚔️ L'AFFARE CHE STAVATE ASPETTANDO È ARRIVATO!",
-    "⚔️ FINALMENTE IL PREZZO È CROLLATO"
-]
+# Numero massimo di canali serviti in parallelo durante la pubblicazione
+FANOUT_CONCURRENCY = int(os.environ.get("FANOUT_CONCURRENCY", "5"))
+# Giorni entro cui un ASIN già pubblicato viene segnalato come duplicato
+DEDUP_DAYS = int(os.environ.get("DEDUP_DAYS", "7"))
 
 # Parsing ADMIN_IDS
 if not ADMIN_IDS_STR:
@@ -45,7 +54,7 @@ def admin_only(func):
         if not ADMIN_IDS or user_id in ADMIN_IDS:
             return await func(update, context, *args, **kwargs)
         else:
-            print(f"[LOG] Accesso negato per l'utente: {user_id}")
+            logger.warning(f"Accesso negato per l'utente: {user_id}")
             await update.message.reply_text("❌ Non hai il permesso di usare questo bot.")
             return
     return wrapped
@@ -54,18 +63,24 @@ def admin_only(func):
 PREZZO_INIZIALE, PREZZO_ATTUALE, CONFERMA_INVIO = range(3)
 
 # --- Funzioni di Utilità ---
-def escape_markdown_v2(text: str) -> str:
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return re.sub(r'([%s])' % re.escape(escape_chars), r'\\\1', text)
+# Regex compilate una volta sola (la caption è in rendering.py)
+AMAZON_LINK_RE = re.compile(r'(https?://(?:amzn\.[a-z]{2,3}|www\.amazon\.[a-z]{2,3})[^ \r\n]*)', re.IGNORECASE)
+AMZN_TO_RE = re.compile(r'amzn\.to', re.IGNORECASE)
+# Prezzo scritto dall'admin: solo cifre e separatori (niente "12a3" interpretato come 123)
+MANUAL_PRICE_RE = re.compile(r'\d[\d.,]*')
 
-def calculate_discount(current, previous):
-    if previous is None or previous <= current or current <= 0: return 0
-    return round(((previous - current) / previous) * 100)
+def parse_price(txt: str) -> float:
+    """Converte '129,99 €', '129.99' o '1.299' in float. Solleva ValueError se non è un numero."""
+    cleaned = txt.replace('€', '').strip()
+    value = parse_price_text(cleaned) if MANUAL_PRICE_RE.fullmatch(cleaned) else None
+    if value is None:
+        raise ValueError(f"prezzo non valido: {txt!r}")
+    return value
 
 def apply_affiliate_tag(original_url: str, tag: str) -> str:
     if not original_url:
         return ""
-    if re.search(r'amzn\.to', original_url, re.IGNORECASE): 
+    if AMZN_TO_RE.search(original_url):
         return original_url
     if tag:
         parsed_url = urllib.parse.urlparse(original_url)
@@ -76,114 +91,300 @@ def apply_affiliate_tag(original_url: str, tag: str) -> str:
         return urllib.parse.urlunparse(parsed_url._replace(query=new_query, fragment=''))
     return original_url
 
+def make_draft(product_data: dict) -> dict:
+    """Crea la bozza del post a partire dai dettagli prodotto restituiti dallo scraper."""
+    final_link = apply_affiliate_tag(product_data.get('clean_product_link') or product_data.get('original_link'), AMAZON_AFFILIATE_TAG)
+    return {
+        'asin': product_data.get('asin'),
+        'title': product_data['title'],
+        'image_url': product_data.get('image_url'),
+        'final_buy_link': final_link
+    }
+
+async def send_text_fallback(bot, chat_id, caption: str = None, **kwargs):
+    """Stesso post senza foto: la caption diventa il testo del messaggio."""
+    kwargs.pop('photo', None)
+    return await bot.send_message(chat_id=chat_id, text=caption or "📦", **kwargs)
+
+async def send_product_photo(bot, chat_id, image_url: str, asin: str = None, **kwargs):
+    """
+    send_photo con cache dei file_id: la foto viene caricata solo al primo invio (byte già ridotti
+    dalla pipeline di images.py, o in mancanza l'URL), poi si riusa il file_id restituito da Telegram.
+    Se il file_id non è più valido si ricarica la foto; senza immagine si invia solo il testo.
+    """
+    if not image_url:
+        return await send_text_fallback(bot, chat_id, **kwargs)
+
+    file_id = await image_file_id_cache.get_async(image_url)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except telegram.error.BadRequest as e:
+            logger.warning(f"file_id in cache rifiutato ({e}), carico di nuovo la foto.")
+            await image_file_id_cache.invalidate_async(image_url)
+
+    photo = await get_product_image(asin, image_url) or image_url
+    try:
+        message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    except telegram.error.BadRequest as e:
+        # Immagine rifiutata da Telegram (URL irraggiungibile, formato non valido): il post parte comunque
+        logger.warning(f"Foto di {asin or image_url} rifiutata ({e}), invio solo testo.")
+        return await send_text_fallback(bot, chat_id, **kwargs)
+    await image_file_id_cache.put_async(image_url, photo_file_id(message), asin)
+    return message
+
+async def publish_draft(bot, draft: dict, chat_id=None, photo=None, rendered=None):
+    """
+    Pubblica una bozza completa (con prezzi) sul canale indicato (default: CHANNEL_ID).
+    `photo` permette di riusare il file_id di una foto già caricata su Telegram.
+    `rendered` è la coppia (caption, tastiera) già pronta (vedi rendering.render_batch).
+    """
+    chat_id = chat_id or CHANNEL_ID
+    caption, reply_markup = rendered or build_final_message(draft)
+    if photo:
+        return await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, reply_markup=reply_markup, parse_mode='MarkdownV2')
+    return await send_product_photo(bot, chat_id, draft.get('image_url'), draft.get('asin'), caption=caption, reply_markup=reply_markup, parse_mode='MarkdownV2')
+
+def photo_file_id(message) -> str or None:
+    """file_id della versione più grande della foto di un messaggio inviato, se presente."""
+    if message is not None and getattr(message, 'photo', None):
+        return message.photo[-1].file_id
+    return None
+
+async def fan_out(targets: list, send, concurrency: int = FANOUT_CONCURRENCY) -> list:
+    """
+    Invia la stessa bozza a più destinazioni. send(target, photo) -> Message.
+    Il primo invio riuscito carica la foto da Amazon; gli altri partono in parallelo
+    (al massimo `concurrency` alla volta) riusando il file_id restituito da Telegram.
+    Restituisce [(target, Message o eccezione)] nello stesso ordine di `targets`.
+    """
+    results = {}
+    pending = list(range(len(targets)))
+    photo = None
+
+    while pending:
+        index = pending.pop(0)
+        try:
+            message = await send(targets[index], None)
+            results[index] = message
+            photo = photo_file_id(message)
+            break
+        except Exception as e:
+            results[index] = e
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _send(index):
+        async with semaphore:
+            try:
+                results[index] = await send(targets[index], photo)
+            except Exception as e:
+                results[index] = e
+
+    await asyncio.gather(*(_send(index) for index in pending))
+    return [(targets[index], results[index]) for index in range(len(targets))]
+
+async def get_target_channels() -> list:
+    """Canali registrati con /aggiungi_canale; se non ce ne sono, il CHANNEL_ID dell'ambiente."""
+    try:
+        channels = await database.get_all_channels_async()
+    except Exception as e:
+        logger.error(f"Errore lettura canali: {e}")
+        channels = []
+    if channels:
+        return [channel_id for channel_id, _ in channels]
+    return [CHANNEL_ID] if CHANNEL_ID else []
+
+def post_record(draft: dict, message) -> dict:
+    """Riga per la tabella posts a partire dalla bozza e dal messaggio pubblicato."""
+    return {
+        'asin': draft.get('asin'),
+        'title': draft.get('title'),
+        'prezzo_precedente': draft.get('prezzo_precedente'),
+        'prezzo_attuale': draft.get('prezzo_attuale'),
+        'sconto': calculate_discount(draft.get('prezzo_attuale'), draft.get('prezzo_precedente')),
+        'channel_id': message.chat.id,
+        'message_id': message.message_id,
+        # Non è una colonna di posts: serve solo all'indice di ricerca inline
+        'image_url': draft.get('image_url'),
+    }
+
+async def record_posts(records: list) -> None:
+    """Salva i post pubblicati nello storico; un errore DB non deve bloccare la pubblicazione."""
+    records = [r for r in records if r.get('asin')]
+    if not records:
+        return
+    deal_index.add_posts(records)
+    try:
+        await database.save_posts_async(records)
+    except Exception as e:
+        logger.error(f"Errore salvataggio storico post: {e}")
+
+async def submit_drafts(context: ContextTypes.DEFAULT_TYPE, drafts: list, requested_by: int = None) -> str:
+    """
+    Mette le bozze approvate nella coda di pubblicazione (una riga per canale registrato)
+    e sveglia subito il dispatcher. Se il DB non è disponibile pubblica direttamente,
+    come prima della coda. Restituisce il messaggio di esito per l'admin.
+    """
+    channels = await get_target_channels()
+    if not channels:
+        return "❌ Nessun canale configurato (CHANNEL_ID o /aggiungi_canale)."
+
+    try:
+        queue_ids = await database.enqueue_posts_async(drafts, channels, requested_by)
+    except Exception as e:
+        logger.error(f"Errore accodamento post: {e}")
+        queue_ids = []
+
+    if queue_ids:
+        from scheduler import invia_messaggio_programmato
+        context.job_queue.run_once(invia_messaggio_programmato, 0)
+        return f"📥 {len(drafts)} post in coda di pubblicazione su {len(channels)} canali."
+
+    # Pubblicazione diretta: stessi limiti per canale e globali del dispatcher della coda
+    from scheduler import rate_limiter, _retry_after_seconds
+    records, errors = [], 0
+    for draft in drafts:
+        async def _send(chat_id, photo, draft=draft):
+            await rate_limiter.acquire(chat_id)
+            return await publish_draft(context.bot, draft, chat_id=chat_id, photo=photo)
+
+        for chat_id, result in await fan_out(channels, _send):
+            if isinstance(result, Exception):
+                errors += 1
+                if isinstance(result, telegram.error.RetryAfter):
+                    rate_limiter.penalize(chat_id, _retry_after_seconds(result))
+                logger.error(f"Errore invio al canale {chat_id}: {result}")
+            else:
+                records.append(post_record(draft, result))
+    await record_posts(records)
+    return f"✅ Pubblicati {len(records)} post" + (f", {errors} invii falliti." if errors else ".")
+
+async def dedup_notice(asin: str) -> str or None:
+    """Avviso per l'admin se l'ASIN è già stato pubblicato di recente (con il minimo storico)."""
+    if not asin:
+        return None
+    try:
+        last_post, lowest = await asyncio.gather(
+            database.get_last_post_async(asin, DEDUP_DAYS),
+            database.get_lowest_price_async(asin),
+        )
+    except Exception as e:
+        logger.error(f"Errore controllo duplicati per {asin}: {e}")
+        return None
+    if not last_post:
+        return None
+    published_at, price = last_post
+    notice = f"⚠️ Già pubblicato il {published_at:%d/%m %H:%M} a € {price:.2f}."
+    if lowest is not None:
+        notice += f" Minimo storico: € {lowest:.2f}."
+    return notice
+
 # --- Handlers ---
 @admin_only
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    print(f"[LOG] Comando /start ricevuto da {update.effective_user.id}")
+    logger.info(f"Comando /start ricevuto da {update.effective_user.id}")
     await update.message.reply_text(r"*Ciao\! Inviami un link Amazon per iniziare\.Pezzo di MERDA!*", parse_mode='MarkdownV2')
 
 @admin_only
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text(r"ℹ️ Invia un link Amazon, poi inserisci i prezzi quando richiesti\.", parse_mode='MarkdownV2')
+    await update.message.reply_text(
+        r"ℹ️ Invia un link Amazon, poi inserisci i prezzi quando richiesti\." "\n"
+        r"📦 Per più prodotti invia una riga per link: `link prezzo_iniziale prezzo_attuale` \(anche come file \.txt/\.csv\)\.",
+        parse_mode='MarkdownV2'
+    )
 
 @admin_only
+@metrics.timed("link_to_preview")
 async def amazon_link_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     message_text = update.message.text
-    print(f"\n--- [LOG] Ricevuto messaggio con link: {message_text[:50]}... ---")
+    logger.info(f"Ricevuto messaggio con link: {message_text[:50]}...")
     
     # Cerchiamo il link nel messaggio
-    match = re.search(r'(https?://(?:amzn\.[a-z]{2,3}|www\.amazon\.[a-z]{2,3})[^ \r\n]*)', message_text, re.IGNORECASE)
+    match = AMAZON_LINK_RE.search(message_text)
     
     if not match:
-        print("[LOG] Errore: Nessun link Amazon valido trovato.")
+        logger.warning("Nessun link Amazon valido trovato.")
         await update.message.reply_text(r"⚠️ Link non riconosciuto\.", parse_mode='MarkdownV2')
         return ConversationHandler.END
 
     # DEFINIAMO LA VARIABILE QUI (così i tentativi sotto la vedono)
     amazon_url = match.group(0)
-    print(f"[LOG] Link estratto: {amazon_url}")
+    logger.info(f"Link estratto: {amazon_url}")
     
     await update.message.reply_text(r"🔎 Analizzo il link\.\.\.", parse_mode='MarkdownV2')
 
-    from utils import get_amazon_product_details 
-    
+    # Un solo livello di ritentativi: li gestisce lo scraper insieme a request_controller.py
     product_data = None
-    tentativi = 3
-    
-    # CICLO DI TENTATIVI (Retries)
-    for i in range(tentativi):
-        print(f"[LOG] Tentativo scraping {i+1} di {tentativi}...")
-        try:
-            # Passiamo l'url estratto sopra
-            product_data = get_amazon_product_details(amazon_url)
-            if product_data and product_data.get('title'):
-                print(f"[LOG] Successo al tentativo {i+1}!")
-                break 
-        except Exception as e:
-            print(f"[LOG] Errore tecnico al tentativo {i+1}: {e}")
-        
-        if i < tentativi - 1:
-            print("[LOG] Amazon ha bloccato o ASIN non trovato. Riprovo tra 2 secondi...")
-            await asyncio.sleep(2) 
+    try:
+        product_data = await get_amazon_product_details_async(amazon_url)
+    except CircuitOpenError as e:
+        logger.warning(f"Scraping rifiutato: {e}")
+        await update.message.reply_text(f"🛑 Amazon ci sta bloccando: nuove richieste tra circa {e.retry_in:.0f} secondi.")
+        return ConversationHandler.END
+    except Exception as e:
+        logger.error(f"Errore tecnico durante lo scraping: {e}")
 
     if product_data and product_data.get('title'):
         # Salvataggio dati e invio anteprima (come prima)
         image_url = product_data.get('image_url')
-        final_link = apply_affiliate_tag(product_data.get('clean_product_link') or product_data.get('original_link'), AMAZON_AFFILIATE_TAG)
-        
-        context.user_data['draft'] = {
-            'title': product_data['title'],
-            'image_url': image_url,
-            'final_buy_link': final_link
-        }
-
-        if image_url:
-            await update.message.reply_photo(photo=image_url, caption=f"✅ {escape_markdown_v2(product_data['title'])}", parse_mode='MarkdownV2')
-        else:
-            await update.message.reply_text(f"✅ {escape_markdown_v2(product_data['title'])}", parse_mode='MarkdownV2')
+        context.user_data['draft'] = make_draft(product_data)
+        deal_index.add_product(product_data.get('asin'), product_data['title'], image_url, product_data.get('clean_product_link'))
+
+        notice = await dedup_notice(product_data.get('asin'))
+        if notice:
+            await update.message.reply_text(notice)
+
+        # Senza immagine send_product_photo invia solo il testo
+        await send_product_photo(
+            context.bot, update.effective_chat.id, image_url, product_data.get('asin'),
+            caption=f"✅ {escape_markdown_v2(product_data['title'])}", parse_mode='MarkdownV2'
+        )
 
         await update.message.reply_text("1️⃣ Inserisci il prezzo iniziale (es: 129.99):")
         return PREZZO_INIZIALE
     else:
-        print("[LOG] Scraping fallito definitivamente dopo 3 tentativi.")
+        logger.warning("Scraping fallito definitivamente.")
         await update.message.reply_text(r"❌ Amazon ha bloccato la richiesta dopo vari tentativi\. Riprova tra un po'\.", parse_mode='MarkdownV2')
         return ConversationHandler.END
 
 async def handle_prezzo_iniziale(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     txt = update.message.text
-    print(f"[DEBUG] Ricevuto prezzo iniziale: {txt}")
+    logger.debug(f"Ricevuto prezzo iniziale: {txt}")
     try:
         # Pulizia del testo e conversione
-        val = float(txt.replace('€', '').replace(',', '.').strip())
+        val = parse_price(txt)
         context.user_data['draft']['prezzo_precedente'] = val
         
-        print(f"[DEBUG] Prezzo salvato: {val}. Chiedo prezzo scontato.")
+        logger.debug(f"Prezzo salvato: {val}. Chiedo prezzo scontato.")
         await update.message.reply_text(r"2️⃣ Ottimo\! Ora inserisci il *prezzo attuale* \(scontato\):", parse_mode='MarkdownV2')
         return PREZZO_ATTUALE
     except ValueError:
-        print(f"[DEBUG] Errore conversione per: {txt}")
+        logger.warning(f"Errore conversione per: {txt}")
         await update.message.reply_text(r"❌ Inserisci un numero valido \(es: 49.90\):", parse_mode='MarkdownV2')
         return PREZZO_INIZIALE
 
 async def handle_prezzo_attuale(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     txt = update.message.text
-    print(f"[DEBUG] Ricevuto prezzo attuale: {txt}")
+    logger.debug(f"Ricevuto prezzo attuale: {txt}")
     try:
-        val = float(txt.replace('€', '').replace(',', '.').strip())
+        val = parse_price(txt)
         context.user_data['draft']['prezzo_attuale'] = val
         
-        print(f"[DEBUG] Prezzo attuale salvato: {val}. Genero anteprima...")
+        logger.debug(f"Prezzo attuale salvato: {val}. Genero anteprima...")
         
         draft = context.user_data['draft']
         caption, reply_markup = build_final_message(draft)
         
         # Invio anteprima
         await update.message.reply_text(r"✨ *Anteprima del post:*", parse_mode='MarkdownV2')
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id, 
-            photo=draft['image_url'], 
+        await send_product_photo(
+            context.bot,
+            update.effective_chat.id,
+            draft.get('image_url'),
+            draft.get('asin'),
             caption=caption,
-            reply_markup=reply_markup, 
+            reply_markup=reply_markup,
             parse_mode='MarkdownV2'
         )
         
@@ -195,73 +396,93 @@ async def handle_prezzo_attuale(update: Update, context: ContextTypes.DEFAULT_TY
         return CONFERMA_INVIO
         
     except ValueError:
-        print(f"[DEBUG] Errore conversione prezzo attuale: {txt}")
+        logger.warning(f"Errore conversione prezzo attuale: {txt}")
         await update.message.reply_text(r"❌ Inserisci un numero valido per il prezzo attuale:", parse_mode='MarkdownV2')
         return PREZZO_ATTUALE
 
+@metrics.timed("confirm_to_queue")
 async def handle_conferma_invio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     
-    print(f"[LOG] Callback ricevuto: {query.data}")
+    logger.info(f"Callback ricevuto: {query.data}")
     if query.data == "send":
-        if not CHANNEL_ID:
-            print("[LOG] Errore: CHANNEL_ID non configurato.")
-            await query.edit_message_text("❌ CHANNEL_ID non impostato.")
-            return ConversationHandler.END
-        
         draft = context.user_data.get('draft')
-        caption, reply_markup = build_final_message(draft)
+        if not draft or draft.get('prezzo_attuale') is None:
+            # Pulsante di un'anteprima vecchia (riavvio, conversazione già chiusa): niente da pubblicare
+            logger.warning(f"Conferma senza bozza da {update.effective_user.id}")
+            await query.edit_message_text("⌛ Bozza scaduta: invia di nuovo il link.")
+            return ConversationHandler.END
         try:
-            print(f"[LOG] Tentativo di invio al canale {CHANNEL_ID}...")
-            await context.bot.send_photo(chat_id=CHANNEL_ID, photo=draft['image_url'], caption=caption, reply_markup=reply_markup, parse_mode='MarkdownV2')
-            print("[LOG] Invio completato con successo!")
-            await query.edit_message_text("✅ Pubblicato con successo!")
+            logger.info("Invio ai canali tramite coda di pubblicazione...")
+            esito = await submit_drafts(context, [draft], update.effective_user.id)
+            logger.info(esito)
+            await query.edit_message_text(esito)
         except Exception as e:
-            print(f"[LOG] Errore durante l'invio al canale: {e}")
+            logger.error(f"Errore durante l'invio al canale: {e}")
             await query.edit_message_text(f"❌ Errore invio: {e}")
     else:
-        print("[LOG] Post annullato dall'utente.")
+        logger.info("Post annullato dall'utente.")
         await query.edit_message_text("❌ Operazione annullata.")
     
     return ConversationHandler.END
 
-def build_final_message(draft: dict) -> (str, InlineKeyboardMarkup):
-    CHANNEL_USERNAME = "@legionedeirisparmiatori"
-    INVITE_TEXT = f"Entra nella Legione delle offerte! ⚔️ {CHANNEL_USERNAME}\nhttps://t.me/legionedeirisparmiatori"
-    
-    intestazione = random.choice(HEADLINE_PHRASES)
-    title = escape_markdown_v2(draft['title'])
-    p_att = draft['prezzo_attuale']
-    p_pre = draft['prezzo_precedente']
-    
-    p_att_esc = f"€ {p_att:.2f}".replace('.', r'\.')
-    p_pre_esc = f"€ {p_pre:.2f}".replace('.', r'\.')
-    sconto = calculate_discount(p_att, p_pre)
-    
-    sconto_text = f"🔥 RISPARMI IL {sconto}%!" if sconto > 0 else ""
-    prezzo_line = f"🏷️ *Prezzo Consigliato:* ~{p_pre_esc}~\n" if p_pre > p_att else ""
-    
-    caption = (f"*{escape_markdown_v2(intestazione)}*\n\n"
-               f"*{title}*\n\n"
-               f"{prezzo_line}💰 *Prezzo Attuale:* *{p_att_esc}*\n\n"
-               f"*__{escape_markdown_v2(sconto_text)}__*\n\n"
-               f"[DISCLAIMER](https://telegra.ph/LEGIONARI-DEL-RISPARMIO-ATTENTI-ALLA-BATTAGLIA-08-27)")
-    
-    share_msg = f"💥 Affare! {draft['title']} a € {p_att:.2f}!"
-    telegram_share_url = f"https://t.me/share/url?url={urllib.parse.quote_plus(draft['final_buy_link'])}&text={urllib.parse.quote_plus(share_msg)}"
-    invite_url = f"https://t.me/share/url?url=&text={urllib.parse.quote_plus(INVITE_TEXT)}"
+@admin_only
+async def aggiungi_canale(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/aggiungi_canale <id_canale> [nome]: registra un canale di destinazione per la pubblicazione."""
+    if not context.args:
+        await update.message.reply_text("Uso: /aggiungi_canale <id_canale> [nome]")
+        return
+    try:
+        channel_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ L'id del canale deve essere numerico (es: -1001234567890).")
+        return
+    name = " ".join(context.args[1:]) or str(channel_id)
+    await database.add_channel_async(channel_id, name)
+    logger.info(f"Canale {channel_id} ({name}) registrato da {update.effective_user.id}")
+    await update.message.reply_text(f"✅ Canale {name} registrato.")
+
+@admin_only
+async def lista_canali(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    channels = await database.get_all_channels_async()
+    if not channels:
+        await update.message.reply_text(f"Nessun canale registrato: si pubblica solo su CHANNEL_ID ({CHANNEL_ID}).")
+        return
+    lines = "\n".join(f"• {name} ({channel_id})" for channel_id, name in channels)
+    await update.message.reply_text(f"📣 Canali di pubblicazione:\n{lines}")
 
-    keyboard = [
-        [InlineKeyboardButton("🛒 ACQUISTA ORA!", url=draft['final_buy_link'])],
-        [InlineKeyboardButton("👥 Invita Amici", url=invite_url),
-         InlineKeyboardButton("📲 WhatsApp", url=f"https://wa.me/?text={urllib.parse.quote_plus(share_msg + ' ' + draft['final_buy_link'])}")]
-    ]
-    return caption, InlineKeyboardMarkup(keyboard)
+@admin_only
+async def stato(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/stato: metriche dello scraper (per host e per identità), delle cache e durate medie delle fasi."""
+    lines = ["📊 Stato scraper"]
+    for host in amazon_controller.snapshot():
+        lines.append(
+            f"• {host['host']}: circuito {host['circuit']}, intervallo {host['interval']}s, "
+            f"in corso {host['in_flight']}, richieste {host.get('requests', 0)}, "
+            f"bloccate {host.get('blocked', 0)} (tasso {host['block_rate']:.0%}), "
+            f"errori {host.get('errors', 0)}, rifiutate {host.get('rejected', 0)}"
+        )
+    for identity in session_pool.snapshot():
+        latency = f"{identity['latency'] * 1000:.0f}ms" if identity['latency'] is not None else "n/d"
+        lines.append(
+            f"• identità #{identity['id']} ({identity['agent']}): richieste {identity['requests']}, "
+            f"bloccate {identity['blocked']}, errori {identity['errors']}, latenza {latency}"
+            f"{', in pausa' if identity['cooling'] else ''}"
+        )
+    for name, stats in (("prodotti", product_cache.stats()), ("link corti", short_link_cache.stats()),
+                        ("immagini", image_file_id_cache.stats()), ("immagini su disco", image_disk_cache.stats()),
+                        ("ricerca inline", deal_index.stats())):
+        lines.append(f"• cache {name}: " + ", ".join(f"{key} {value}" for key, value in stats.items()))
+    timings = metrics.summary()
+    if timings:
+        lines.append("⏱️ Durate")
+        lines.extend(f"• {line}" for line in timings)
+    await update.message.reply_text("\n".join(lines))
 
 @admin_only
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    print(f"[LOG] Conversazione annullata da {update.effective_user.id}")
+    logger.info(f"Conversazione annullata da {update.effective_user.id}")
     context.user_data.clear()
     await update.message.reply_text("Operazione annullata.")
     return ConversationHandler.END
@@ -279,5 +500,8 @@ conv_handler = ConversationHandler(
         CONFERMA_INVIO: [CallbackQueryHandler(handle_conferma_invio)],
     },
     fallbacks=[CommandHandler("cancel", cancel)],
-    per_user=True
+    per_user=True,
+    # Stato salvato da persistence.py: una bozza a metà sopravvive a un riavvio
+    name="conversazione_post",
+    persistent=PERSISTENCE_ENABLED,
 )
\ No newline at end of file
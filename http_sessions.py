@@ -0,0 +1,293 @@
+"""
+Pool di identità HTTP verso Amazon.
+
+Un'identità è un "browser" coerente nel tempo: User-Agent fisso, cookie jar proprio e pool di
+connessioni keep-alive proprio (aiohttp per il motore asincrono, requests.Session per le funzioni
+sincrone). Ogni richiesta prende in prestito l'identità meno occupata:
+
+    with session_pool.use() as lease:
+        async with lease.session.get(url) as response:
+            ...
+        lease.record(response.status, blocked=captcha)
+
+Dopo un blocco (403/429/503 o captcha) l'identità resta in pausa per HTTP_IDENTITY_COOLDOWN secondi
+se ce ne sono altre disponibili. Dopo HTTP_IDENTITY_MAX_BLOCKS blocchi consecutivi viene sostituita
+da un'identità nuova (altro User-Agent, cookie vuoti). Il ritmo verso Amazon resta compito di
+request_controller.py: qui si decide solo *chi* fa la richiesta.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import itertools
+
+import aiohttp
+
+from metrics import metrics
+from request_controller import BLOCK_STATUSES
+
+logger = logging.getLogger(__name__)
+
+# Identità contemporanee e connessioni keep-alive per ciascuna
+HTTP_IDENTITIES = int(os.environ.get("HTTP_IDENTITIES", "4"))
+HTTP_IDENTITY_CONNECTIONS = int(os.environ.get("HTTP_IDENTITY_CONNECTIONS", "4"))
+HTTP_IDENTITY_MAX_BLOCKS = int(os.environ.get("HTTP_IDENTITY_MAX_BLOCKS", "3"))
+HTTP_IDENTITY_COOLDOWN = float(os.environ.get("HTTP_IDENTITY_COOLDOWN", "60"))
+# Connessioni inattive tenute aperte (secondi): oltre, la prossima richiesta rifà TCP+TLS
+HTTP_KEEPALIVE = float(os.environ.get("HTTP_KEEPALIVE", "60"))
+
+# --- Compressione ---
+
+def _brotli_available() -> bool:
+    for module in ("brotli", "brotlicffi"):
+        try:
+            __import__(module)
+            return True
+        except ImportError:
+            continue
+    return False
+
+# aiohttp e urllib3 decomprimono br solo se c'è il pacchetto Brotli: senza, non lo chiediamo
+BROTLI_AVAILABLE = _brotli_available()
+ACCEPT_ENCODING = "gzip, deflate, br" if BROTLI_AVAILABLE else "gzip, deflate"
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+def check_decoded_html(body: bytes, content_encoding: str = None) -> bool:
+    """
+    Conta la codifica ricevuta e verifica che il corpo sia HTML già decompresso.
+    False se sono arrivati byte compressi (codifica non supportata o intestazioni incoerenti).
+    """
+    metrics.inc("http_content_encoding_total", encoding=(content_encoding or "identity").lower())
+    head = body[:512].lstrip().removeprefix(b"\xef\xbb\xbf").lstrip()
+    if head.startswith(GZIP_MAGIC) or (head and not head.startswith(b"<")):
+        metrics.inc("http_undecoded_total", encoding=(content_encoding or "identity").lower())
+        logger.error(f"Corpo non decompresso (Content-Encoding: {content_encoding or 'nessuno'}).")
+        return False
+    return True
+
+# --- Identità ---
+
+class Identity:
+    """User-Agent, cookie e connessioni di un singolo "browser", con le sue statistiche di salute."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_agent: str, headers: dict, timeout: float):
+        self.id = next(self._ids)
+        self.user_agent = user_agent
+        self.headers = {**headers, "User-Agent": user_agent, "Accept-Encoding": ACCEPT_ENCODING}
+        self.timeout = timeout
+        self._session = None
+        self._loop = None
+        self._sync_session = None
+        self._sync_lock = threading.Lock()
+
+        self.created = time.monotonic()
+        self.last_used = 0.0
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.ok = 0
+        self.blocked = 0
+        self.errors = 0
+        self.consecutive_blocks = 0
+        self.latency = None
+        self.retired = False
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """ClientSession dell'identità (creata al primo uso, nell'event loop corrente)."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_IDENTITY_CONNECTIONS, ttl_dns_cache=300, keepalive_timeout=HTTP_KEEPALIVE
+            )
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=connector,
+                cookie_jar=aiohttp.CookieJar(),
+            )
+            self._loop = asyncio.get_running_loop()
+        return self._session
+
+    @property
+    def sync_session(self):
+        """requests.Session dell'identità, per le funzioni sincrone (import ritardato di requests)."""
+        with self._sync_lock:
+            if self._sync_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                session.headers.update(self.headers)
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_IDENTITY_CONNECTIONS)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sync_session = session
+            return self._sync_session
+
+    @property
+    def label(self) -> str:
+        """'Windows NT 10.0; Win64; x64' invece dell'intero User-Agent."""
+        return self.user_agent.split("(", 1)[-1].split(")", 1)[0]
+
+    def record(self, status: int = None, blocked: bool = False, elapsed: float = None, error: bool = False) -> None:
+        self.requests += 1
+        if error:
+            self.errors += 1
+        elif blocked:
+            self.blocked += 1
+            self.consecutive_blocks += 1
+            self.cooldown_until = time.monotonic() + HTTP_IDENTITY_COOLDOWN
+        else:
+            self.ok += 1
+            self.consecutive_blocks = 0
+        if elapsed is not None and not error:
+            # Media mobile esponenziale: pesa di più le richieste recenti
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+
+    def snapshot(self) -> dict:
+        return {
+            "id": self.id,
+            "agent": self.label,
+            "age": round(time.monotonic() - self.created),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "ok": self.ok,
+            "blocked": self.blocked,
+            "errors": self.errors,
+            "consecutive_blocks": self.consecutive_blocks,
+            "cooling": time.monotonic() < self.cooldown_until,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+        }
+
+    def close_soon(self) -> None:
+        """Chiude le sessioni da qualunque thread (quella aiohttp nel suo event loop)."""
+        if self._sync_session is not None:
+            self._sync_session.close()
+            self._sync_session = None
+        session, loop = self._session, self._loop
+        self._session = None
+        if session is not None and not session.closed and loop is not None:
+            try:
+                loop.call_soon_threadsafe(lambda: loop.create_task(session.close()))
+            except RuntimeError:
+                pass  # event loop già chiuso: le connessioni si chiudono con il processo
+
+    async def close(self) -> None:
+        if self._sync_session is not None:
+            self._sync_session.close()
+            self._sync_session = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+class Lease:
+    """Prestito di un'identità per una richiesta; l'esito va registrato con record()."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.identity = None
+        self.status = None
+        self.blocked = False
+        self.recorded = False
+        self.started = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.identity.session
+
+    @property
+    def sync_session(self):
+        return self.identity.sync_session
+
+    def record(self, status: int = None, blocked: bool = False) -> None:
+        self.recorded = True
+        self.status = status
+        self.blocked = blocked or status in BLOCK_STATUSES
+
+    def __enter__(self):
+        self.identity = self.pool._acquire()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        error = exc_type is not None and not self.recorded
+        self.pool._release(self.identity, self.status, self.blocked, time.perf_counter() - self.started, error)
+        return False
+
+class SessionPool:
+    def __init__(self, headers: dict, user_agents: list, timeout: float, size: int = HTTP_IDENTITIES):
+        self.headers = headers
+        self.user_agents = user_agents
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._retired = []
+        self.rotations = 0
+        self.identities = [self._new_identity() for _ in range(max(1, size))]
+
+    def _new_identity(self, previous: Identity = None) -> Identity:
+        # Un'identità nuova non riusa lo User-Agent di quella appena ritirata
+        choices = [ua for ua in self.user_agents if previous is None or ua != previous.user_agent]
+        return Identity(random.choice(choices or self.user_agents), self.headers, self.timeout)
+
+    def use(self) -> Lease:
+        return Lease(self)
+
+    def _acquire(self) -> Identity:
+        with self._lock:
+            now = time.monotonic()
+            available = [identity for identity in self.identities if identity.cooldown_until <= now] or self.identities
+            identity = min(available, key=lambda i: (i.in_flight, i.last_used))
+            identity.in_flight += 1
+            identity.last_used = now
+            return identity
+
+    def _release(self, identity: Identity, status, blocked: bool, elapsed: float, error: bool) -> None:
+        with self._lock:
+            identity.in_flight -= 1
+            identity.record(status=status, blocked=blocked, elapsed=elapsed, error=error)
+            if blocked and not identity.retired and identity.consecutive_blocks >= HTTP_IDENTITY_MAX_BLOCKS:
+                self._rotate(identity)
+            closable = [retired for retired in self._retired if retired.in_flight == 0]
+            self._retired = [retired for retired in self._retired if retired.in_flight > 0]
+        for retired in closable:
+            retired.close_soon()
+
+    def _rotate(self, identity: Identity) -> None:
+        """Sostituisce un'identità bloccata; le sue richieste in corso terminano prima della chiusura."""
+        replacement = self._new_identity(identity)
+        self.identities[self.identities.index(identity)] = replacement
+        identity.retired = True
+        self._retired.append(identity)
+        self.rotations += 1
+        metrics.inc("http_identity_rotations_total")
+        logger.warning(
+            f"Identità #{identity.id} ({identity.label}) bloccata {identity.consecutive_blocks} volte di fila: "
+            f"sostituita da #{replacement.id} ({replacement.label})."
+        )
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [identity.snapshot() for identity in self.identities]
+
+    async def close(self) -> None:
+        with self._lock:
+            identities, self._retired = self.identities + self._retired, []
+        for identity in identities:
+            await identity.close()
+
+def pool_samples(pool: SessionPool) -> list:
+    """Salute di ogni identità per metrics.py."""
+    samples = [("http_identities", "gauge", {}, len(pool.identities))]
+    for state in pool.snapshot():
+        labels = {"identity": state["id"]}
+        for event in ("requests", "ok", "blocked", "errors"):
+            samples.append((f"http_identity_{event}_total", "counter", labels, state[event]))
+        samples.append(("http_identity_in_flight", "gauge", labels, state["in_flight"]))
+        if state["latency"] is not None:
+            samples.append(("http_identity_latency_seconds", "gauge", labels, state["latency"]))
+    return samples
@@ -0,0 +1,242 @@
+"""
+Immagini dei prodotti: scaricate una volta, ridotte e ricompresse, tenute in una cache su disco.
+
+    get_product_image(asin, image_url) -> bytes JPEG pronti per send_photo (o None)
+
+- l'immagine viene scaricata una sola volta anche se più invii la chiedono insieme;
+- la riduzione (lato lungo <= IMAGE_MAX_SIDE, JPEG qualità IMAGE_JPEG_QUALITY) gira nel pool di
+  workers.run_cpu; Pillow è opzionale: senza, si caricano i byte originali;
+- la cache su disco è indicizzata per ASIN e limitata a IMAGE_CACHE_MAX_MB (si eliminano i file
+  usati meno di recente).
+
+IMAGE_PIPELINE=0 torna al comportamento precedente: Telegram scarica l'immagine dall'URL.
+"""
+import io
+import os
+import re
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+import aiohttp
+
+from metrics import metrics
+from request_controller import amazon_controller
+import workers
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PIPELINE = os.environ.get("IMAGE_PIPELINE", "1") == "1"
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", ".image_cache")
+IMAGE_CACHE_MAX_MB = float(os.environ.get("IMAGE_CACHE_MAX_MB", "200"))
+# Telegram mostra le foto al massimo a 1280 px: oltre è solo peso in più da caricare
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", "1280"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+# Download più grandi vengono scartati (limite di Telegram per le foto: 10 MB)
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_TIMEOUT = float(os.environ.get("IMAGE_TIMEOUT", "15"))
+
+ASIN_RE = re.compile(r'^[A-Z0-9]{10}$')
+
+# --- Elaborazione (CPU, nel pool di workers.py) ---
+
+def process_image(raw: bytes, max_side: int = IMAGE_MAX_SIDE, quality: int = IMAGE_JPEG_QUALITY) -> bytes:
+    """Riduce e ricomprime in JPEG; restituisce i byte originali se non conviene o se manca Pillow."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return raw
+
+    with Image.open(io.BytesIO(raw)) as image:
+        if image.mode in ("RGBA", "LA", "P"):
+            # Trasparenza (PNG) su fondo bianco, come la mostra Amazon
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side))
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+
+    processed = output.getvalue()
+    return processed if len(processed) < len(raw) else raw
+
+# --- Cache su disco ---
+
+class ImageDiskCache:
+    """
+    File <chiave>.jpg in una directory, con un indice in memoria in ordine di utilizzo (LRU).
+    L'indice si costruisce al primo accesso leggendo la directory; l'I/O gira in un thread.
+    """
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = int(IMAGE_CACHE_MAX_MB * 1024 * 1024)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index = None
+        self._total = 0
+        self._lock = asyncio.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.jpg")
+
+    def _scan(self) -> OrderedDict:
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".jpg"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        return OrderedDict((key, size) for _, key, size in sorted(entries))
+
+    async def _ensure_index(self) -> None:
+        if self._index is None:
+            self._index = await asyncio.to_thread(self._scan)
+            self._total = sum(self._index.values())
+
+    def _read(self, key: str) -> bytes or None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: str, data: bytes, evict: list) -> None:
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        for old in evict:
+            try:
+                os.remove(self._path(old))
+            except FileNotFoundError:
+                pass
+
+    async def get(self, key: str) -> bytes or None:
+        async with self._lock:
+            await self._ensure_index()
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        data = await asyncio.to_thread(self._read, key)
+        if data is None:
+            async with self._lock:
+                self._total -= self._index.pop(key, 0)
+        return data
+
+    async def put(self, key: str, data: bytes) -> None:
+        async with self._lock:
+            await self._ensure_index()
+            self._total += len(data) - self._index.pop(key, 0)
+            self._index[key] = len(data)
+            evict = []
+            while self._total > self.max_bytes and len(self._index) > 1:
+                old, size = self._index.popitem(last=False)
+                self._total -= size
+                evict.append(old)
+        await asyncio.to_thread(self._write, key, data, evict)
+
+    def stats(self) -> dict:
+        return {"files": len(self._index or ()), "mb": round(self._total / 1024 / 1024, 1)}
+
+image_disk_cache = ImageDiskCache()
+
+# --- Download ---
+
+_inflight = {}
+_session = None
+
+async def _get_session() -> aiohttp.ClientSession:
+    """Sessione dedicata al CDN delle immagini (host diverso dalle pagine prodotto)."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=IMAGE_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=8, ttl_dns_cache=300),
+        )
+    return _session
+
+async def close_image_session(*_args) -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def cache_key(asin: str, image_url: str) -> str:
+    if asin and ASIN_RE.match(asin):
+        return asin
+    return hashlib.sha1(image_url.encode()).hexdigest()[:20]
+
+async def _download(image_url: str) -> bytes or None:
+    session = await _get_session()
+    async with amazon_controller.limit(image_url) as slot:
+        async with metrics.span("image_download"):
+            async with session.get(image_url) as response:
+                slot.record(response.status)
+                if response.status != 200:
+                    logger.warning(f"Immagine {image_url}: risposta HTTP {response.status}")
+                    return None
+                if response.content_length and response.content_length > IMAGE_MAX_BYTES:
+                    logger.warning(f"Immagine {image_url} troppo grande ({response.content_length} byte)")
+                    return None
+                data = await response.read()
+    return data if len(data) <= IMAGE_MAX_BYTES else None
+
+async def _fetch_and_store(key: str, image_url: str) -> bytes or None:
+    try:
+        raw = await _download(image_url)
+    except Exception as e:
+        logger.warning(f"Download dell'immagine {image_url} non riuscito: {e}")
+        return None
+    if not raw:
+        return None
+
+    try:
+        async with metrics.span("image_process"):
+            data = await workers.run_cpu(process_image, raw)
+    except Exception as e:
+        # File non riconosciuto da Pillow: si carica l'originale, Telegram deciderà
+        logger.warning(f"Elaborazione dell'immagine {image_url} non riuscita: {e}")
+        data = raw
+    metrics.inc("image_bytes_saved_total", len(raw) - len(data))
+
+    try:
+        await image_disk_cache.put(key, data)
+    except OSError as e:
+        logger.error(f"Scrittura della cache immagini non riuscita: {e}")
+    return data
+
+async def get_product_image(asin: str, image_url: str) -> bytes or None:
+    """Byte dell'immagine pronti per l'upload: dalla cache su disco o scaricati (una sola volta)."""
+    if not IMAGE_PIPELINE or not image_url:
+        return None
+    key = cache_key(asin, image_url)
+
+    cached = await image_disk_cache.get(key)
+    if cached:
+        metrics.inc("images_total", source="disk")
+        return cached
+
+    # Invii contemporanei della stessa immagine (anteprima + più canali) condividono il download
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.create_task(_fetch_and_store(key, image_url))
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    data = await asyncio.shield(task)
+    metrics.inc("images_total", source="download" if data else "failed")
+    return data
+
+def _image_samples() -> list:
+    stats = image_disk_cache.stats()
+    return [
+        ("image_cache_files", "gauge", {}, stats["files"]),
+        ("image_cache_megabytes", "gauge", {}, stats["mb"]),
+    ]
+
+metrics.register_collector(_image_samples)
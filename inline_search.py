@@ -0,0 +1,113 @@
+"""
+Ricerca inline delle offerte: `@bot cuffie bluetooth` o `@bot B0XXXXXXXX` in qualunque chat.
+
+Risponde dall'indice in memoria di search_index.py, senza scraping né query al DB:
+- prodotti pubblicati: stessa caption e tastiera del post sul canale (build_final_message), con
+  l'ultimo prezzo pubblicato;
+- prodotti solo in cache (mai pubblicati): titolo e pulsante di acquisto.
+
+La foto usa il file_id già noto a Telegram se c'è, altrimenti l'URL Amazon; senza immagine il
+risultato è un messaggio di testo. La modalità inline va attivata su BotFather (/setinline).
+"""
+import os
+import logging
+
+from telegram import (
+    Update, InlineQueryResultArticle, InlineQueryResultCachedPhoto, InlineQueryResultPhoto,
+    InputTextMessageContent,
+)
+from telegram.ext import ContextTypes, InlineQueryHandler, Application
+
+from cache import image_file_id_cache
+from handlers import make_draft, ADMIN_IDS
+from metrics import metrics
+from rendering import build_final_message, build_link_message
+from search_index import deal_index, refresh_search_index
+
+logger = logging.getLogger(__name__)
+
+# Telegram accetta al massimo 50 risultati per risposta; gli altri arrivano scorrendo (next_offset)
+INLINE_RESULTS = min(int(os.environ.get("INLINE_RESULTS", "20")), 50)
+# Secondi per cui Telegram può riusare la risposta alla stessa query
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "30"))
+INLINE_REFRESH_INTERVAL = int(os.environ.get("INLINE_REFRESH_INTERVAL", "300"))
+# 1 = chiunque può cercare; altrimenti solo gli ADMIN_IDS
+INLINE_SEARCH_PUBLIC = os.environ.get("INLINE_SEARCH_PUBLIC", "0") == "1"
+
+def _buy_link_draft(deal, title: str) -> dict:
+    """Bozza con il link di acquisto affiliato, costruita come per un link inviato al bot."""
+    return make_draft({
+        'asin': deal.asin,
+        'title': title,
+        'image_url': deal.image_url,
+        'clean_product_link': deal.clean_product_link or f"https://www.amazon.it/dp/{deal.asin}",
+    })
+
+def build_inline_result(deal):
+    """Risultato inline di un prodotto dell'indice."""
+    title = deal.title or deal.asin
+    draft = _buy_link_draft(deal, title)
+    if deal.prezzo_attuale is not None:
+        draft['prezzo_attuale'] = deal.prezzo_attuale
+        draft['prezzo_precedente'] = deal.prezzo_precedente if deal.prezzo_precedente is not None else deal.prezzo_attuale
+        caption, reply_markup = build_final_message(draft)
+        description = f"€ {deal.prezzo_attuale:.2f}"
+    else:
+        caption, reply_markup = build_link_message(title, draft['final_buy_link'])
+        description = "Non ancora pubblicato"
+
+    title = title[:100]
+    file_id = image_file_id_cache.peek(deal.image_url)
+    if file_id:
+        return InlineQueryResultCachedPhoto(
+            id=deal.asin, photo_file_id=file_id, title=title, description=description,
+            caption=caption, parse_mode='MarkdownV2', reply_markup=reply_markup,
+        )
+    if deal.image_url:
+        return InlineQueryResultPhoto(
+            id=deal.asin, photo_url=deal.image_url, thumbnail_url=deal.image_url, title=title,
+            description=description, caption=caption, parse_mode='MarkdownV2', reply_markup=reply_markup,
+        )
+    return InlineQueryResultArticle(
+        id=deal.asin, title=title, description=description,
+        input_message_content=InputTextMessageContent(caption, parse_mode='MarkdownV2'),
+        reply_markup=reply_markup,
+    )
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    inline_query = update.inline_query
+    if not INLINE_SEARCH_PUBLIC and ADMIN_IDS and inline_query.from_user.id not in ADMIN_IDS:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+
+    try:
+        offset = max(int(inline_query.offset or 0), 0)
+    except ValueError:
+        offset = 0
+
+    with metrics.span("inline_search"):
+        deals = deal_index.search(inline_query.query, INLINE_RESULTS, offset)
+        results = [build_inline_result(deal) for deal in deals]
+    metrics.inc("inline_queries_total", outcome="hit" if results else "empty")
+
+    next_offset = str(offset + len(results)) if len(results) == INLINE_RESULTS else ""
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True, next_offset=next_offset)
+
+async def refresh_index_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await refresh_search_index()
+    except Exception as e:
+        logger.error(f"Errore aggiornamento dell'indice di ricerca: {e}")
+
+async def load_search_index(application: Application) -> None:
+    """Primo caricamento (dopo l'init del DB) e aggiornamento periodico delle sole righe nuove."""
+    await refresh_index_job(None)
+    application.job_queue.run_repeating(
+        refresh_index_job,
+        interval=INLINE_REFRESH_INTERVAL,
+        first=INLINE_REFRESH_INTERVAL,
+        name="search_index_refresh",
+        job_kwargs={"max_instances": 1, "coalesce": True},
+    )
+
+inline_handlers = [InlineQueryHandler(inline_query_handler)]
@@ -0,0 +1,264 @@
+"""
+Strumentazione del bot: contatori, durate (span) ed esposizione in formato Prometheus.
+
+    with metrics.span("amazon_fetch"):           # anche `async with`
+        ...
+    metrics.inc("amazon_responses_total", status=200)
+
+Ogni span alimenta l'istogramma <nome>_seconds (e <nome>_errors_total se esce con un'eccezione).
+Le metriche si leggono su http://<host>:METRICS_PORT/metrics oppure nel log con il dump periodico.
+Il logging passa da una coda: i gestori non scrivono mai su stdout dall'event loop.
+"""
+import os
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+import functools
+
+from aiohttp import web
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))                      # 0 = endpoint disattivato
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "0.0.0.0")
+METRICS_DUMP_INTERVAL = int(os.environ.get("METRICS_DUMP_INTERVAL", "0"))    # secondi, 0 = niente dump
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+PREFIX = "legione_"
+# Limiti (in secondi) dei bucket degli istogrammi di durata
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{v}"' for k, v in pairs)
+    return "{" + body + "}"
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+
+class Span:
+    """Misura la durata di un blocco (sync o async) e la registra alla chiusura."""
+
+    def __init__(self, registry, name: str, labels: dict):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        if exc_type is not None:
+            self.registry.inc(f"{self.name}_errors_total", **self.labels)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+class MetricsRegistry:
+    """Registro thread-safe: lo usano anche le funzioni DB eseguite con asyncio.to_thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, _key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def span(self, name: str, **labels) -> Span:
+        return Span(self, name, labels)
+
+    def timed(self, name: str, **labels):
+        """Decoratore: misura ogni esecuzione di una coroutine (es. un handler Telegram)."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapped(*args, **kwargs):
+                async with self.span(name, **labels):
+                    return await func(*args, **kwargs)
+            return wrapped
+        return decorator
+
+    def register_collector(self, collector) -> None:
+        """collector() restituisce tuple (nome, tipo, etichette, valore) lette al momento dell'esposizione."""
+        self._collectors.append(collector)
+
+    def _collected(self) -> list:
+        samples = []
+        for collector in self._collectors:
+            try:
+                samples.extend(collector())
+            except Exception as e:
+                logger.error(f"Errore nel collector di metriche {collector.__name__}: {e}")
+        return samples
+
+    def render(self) -> str:
+        """Formato di esposizione testuale di Prometheus."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.buckets), h.count, h.sum)) for key, h in self._histograms.items())
+
+        lines = []
+        declared = set()
+
+        def _declare(name: str, kind: str):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for (name, key), value in counters:
+            _declare(name, "counter")
+            lines.append(f"{PREFIX}{name}{_format_labels(key)} {value}")
+
+        for (name, key), (buckets, count, total) in histograms:
+            metric = f"{name}_seconds"
+            _declare(metric, "histogram")
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f"{PREFIX}{metric}_bucket{_format_labels(key, (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{PREFIX}{metric}_bucket{_format_labels(key, (('le', '+Inf'),))} {count}")
+            lines.append(f"{PREFIX}{metric}_sum{_format_labels(key)} {total:.6f}")
+            lines.append(f"{PREFIX}{metric}_count{_format_labels(key)} {count}")
+
+        # Le righe di una stessa metrica devono essere contigue
+        for name, kind, labels, value in sorted(self._collected(), key=lambda sample: sample[0]):
+            _declare(name, kind)
+            lines.append(f"{PREFIX}{name}{_format_labels(_key(labels))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> list:
+        """Righe leggibili (una per span) per il dump nel log e per /stato."""
+        with self._lock:
+            items = sorted(self._histograms.items())
+            rows = [(name, key, h.count, h.sum, h.max) for (name, key), h in items]
+        return [
+            f"{name}{_format_labels(key)}: n={count} media={total / count * 1000:.1f}ms max={peak * 1000:.1f}ms"
+            for name, key, count, total, peak in rows if count
+        ]
+
+# Registro condiviso da tutti i moduli
+metrics = MetricsRegistry()
+
+# --- Bot API di Telegram ---
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest che misura ogni chiamata alla Bot API (sendPhoto, sendMessage, ...)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        with metrics.span("telegram_request", method=endpoint):
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        metrics.inc("telegram_responses_total", method=endpoint, status=code)
+        return code, payload
+
+# --- Esposizione ---
+
+_runner = None
+
+async def _metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def dump_metrics(context) -> None:
+    """Job periodico: scrive nel log il riepilogo delle durate."""
+    for line in metrics.summary():
+        logger.info(f"[metriche] {line}")
+
+async def setup_metrics(application) -> None:
+    """Avvia l'endpoint /metrics e/o il dump periodico, se configurati."""
+    global _runner
+    if METRICS_PORT and _runner is None:
+        app = web.Application()
+        app.router.add_get("/metrics", _metrics_endpoint)
+        _runner = web.AppRunner(app, access_log=None)
+        await _runner.setup()
+        await web.TCPSite(_runner, METRICS_LISTEN, METRICS_PORT).start()
+        logger.info(f"Metriche esposte su {METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+    if METRICS_DUMP_INTERVAL and application.job_queue:
+        application.job_queue.run_repeating(
+            dump_metrics,
+            interval=METRICS_DUMP_INTERVAL,
+            first=METRICS_DUMP_INTERVAL,
+            name="metrics_dump",
+            job_kwargs={"max_instances": 1, "coalesce": True},
+        )
+
+async def shutdown_metrics(*_args) -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+
+# --- Logging non bloccante ---
+
+_log_listener = None
+
+def setup_logging(level: str = LOG_LEVEL) -> None:
+    """
+    Sostituisce gli handler del root logger con un QueueHandler: la scrittura vera su stderr
+    la fa un thread dedicato (QueueListener), così l'event loop non resta mai in attesa dell'I/O.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(LOG_FORMAT))
+    _log_listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _log_listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging() -> None:
+    """Svuota la coda dei log (chiamata anche all'uscita del processo)."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
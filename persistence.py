@@ -0,0 +1,177 @@
+"""
+Persistenza dell'Application su Postgres: stato delle conversazioni, user_data (bozze in corso,
+coda bulk) e bot_data sopravvivono a deploy e crash, senza dover rifare lo scraping.
+
+Scrittura differita a due livelli:
+- python-telegram-bot raccoglie i dati modificati e chiama update_* ogni PERSISTENCE_INTERVAL secondi;
+- update_* non toccano il DB: accodano la modifica, e un unico flush scrive tutto il giro
+  in una transazione (database.save_persistence). Allo spegnimento flush() svuota la coda.
+All'avvio tutto lo stato viene letto con una sola query (con ritentativi: Neon può essere ancora
+in risveglio); una scrittura fallita resta in coda e viene ritentata con attesa crescente.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import defaultdict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Serve DATABASE_URL; PERSISTENCE=0 la disattiva (bot.py e il ConversationHandler leggono questo flag)
+PERSISTENCE_ENABLED = os.environ.get("PERSISTENCE", "1") == "1" and bool(os.environ.get("DATABASE_URL"))
+# Ogni quanti secondi l'Application consegna i dati modificati (default di PTB: 60)
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", "5"))
+# Finestra in cui le modifiche dello stesso giro vengono raccolte in un'unica scrittura
+PERSISTENCE_FLUSH_DELAY = float(os.environ.get("PERSISTENCE_FLUSH_DELAY", "0.5"))
+# Tentativi di lettura dello stato all'avvio (attese 1, 2, 4, ... secondi) e attesa massima tra due scritture fallite
+PERSISTENCE_LOAD_ATTEMPTS = int(os.environ.get("PERSISTENCE_LOAD_ATTEMPTS", "5"))
+PERSISTENCE_LOAD_BACKOFF = float(os.environ.get("PERSISTENCE_LOAD_BACKOFF", "1"))
+PERSISTENCE_RETRY_MAX = float(os.environ.get("PERSISTENCE_RETRY_MAX", "60"))
+
+USER_DATA = "user_data"
+CHAT_DATA = "chat_data"
+BOT_DATA = "bot_data"
+CONVERSATION = "conversation:"
+
+class PostgresPersistence(BasePersistence):
+    def __init__(self, update_interval: float = PERSISTENCE_INTERVAL):
+        # callback_data arbitrari non usati dal bot: i pulsanti hanno callback_data stringa
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self._snapshot = None
+        self._load_lock = asyncio.Lock()
+        # (kind, key) -> JSON da scrivere, oppure None per cancellare la riga
+        self._pending = {}
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+        # Durata della lettura iniziale: bot.py la riporta come fase di avvio a sé (persistence_load)
+        self.load_seconds = None
+
+    # --- Lettura (una sola query all'avvio) ---
+
+    async def _load_rows(self) -> list:
+        for attempt in range(1, PERSISTENCE_LOAD_ATTEMPTS + 1):
+            try:
+                return await database.db_call(database.load_persistence)
+            except Exception as e:
+                if attempt == PERSISTENCE_LOAD_ATTEMPTS:
+                    logger.error(f"Stato persistito non leggibile dopo {attempt} tentativi, si parte da zero: {e}")
+                    return []
+                delay = PERSISTENCE_LOAD_BACKOFF * 2 ** (attempt - 1)
+                logger.warning(f"Lettura dello stato non riuscita (tentativo {attempt}), riprovo tra {delay:.0f}s: {e}")
+                await asyncio.sleep(delay)
+
+    async def _load(self) -> dict:
+        async with self._load_lock:
+            if self._snapshot is None:
+                started = time.perf_counter()
+                snapshot = defaultdict(dict)
+                rows = await self._load_rows()
+                self.load_seconds = time.perf_counter() - started
+                for kind, key, data in rows:
+                    snapshot[kind][key] = data
+                self._snapshot = snapshot
+                logger.info(f"Stato ripristinato: {len(rows)} righe ({len(snapshot[USER_DATA])} utenti).")
+            return self._snapshot
+
+    async def get_user_data(self) -> dict:
+        snapshot = await self._load()
+        return {int(key): data for key, data in snapshot[USER_DATA].items()}
+
+    async def get_chat_data(self) -> dict:
+        snapshot = await self._load()
+        return {int(key): data for key, data in snapshot[CHAT_DATA].items()}
+
+    async def get_bot_data(self) -> dict:
+        snapshot = await self._load()
+        return snapshot[BOT_DATA].get("bot", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        snapshot = await self._load()
+        return {tuple(json.loads(key)): state for key, state in snapshot[CONVERSATION + name].items()}
+
+    # --- Scrittura differita ---
+
+    def _stage(self, kind: str, key: str, data) -> None:
+        # Serializziamo subito: è la copia dei dati nel momento della consegna
+        self._pending[(kind, key)] = None if data is None else json.dumps(data, default=str)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        delay = PERSISTENCE_FLUSH_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            if await self._write():
+                return
+            # Le modifiche sono rimaste in coda: si ritenta senza aspettare il prossimo aggiornamento
+            delay = min(max(delay * 2, 1.0), PERSISTENCE_RETRY_MAX)
+
+    async def _write(self) -> bool:
+        """Scrive le modifiche in coda; False se il DB non le ha accettate (restano in coda)."""
+        async with self._write_lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return True
+            upserts = [(kind, key, data) for (kind, key), data in pending.items() if data is not None]
+            deletes = [(kind, key) for (kind, key), data in pending.items() if data is None]
+            try:
+                await database.db_call(database.save_persistence, upserts, deletes)
+            except asyncio.CancelledError:
+                self._pending = {**pending, **self._pending}
+                raise
+            except Exception as e:
+                logger.error(f"Errore salvataggio dello stato ({len(pending)} modifiche), riprovo: {e}")
+                # Le modifiche arrivate nel frattempo sono più recenti: hanno la precedenza
+                self._pending = {**pending, **self._pending}
+                return False
+            return True
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage(USER_DATA, str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._stage(CHAT_DATA, str(chat_id), data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        self._stage(BOT_DATA, "bot", data)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        # new_state None = conversazione terminata: la riga si cancella
+        self._stage(CONVERSATION + name, json.dumps(list(key)), new_state)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._stage(CHAT_DATA, str(chat_id), None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage(USER_DATA, str(user_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Chiamata allo spegnimento: scrive subito tutto ciò che è ancora in coda (un solo tentativo)."""
+        if self._flush_task is not None and not self._flush_task.done():
+            # Il flush differito può essere in attesa di un nuovo tentativo: lo si sostituisce con uno immediato
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self._write()
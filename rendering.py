@@ -0,0 +1,105 @@
+"""
+Rendering dei post: caption MarkdownV2 e tastiere inline.
+
+Quello che non dipende dalla bozza (regex, intestazioni già escapate, link di invito) viene calcolato
+una volta all'import. La parte che dipende dalla bozza è memoizzata per (titolo, link, prezzi):
+anteprima, pubblicazione e invio su più canali della stessa bozza non rifanno escape e URL-encoding.
+Solo l'intestazione casuale viene scelta a ogni chiamata.
+"""
+import os
+import re
+import random
+import urllib.parse
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Bozze diverse di cui tenere in memoria caption e tastiera già pronte
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "1024"))
+
+# Caratteri da escapare in MarkdownV2: _ * [ ] ( ) ~ ` > # + - = | { } . !
+MARKDOWN_V2_SPECIAL_RE = re.compile(r'([_*\[\]()~`>#+\-=|{}.!])')
+
+HEADLINE_PHRASES = [
+    "🔥 SCONTO DA NON PERDERE!", "🚨 PREZZO MINIMO STORICO!", "💰 RISPARMIA ORA!",
+    "✨ GRANDE AFFARE SU AMAZON!", "🎉 OFFERTA ESCLUSIVA!", "💥 LEGIONARI, ALL'ATTACCO!",
+    "🔍 TROVATO UN SUPER AFFARE!", "💸 MAI VISTO UN PREZZO COSÌ!",
+    "🎖️ Vittoria sul Prezzo: MAXI SCONTO!", "⚔️ L'AFFARE CHE STAVATE ASPETTANDO È ARRIVATO!",
+    "⚔️ FINALMENTE IL PREZZO È CROLLATO"
+]
+
+CHANNEL_USERNAME = "@legionedeirisparmiatori"
+INVITE_TEXT = f"Entra nella Legione delle offerte! ⚔️ {CHANNEL_USERNAME}\nhttps://t.me/legionedeirisparmiatori"
+INVITE_URL = f"https://t.me/share/url?url=&text={urllib.parse.quote_plus(INVITE_TEXT)}"
+DISCLAIMER_URL = "https://telegra.ph/LEGIONARI-DEL-RISPARMIO-ATTENTI-ALLA-BATTAGLIA-08-27"
+
+@lru_cache(maxsize=4096)
+def escape_markdown_v2(text: str) -> str:
+    return MARKDOWN_V2_SPECIAL_RE.sub(r'\\\1', text)
+
+# Intestazioni già in grassetto ed escapate: a ogni post resta solo random.choice
+ESCAPED_HEADLINES = [f"*{escape_markdown_v2(phrase)}*" for phrase in HEADLINE_PHRASES]
+
+# Corpo della caption dopo l'intestazione (i valori sono già escapati)
+CAPTION_BODY = (
+    "*{title}*\n\n"
+    "{old_price_line}💰 *Prezzo Attuale:* *{price}*\n\n"
+    "*__{discount}__*\n\n"
+    "[DISCLAIMER](" + DISCLAIMER_URL + ")"
+)
+
+def calculate_discount(current, previous):
+    if previous is None or previous <= current or current <= 0: return 0
+    return round(((previous - current) / previous) * 100)
+
+def format_price(value: float) -> str:
+    """'€ 79\\.99': prezzo già escapato per MarkdownV2."""
+    return f"€ {value:.2f}".replace('.', r'\.')
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _render_body(title: str, buy_link: str, p_att: float, p_pre: float) -> tuple:
+    """Caption (senza intestazione) e tastiera di una bozza; memoizzata, la tastiera è immutabile."""
+    sconto = calculate_discount(p_att, p_pre)
+    sconto_text = f"🔥 RISPARMI IL {sconto}%!" if sconto > 0 else ""
+    old_price_line = f"🏷️ *Prezzo Consigliato:* ~{format_price(p_pre)}~\n" if p_pre > p_att else ""
+
+    body = CAPTION_BODY.format(
+        title=escape_markdown_v2(title),
+        old_price_line=old_price_line,
+        price=format_price(p_att),
+        discount=escape_markdown_v2(sconto_text),
+    )
+
+    share_msg = f"💥 Affare! {title} a € {p_att:.2f}!"
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🛒 ACQUISTA ORA!", url=buy_link)],
+        [InlineKeyboardButton("👥 Invita Amici", url=INVITE_URL),
+         InlineKeyboardButton("📲 WhatsApp", url=f"https://wa.me/?text={urllib.parse.quote_plus(share_msg + ' ' + buy_link)}")]
+    ])
+    return body, keyboard
+
+def build_final_message(draft: dict) -> (str, InlineKeyboardMarkup):
+    """Caption MarkdownV2 e tastiera del post finale di una bozza completa di prezzi."""
+    body, keyboard = _render_body(draft['title'], draft['final_buy_link'], draft['prezzo_attuale'], draft['prezzo_precedente'])
+    return f"{random.choice(ESCAPED_HEADLINES)}\n\n{body}", keyboard
+
+def build_link_message(title: str, buy_link: str) -> (str, InlineKeyboardMarkup):
+    """Prodotto mai pubblicato (solo in cache, senza prezzi): titolo e pulsante di acquisto."""
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🛒 VEDI SU AMAZON", url=buy_link)]])
+    return f"📦 *{escape_markdown_v2(title)}*", keyboard
+
+def render_batch(drafts: list) -> list:
+    """
+    Rende molte bozze in una volta (bulk, coda di pubblicazione): [(caption, tastiera)] nello stesso ordine.
+    Le bozze ripetute (stesso post su più canali) vengono rese una sola volta.
+    """
+    headlines = random.choices(ESCAPED_HEADLINES, k=len(drafts))
+    rendered = []
+    for headline, draft in zip(headlines, drafts):
+        body, keyboard = _render_body(draft['title'], draft['final_buy_link'], draft['prezzo_attuale'], draft['prezzo_precedente'])
+        rendered.append((f"{headline}\n\n{body}", keyboard))
+    return rendered
+
+def render_cache_info() -> dict:
+    info = _render_body.cache_info()
+    return {"size": info.currsize, "hits": info.hits, "misses": info.misses}
@@ -0,0 +1,262 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque, Counter
+from contextlib import contextmanager, asynccontextmanager
+from urllib.parse import urlparse
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione del controllo delle richieste verso Amazon ---
+# Richieste contemporanee massime verso lo stesso host
+AMAZON_MAX_CONCURRENCY = int(os.environ.get("AMAZON_MAX_CONCURRENCY", "4"))
+# Intervallo minimo/massimo tra due richieste allo stesso host (secondi), adattato ai blocchi
+AMAZON_MIN_INTERVAL = float(os.environ.get("AMAZON_MIN_INTERVAL", "0.2"))
+AMAZON_MAX_INTERVAL = float(os.environ.get("AMAZON_MAX_INTERVAL", "30"))
+# Circuit breaker: finestra degli ultimi esiti, soglia di blocchi e pausa
+BREAKER_WINDOW = int(os.environ.get("BREAKER_WINDOW", "20"))
+BREAKER_MIN_SAMPLES = int(os.environ.get("BREAKER_MIN_SAMPLES", "5"))
+BREAKER_BLOCK_RATIO = float(os.environ.get("BREAKER_BLOCK_RATIO", "0.6"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "120"))
+
+# Stati HTTP con cui Amazon segnala che ci sta limitando
+BLOCK_STATUSES = (403, 429, 503)
+
+class CircuitOpenError(Exception):
+    """Amazon ci sta bloccando: le richieste vengono rifiutate subito fino alla fine della pausa."""
+
+    def __init__(self, host: str, retry_in: float):
+        super().__init__(f"circuito aperto per {host}, riprova tra {retry_in:.0f}s")
+        self.host = host
+        self.retry_in = retry_in
+
+class HostState:
+    """Stato di un host: ritmo adattivo (AIMD), circuit breaker e metriche."""
+
+    def __init__(self, host: str, max_concurrency: int):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.interval = AMAZON_MIN_INTERVAL
+        self.next_slot = 0.0
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        self.open_until = 0.0
+        self.half_open_probe = False
+        self.in_flight = 0
+        self.metrics = Counter()
+        self.lock = threading.Lock()
+        self._async_semaphore = None
+        self._async_semaphore_loop = None
+        self.sync_semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def async_semaphore(self) -> asyncio.Semaphore:
+        # Un semaforo asyncio appartiene a un solo event loop
+        loop = asyncio.get_running_loop()
+        if self._async_semaphore is None or self._async_semaphore_loop is not loop:
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._async_semaphore_loop = loop
+        return self._async_semaphore
+
+    def check_circuit(self) -> bool:
+        """
+        Solleva CircuitOpenError se il circuito è aperto; in half-open lascia passare una sola sonda.
+        Restituisce True se questa richiesta è la sonda.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.open_until:
+                self.metrics["rejected"] += 1
+                raise CircuitOpenError(self.host, self.open_until - now)
+            if self.open_until and not self.half_open_probe:
+                # Pausa finita: una richiesta di prova decide se richiudere il circuito
+                self.half_open_probe = True
+                return True
+            if self.open_until and self.half_open_probe:
+                self.metrics["rejected"] += 1
+                raise CircuitOpenError(self.host, 1)
+            return False
+
+    def release_probe(self) -> None:
+        """La sonda è terminata senza esito (es. task cancellato): la prossima richiesta farà da sonda."""
+        with self.lock:
+            self.half_open_probe = False
+
+    def reserve_slot(self) -> float:
+        """Prenota il prossimo istante utile secondo l'intervallo adattivo; restituisce l'attesa."""
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_slot)
+            self.next_slot = start + self.interval * random.uniform(0.8, 1.2)
+            return start - now
+
+    def record(self, status: int = None, blocked: bool = False, error: bool = False) -> None:
+        with self.lock:
+            self.metrics["requests"] += 1
+            if status is not None:
+                self.metrics[f"status_{status}"] += 1
+            if error:
+                self.metrics["errors"] += 1
+
+            blocked = blocked or status in BLOCK_STATUSES
+            if error and not blocked:
+                # Errore di rete/timeout: non dice nulla sui blocchi, resta fuori dalla finestra del breaker.
+                # Se era la sonda half-open però la prova è fallita: il circuito si riapre
+                if self.half_open_probe:
+                    self.half_open_probe = False
+                    logger.warning(f"Sonda verso {self.host} fallita per errore di rete.")
+                    self._open()
+                return
+            if blocked:
+                self.metrics["blocked"] += 1
+                # Aumento moltiplicativo del ritmo quando veniamo bloccati
+                self.interval = min(AMAZON_MAX_INTERVAL, self.interval * 2 + AMAZON_MIN_INTERVAL)
+            else:
+                # Diminuzione graduale quando le richieste vanno a buon fine
+                self.interval = max(AMAZON_MIN_INTERVAL, self.interval * 0.9)
+            self.outcomes.append(blocked)
+            self._update_circuit(blocked)
+
+    def _update_circuit(self, blocked: bool) -> None:
+        if self.half_open_probe:
+            self.half_open_probe = False
+            if blocked:
+                self._open()
+            else:
+                self.open_until = 0.0
+                self.outcomes.clear()
+                logger.info(f"Circuito per {self.host} richiuso.")
+            return
+
+        if len(self.outcomes) >= BREAKER_MIN_SAMPLES:
+            block_ratio = sum(self.outcomes) / len(self.outcomes)
+            if block_ratio >= BREAKER_BLOCK_RATIO:
+                self._open()
+
+    def _open(self) -> None:
+        self.open_until = time.monotonic() + BREAKER_COOLDOWN
+        self.outcomes.clear()
+        self.metrics["circuit_opened"] += 1
+        logger.warning(f"Troppi blocchi da {self.host}: circuito aperto per {BREAKER_COOLDOWN:.0f}s.")
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            now = time.monotonic()
+            return {
+                "host": self.host,
+                "circuit": "open" if now < self.open_until else ("half_open" if self.open_until else "closed"),
+                "interval": round(self.interval, 2),
+                "in_flight": self.in_flight,
+                "block_rate": round(sum(self.outcomes) / len(self.outcomes), 2) if self.outcomes else 0.0,
+                **dict(self.metrics),
+            }
+
+class RequestSlot:
+    """Permesso per una singola richiesta: l'esito va registrato con record()."""
+
+    def __init__(self, state: HostState):
+        self.state = state
+        self.recorded = False
+
+    def record(self, status: int = None, blocked: bool = False) -> None:
+        self.recorded = True
+        self.state.record(status=status, blocked=blocked)
+
+class RequestController:
+    """
+    Punto unico da cui passano tutte le richieste verso Amazon (pagine prodotto e link corti):
+    limite di concorrenza per host, ritmo adattivo sui blocchi e circuit breaker.
+    """
+
+    def __init__(self, max_concurrency: int = AMAZON_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def host_state(self, url: str) -> HostState:
+        host = urlparse(url).hostname or url
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostState(host, self.max_concurrency)
+            return self._hosts[host]
+
+    @asynccontextmanager
+    async def limit(self, url: str):
+        """async with controller.limit(url) as slot: ... slot.record(status)"""
+        state = self.host_state(url)
+        probe, slot = False, None
+        try:
+            async with state.async_semaphore():
+                # Controllo dopo l'attesa del semaforo: chi era in coda fallisce subito se il circuito si è aperto
+                probe = state.check_circuit()
+                wait = state.reserve_slot()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                slot = RequestSlot(state)
+                state.in_flight += 1
+                try:
+                    yield slot
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    if not slot.recorded:
+                        state.record(error=True)
+                    raise
+                finally:
+                    state.in_flight -= 1
+        finally:
+            if probe and (slot is None or not slot.recorded):
+                state.release_probe()
+
+    @contextmanager
+    def limit_sync(self, url: str):
+        """Versione bloccante di limit() per le funzioni basate su requests."""
+        state = self.host_state(url)
+        probe, slot = False, None
+        try:
+            with state.sync_semaphore:
+                probe = state.check_circuit()
+                wait = state.reserve_slot()
+                if wait > 0:
+                    time.sleep(wait)
+                slot = RequestSlot(state)
+                state.in_flight += 1
+                try:
+                    yield slot
+                except Exception:
+                    if not slot.recorded:
+                        state.record(error=True)
+                    raise
+                finally:
+                    state.in_flight -= 1
+        finally:
+            if probe and (slot is None or not slot.recorded):
+                state.release_probe()
+
+    def snapshot(self) -> list:
+        with self._lock:
+            states = list(self._hosts.values())
+        return [state.snapshot() for state in states]
+
+# Istanza condivisa usata da utils.py
+amazon_controller = RequestController()
+
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+def _controller_samples() -> list:
+    """Stato per host del controller (intervallo, circuit breaker, contatori) per metrics.py."""
+    samples = []
+    for state in amazon_controller.snapshot():
+        labels = {"host": state["host"]}
+        samples.append(("amazon_interval_seconds", "gauge", labels, state["interval"]))
+        samples.append(("amazon_in_flight", "gauge", labels, state["in_flight"]))
+        samples.append(("amazon_circuit_state", "gauge", labels, CIRCUIT_STATES[state["circuit"]]))
+        samples.append(("amazon_block_rate", "gauge", labels, state["block_rate"]))
+        for event in ("requests", "blocked", "errors", "rejected", "circuit_opened"):
+            samples.append((f"amazon_{event}_total", "counter", labels, state.get(event, 0)))
+    return samples
+
+metrics.register_collector(_controller_samples)
@@ -1,27 +1,202 @@
 import os
+import time
+import asyncio
 import logging
-from telegram.ext import ContextTypes
+from functools import partial
+from telegram.ext import ContextTypes, Application
+from telegram.error import RetryAfter, BadRequest, Forbidden, TelegramError
+
+import database
+from handlers import publish_draft, post_record, record_posts, fan_out
+from metrics import metrics
+from rendering import render_batch
+
+# --- Configurazione della coda di pubblicazione ---
+# Ogni quanti secondi il dispatcher controlla la coda
+PUBLISH_INTERVAL = float(os.environ.get("PUBLISH_INTERVAL", "5"))
+# Post presi in carico per ciclo
+PUBLISH_BATCH_SIZE = int(os.environ.get("PUBLISH_BATCH_SIZE", "20"))
+PUBLISH_MAX_ATTEMPTS = int(os.environ.get("PUBLISH_MAX_ATTEMPTS", "5"))
+# Limiti di Telegram: ~30 messaggi/s in totale, ~20 messaggi/minuto per lo stesso canale
+PUBLISH_GLOBAL_RATE = float(os.environ.get("PUBLISH_GLOBAL_RATE", "25"))
+PUBLISH_CHAT_RATE_PER_MIN = float(os.environ.get("PUBLISH_CHAT_RATE_PER_MIN", "20"))
+PUBLISH_CHAT_BURST = int(os.environ.get("PUBLISH_CHAT_BURST", "3"))
+
+class TokenBucket:
+    """Token bucket asincrono: `rate` token al secondo, al massimo `capacity` accumulati."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def penalize(self, seconds: float) -> None:
+        """Blocca il bucket per `seconds` (usato quando Telegram risponde con RetryAfter)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class SendRateLimiter:
+    """Limite globale del bot più un bucket separato per ogni chat/canale di destinazione."""
+
+    def __init__(self, global_rate=PUBLISH_GLOBAL_RATE, chat_rate_per_min=PUBLISH_CHAT_RATE_PER_MIN, chat_burst=PUBLISH_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate_per_min / 60
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        if key not in self.chat_buckets:
+            self.chat_buckets[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chat_buckets[key]
+
+    async def acquire(self, chat_id) -> None:
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    def penalize(self, chat_id, seconds: float) -> None:
+        self._chat_bucket(chat_id).penalize(seconds)
+
+rate_limiter = SendRateLimiter()
+# Un solo ciclo di svuotamento alla volta per processo
+_dispatch_lock = asyncio.Lock()
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+# Campi senza i quali una bozza non si può rendere (render_batch) né pubblicare
+DRAFT_REQUIRED_FIELDS = ('title', 'final_buy_link', 'prezzo_attuale', 'prezzo_precedente')
+
+def _is_valid_draft(draft) -> bool:
+    return isinstance(draft, dict) and all(draft.get(field) is not None for field in DRAFT_REQUIRED_FIELDS)
+
+def _group_by_draft(jobs: list) -> list:
+    """Raggruppa le righe della coda che pubblicano la stessa bozza su canali diversi."""
+    groups = {}
+    for job in jobs:
+        draft = job[2]
+        key = (draft.get('asin'), draft.get('title'), draft.get('image_url'), draft.get('prezzo_attuale'))
+        groups.setdefault(key, []).append(job)
+    return list(groups.values())
+
+async def _settle_job(job, result, records: list) -> str:
+    """Aggiorna lo stato della riga in base all'esito dell'invio. Restituisce la riga di report."""
+    queue_id, chat_id, draft, attempts, _ = job
+    title = draft.get('title', '')[:40]
+
+    if not isinstance(result, Exception):
+        await database.db_call(database.mark_post_sent, queue_id)
+        records.append(post_record(draft, result))
+        metrics.inc("publish_jobs_total", outcome="sent")
+        logging.info(f"Post {queue_id} pubblicato sul canale {chat_id}")
+        return f"✅ {title} → {chat_id}"
+
+    if isinstance(result, RetryAfter):
+        # Flood control: fermiamo il canale e riproviamo dopo il tempo indicato
+        delay = _retry_after_seconds(result)
+        rate_limiter.penalize(chat_id, delay)
+        await database.db_call(database.reschedule_post, queue_id, delay, str(result))
+        metrics.inc("publish_jobs_total", outcome="flood_control")
+        logging.warning(f"Flood control su {chat_id}: post {queue_id} rimandato di {delay:.0f}s")
+        return f"⏳ {title} → {chat_id}: rimandato di {delay:.0f}s"
+
+    if isinstance(result, (BadRequest, Forbidden)) or attempts >= PUBLISH_MAX_ATTEMPTS:
+        # Errori non recuperabili (bozza non valida, bot rimosso dal canale) o tentativi esauriti
+        await database.db_call(database.mark_post_failed, queue_id, str(result))
+        metrics.inc("publish_jobs_total", outcome="failed")
+        logging.error(f"Post {queue_id} scartato dopo {attempts} tentativi: {result}")
+        return f"❌ {title} → {chat_id}: {result}"
+
+    await database.db_call(database.reschedule_post, queue_id, attempts * 10, str(result))
+    metrics.inc("publish_jobs_total", outcome="retry")
+    logging.warning(f"Errore temporaneo per il post {queue_id}, nuovo tentativo: {result}")
+    return f"🔁 {title} → {chat_id}: nuovo tentativo ({result})"
+
+async def _report(bot, reports: dict) -> None:
+    """Invia a ogni admin l'esito, canale per canale, dei post che ha approvato."""
+    for admin_id, lines in reports.items():
+        try:
+            await bot.send_message(chat_id=admin_id, text="📣 Esito pubblicazione:\n" + "\n".join(lines))
+        except TelegramError as e:
+            logging.warning(f"Impossibile inviare il report all'admin {admin_id}: {e}")
 
 async def invia_messaggio_programmato(context: ContextTypes.DEFAULT_TYPE):
     """
-    Logica per inviare un messaggio al canale.
-    In futuro, questa funzione recupererà dati dal database o da altre fonti.
+    Svuota la coda di pubblicazione (tabella publish_queue) rispettando i limiti di Telegram.
+    Viene eseguita periodicamente dalla JobQueue e subito dopo ogni approvazione.
+    Ogni bozza viene distribuita in parallelo su tutti i suoi canali caricando la foto una sola volta.
+    Restituisce il numero di post pubblicati in questo ciclo.
     """
-    channel_id = os.getenv("CHANNEL_ID")
-    if not channel_id:
-        logging.warning("CHANNEL_ID non impostato nel file .env")
-        return
-
-    try:
-        # In futuro qui potrai inserire logiche complesse per creare il messaggio
-        testo_messaggio = "Questo è un invio forzato del messaggio che sarebbe stato programmato. ⚙️"
-        
-        await context.bot.send_message(
-            chat_id=channel_id,
-            text=testo_messaggio
-        )
-        logging.info(f"Messaggio inviato con successo al canale {channel_id}")
-        return True
-    except Exception as e:
-        logging.error(f"Errore durante l'invio del messaggio programmato: {e}")
-        return False
\ No newline at end of file
+    if _dispatch_lock.locked():
+        return 0
+
+    async with _dispatch_lock:
+        try:
+            jobs = await database.db_call(database.claim_due_posts, PUBLISH_BATCH_SIZE)
+        except Exception as e:
+            logging.error(f"Errore lettura della coda di pubblicazione: {e}")
+            return 0
+
+        # Payload non valido (es. JSON null da una bozza scaduta): la riga si scarta, il resto del ciclo prosegue
+        records, reports = [], {}
+        invalid = [job for job in jobs if not _is_valid_draft(job[2])]
+        for queue_id, chat_id, _, _, requested_by in invalid:
+            try:
+                await database.db_call(database.mark_post_failed, queue_id, "bozza non valida")
+            except Exception as e:
+                logging.error(f"Errore scarto del post {queue_id}: {e}")
+            metrics.inc("publish_jobs_total", outcome="invalid")
+            logging.error(f"Post {queue_id} scartato: bozza non valida.")
+            if requested_by:
+                reports.setdefault(requested_by, []).append(f"❌ bozza non valida → {chat_id}")
+        jobs = [job for job in jobs if _is_valid_draft(job[2])]
+
+        async def _send(job, photo, rendered):
+            queue_id, chat_id, draft, _, _ = job
+            await rate_limiter.acquire(chat_id)
+            return await publish_draft(context.bot, draft, chat_id=chat_id, photo=photo, rendered=rendered)
+
+        # Caption e tastiera calcolate una volta per bozza, non per ogni canale
+        groups = _group_by_draft(jobs)
+        rendered_groups = render_batch([group[0][2] for group in groups])
+
+        for group, rendered in zip(groups, rendered_groups):
+            for job, result in await fan_out(group, partial(_send, rendered=rendered)):
+                line = await _settle_job(job, result, records)
+                requested_by = job[4]
+                if requested_by:
+                    reports.setdefault(requested_by, []).append(line)
+
+        await record_posts(records)
+        await _report(context.bot, reports)
+        return len(records)
+
+async def setup_publish_queue(application: Application) -> None:
+    """Rimette in coda i post interrotti e avvia il dispatcher periodico."""
+    requeued = await database.db_call(database.requeue_stale_posts)
+    if requeued:
+        logging.info(f"{requeued} post interrotti rimessi in coda.")
+    application.job_queue.run_repeating(
+        invia_messaggio_programmato,
+        interval=PUBLISH_INTERVAL,
+        first=1,
+        name="publish_queue",
+        job_kwargs={"max_instances": 1, "coalesce": True},
+    )
@@ -0,0 +1,129 @@
+"""
+Worker di scraping per SCRAPE_BACKEND=postgres (vedi workers.py).
+
+Preleva i job dalla tabella scrape_jobs con FOR UPDATE SKIP LOCKED, li esegue con lo stesso motore
+del bot (controller delle richieste, cache, parsing nel pool di processi) e ne salva l'esito.
+Se ne possono avviare quanti se ne vuole, anche su altre VM con lo stesso DATABASE_URL:
+
+    SCRAPE_BACKEND=postgres python scrape_worker.py
+
+Un job preso da un worker caduto torna disponibile alla scadenza del lease (SCRAPE_JOB_LEASE).
+"""
+import os
+import json
+import time
+import signal
+import socket
+import asyncio
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import database
+import workers
+from metrics import setup_logging, metrics
+from request_controller import CircuitOpenError
+from startup import init_database
+from utils import get_amazon_product_details_async, close_http_session, SCRAPER_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Questo processo esegue davvero lo scraping: i job non vanno rimessi in coda
+workers.REMOTE_SCRAPING = False
+
+# Job eseguiti contemporaneamente da questo worker
+SCRAPE_WORKER_SLOTS = int(os.environ.get("SCRAPE_WORKER_SLOTS", str(SCRAPER_CONCURRENCY)))
+# Attesa tra un controllo e l'altro quando la coda è vuota
+SCRAPE_WORKER_IDLE = float(os.environ.get("SCRAPE_WORKER_IDLE", "0.5"))
+SCRAPE_JOB_LEASE = int(os.environ.get("SCRAPE_JOB_LEASE", "120"))
+SCRAPE_JOB_MAX_ATTEMPTS = int(os.environ.get("SCRAPE_JOB_MAX_ATTEMPTS", "3"))
+# I job più vecchi di così non li aspetta più nessuno
+SCRAPE_JOB_MAX_AGE = int(os.environ.get("SCRAPE_JOB_MAX_AGE", "3600"))
+PRUNE_EVERY = 600
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+async def run_job(job_id: int, url: str, use_cache: bool) -> tuple:
+    """Esegue un job e restituisce la riga per complete_scrape_jobs: (id, status, result_json, error)."""
+    try:
+        result = await get_amazon_product_details_async(url, use_cache=use_cache)
+    except CircuitOpenError as e:
+        return job_id, "failed", None, workers.encode_circuit_error(e)
+    except Exception as e:
+        logger.error(f"Errore imprevisto nel job {job_id} ({url}): {e}")
+        return job_id, "failed", None, str(e)
+    # result None = prodotto non leggibile: è comunque un esito, il bot lo tratta come uno scraping fallito
+    return job_id, "done", json.dumps(result) if result else None, None
+
+async def run_worker(stop: asyncio.Event) -> None:
+    """Ciclo principale: tiene occupati fino a SCRAPE_WORKER_SLOTS job e salva gli esiti in blocco."""
+    in_flight = set()
+    last_prune = 0.0
+
+    while not stop.is_set() or in_flight:
+        claimed = []
+        free = SCRAPE_WORKER_SLOTS - len(in_flight)
+        if free > 0 and not stop.is_set():
+            try:
+                claimed = await database.db_call(
+                    database.claim_scrape_jobs, free, SCRAPE_JOB_LEASE, WORKER_ID, SCRAPE_JOB_MAX_ATTEMPTS
+                )
+            except Exception as e:
+                logger.error(f"Errore prelievo dei job di scraping: {e}")
+            for job in claimed:
+                in_flight.add(asyncio.create_task(run_job(*job)))
+
+        if in_flight:
+            # Con slot liberi ci si risveglia comunque dopo SCRAPE_WORKER_IDLE per prelevare altri job
+            timeout = SCRAPE_WORKER_IDLE if free > len(claimed) and not stop.is_set() else None
+            finished, in_flight = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            results = [task.result() for task in finished]
+            if results:
+                try:
+                    await database.db_call(database.complete_scrape_jobs, results)
+                except Exception as e:
+                    logger.error(f"Errore salvataggio dell'esito di {len(results)} job: {e}")
+                for _, status, _, _ in results:
+                    metrics.inc("scrape_jobs_total", outcome=status)
+            continue
+
+        if time.monotonic() - last_prune > PRUNE_EVERY:
+            last_prune = time.monotonic()
+            try:
+                pruned = await database.db_call(database.prune_scrape_jobs, SCRAPE_JOB_MAX_AGE)
+                if pruned:
+                    logger.info(f"Eliminati {pruned} job di scraping orfani.")
+            except Exception as e:
+                logger.error(f"Errore pulizia dei job di scraping: {e}")
+        try:
+            await asyncio.wait_for(stop.wait(), SCRAPE_WORKER_IDLE)
+        except asyncio.TimeoutError:
+            pass
+
+async def main_async() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    if not await init_database():
+        logger.error("Il worker di scraping richiede il database: esco.")
+        return
+    await workers.warm_up_pool()
+    logger.info(f"🚀 Worker di scraping {WORKER_ID} avviato ({SCRAPE_WORKER_SLOTS} job contemporanei).")
+    try:
+        await run_worker(stop)
+    finally:
+        await close_http_session()
+        workers.shutdown_workers()
+        database.close_pool()
+        logger.info("Worker di scraping fermato.")
+
+def main():
+    # All'avvio e non all'import: i processi del pool di parsing reimportano questo file (vedi workers.py)
+    setup_logging()
+    asyncio.run(main_async())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+Indice in memoria dei prodotti già visti (cache prodotti) e pubblicati (storico posts),
+usato dalla ricerca inline (`@bot parola` o `@bot ASIN`, vedi inline_search.py).
+
+- indice invertito token -> ASIN sui titoli, normalizzati (minuscole, senza accenti);
+- l'ultimo token della query vale come prefisso ("cuff" trova "cuffie"), gli altri come parole intere;
+- i risultati sono ordinati per ultima pubblicazione, poi per ultimo aggiornamento della cache.
+
+Il caricamento è incrementale: all'avvio si leggono product_cache e posts a blocchi di
+INLINE_LOAD_CHUNK righe, poi ogni INLINE_REFRESH_INTERVAL secondi solo le righe nuove (keyset su
+updated_at/asin e su id). I post pubblicati da questo processo entrano subito con add_posts().
+"""
+import os
+import re
+import time
+import heapq
+import bisect
+import asyncio
+import logging
+import unicodedata
+from collections import defaultdict
+
+import database
+from metrics import metrics
+from utils import extract_asin_from_url
+
+logger = logging.getLogger(__name__)
+
+INLINE_LOAD_CHUNK = int(os.environ.get("INLINE_LOAD_CHUNK", "2000"))
+# Token del vocabolario espansi al massimo per il prefisso dell'ultima parola
+INLINE_PREFIX_EXPANSION = int(os.environ.get("INLINE_PREFIX_EXPANSION", "200"))
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+ASIN_RE = re.compile(r"^[A-Z0-9]{10}$")
+# Parole troppo comuni nei titoli per restringere la ricerca
+STOPWORDS = frozenset({
+    "di", "da", "in", "con", "su", "per", "tra", "fra", "il", "lo", "la", "le", "gli", "un", "uno", "una",
+    "del", "della", "dei", "delle", "al", "alla", "ai", "e", "ed", "o", "the", "and", "for", "with", "of",
+})
+
+EMPTY = frozenset()
+
+def tokenize(text: str) -> list:
+    """'Cuffie Bluetooth, Qualità HD' -> ['cuffie', 'bluetooth', 'qualita', 'hd']."""
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode("ascii")
+    return [token for token in TOKEN_RE.findall(text) if len(token) > 1 and token not in STOPWORDS]
+
+class IndexedDeal:
+    """Un prodotto dell'indice: dati della cache prodotti più l'ultima pubblicazione, se c'è."""
+
+    __slots__ = ("asin", "title", "image_url", "clean_product_link",
+                 "prezzo_precedente", "prezzo_attuale", "published_at", "updated_at")
+
+    def __init__(self, asin: str):
+        self.asin = asin
+        self.title = None
+        self.image_url = None
+        self.clean_product_link = None
+        self.prezzo_precedente = None
+        self.prezzo_attuale = None
+        self.published_at = 0.0
+        self.updated_at = 0.0
+
+    @property
+    def rank(self) -> tuple:
+        return self.published_at, self.updated_at
+
+class DealIndex:
+    """Indice invertito dei titoli; tutte le operazioni girano nell'event loop del bot."""
+
+    def __init__(self):
+        self.deals = {}
+        self._postings = defaultdict(set)
+        self._tokens = {}
+        self._vocabulary = []
+        self._vocabulary_dirty = False
+        # Watermark del caricamento incrementale
+        self.products_since = "1970-01-01T00:00:00+00:00"
+        self.products_after_asin = ""
+        self.posts_after_id = 0
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self.deals)
+
+    def _entry(self, asin: str) -> IndexedDeal:
+        deal = self.deals.get(asin)
+        if deal is None:
+            deal = self.deals[asin] = IndexedDeal(asin)
+        return deal
+
+    def _set_title(self, deal: IndexedDeal, title: str) -> None:
+        if not title or title == deal.title:
+            return
+        deal.title = title
+        tokens = frozenset(tokenize(title))
+        old = self._tokens.get(deal.asin, EMPTY)
+        for token in old - tokens:
+            postings = self._postings[token]
+            postings.discard(deal.asin)
+            if not postings:
+                del self._postings[token]
+                self._vocabulary_dirty = True
+        for token in tokens - old:
+            if token not in self._postings:
+                self._vocabulary_dirty = True
+            self._postings[token].add(deal.asin)
+        self._tokens[deal.asin] = tokens
+
+    def add_product(self, asin: str, title: str, image_url: str = None,
+                    clean_product_link: str = None, updated_at: float = None) -> None:
+        """Prodotto scaricato (cache prodotti): titolo, immagine e link, senza prezzi."""
+        if not asin:
+            return
+        deal = self._entry(asin)
+        self._set_title(deal, title)
+        deal.image_url = image_url or deal.image_url
+        deal.clean_product_link = clean_product_link or deal.clean_product_link
+        deal.updated_at = max(deal.updated_at, updated_at or time.time())
+
+    def add_post(self, asin: str, title: str, prezzo_precedente: float, prezzo_attuale: float,
+                 published_at: float = None, image_url: str = None) -> None:
+        """Post pubblicato: vince il più recente (i prezzi mostrati sono quelli dell'ultima offerta)."""
+        if not asin:
+            return
+        published_at = published_at or time.time()
+        deal = self._entry(asin)
+        if published_at < deal.published_at:
+            return
+        self._set_title(deal, title)
+        deal.prezzo_precedente = prezzo_precedente
+        deal.prezzo_attuale = prezzo_attuale
+        deal.published_at = published_at
+        deal.image_url = image_url or deal.image_url
+
+    def add_posts(self, records: list) -> None:
+        """Righe di handlers.post_record appena pubblicate."""
+        for record in records:
+            self.add_post(record.get('asin'), record.get('title'), record.get('prezzo_precedente'),
+                          record.get('prezzo_attuale'), image_url=record.get('image_url'))
+
+    def _prefix_matches(self, prefix: str) -> set:
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+        matches = set()
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        for token in self._vocabulary[start:start + INLINE_PREFIX_EXPANSION]:
+            if not token.startswith(prefix):
+                break
+            matches |= self._postings[token]
+        return matches
+
+    def _asin_in(self, query: str) -> str or None:
+        """ASIN scritto per intero o contenuto in un link Amazon incollato nella query."""
+        query = query.strip()
+        if ASIN_RE.match(query.upper()):
+            return query.upper()
+        if "amazon." in query:
+            return extract_asin_from_url(query)
+        return None
+
+    def search(self, query: str, limit: int, offset: int = 0) -> list:
+        """Prodotti che contengono tutte le parole della query, i più recenti per primi."""
+        asin = self._asin_in(query)
+        if asin:
+            deal = self.deals.get(asin)
+            # Dieci caratteri alfanumerici possono anche essere una parola: si ripiega sui titoli
+            if deal is not None:
+                return [deal] if offset == 0 else []
+
+        tokens = tokenize(query)
+        if not tokens:
+            candidates = self.deals.values()
+        else:
+            *words, last = tokens
+            sets = [self._postings.get(word, EMPTY) for word in words]
+            sets.append(self._prefix_matches(last))
+            sets.sort(key=len)
+            asins = set(sets[0])
+            for other in sets[1:]:
+                if not asins:
+                    break
+                asins &= other
+            candidates = (self.deals[asin] for asin in asins)
+
+        ranked = heapq.nlargest(offset + limit, candidates, key=lambda deal: deal.rank)
+        return ranked[offset:offset + limit]
+
+    def stats(self) -> dict:
+        return {
+            "products": len(self.deals),
+            "published": sum(1 for deal in self.deals.values() if deal.published_at),
+            "tokens": len(self._postings),
+        }
+
+deal_index = DealIndex()
+
+# --- Caricamento da Postgres ---
+
+async def _load_products(index: DealIndex) -> int:
+    loaded = 0
+    while True:
+        rows = await database.db_call(
+            database.get_indexable_products, index.products_since, index.products_after_asin, INLINE_LOAD_CHUNK
+        )
+        for asin, title, image_url, link, updated_epoch, _ in rows:
+            index.add_product(asin, title, image_url, link, updated_epoch)
+        if rows:
+            index.products_since, index.products_after_asin = rows[-1][5], rows[-1][0]
+            loaded += len(rows)
+        if len(rows) < INLINE_LOAD_CHUNK:
+            return loaded
+        await asyncio.sleep(0)
+
+async def _load_posts(index: DealIndex) -> int:
+    loaded = 0
+    while True:
+        rows = await database.db_call(database.get_indexable_posts, index.posts_after_id, INLINE_LOAD_CHUNK)
+        for _, asin, title, prezzo_precedente, prezzo_attuale, published_epoch in rows:
+            index.add_post(asin, title, prezzo_precedente, prezzo_attuale, published_epoch)
+        if rows:
+            index.posts_after_id = rows[-1][0]
+            loaded += len(rows)
+        if len(rows) < INLINE_LOAD_CHUNK:
+            return loaded
+        await asyncio.sleep(0)
+
+async def refresh_search_index(index: DealIndex = deal_index) -> int:
+    """Legge le righe nuove dall'ultimo watermark (al primo giro: tutto). Restituisce le righe lette."""
+    async with metrics.span("search_index_refresh"):
+        loaded = await _load_products(index) + await _load_posts(index)
+    if not index.loaded:
+        index.loaded = True
+        stats = index.stats()
+        logger.info(
+            f"Indice di ricerca caricato: {stats['products']} prodotti "
+            f"({stats['published']} pubblicati), {stats['tokens']} parole."
+        )
+    return loaded
+
+def _index_samples() -> list:
+    stats = deal_index.stats()
+    return [
+        ("search_index_products", "gauge", {}, stats["products"]),
+        ("search_index_tokens", "gauge", {}, stats["tokens"]),
+    ]
+
+metrics.register_collector(_index_samples)
@@ -0,0 +1,127 @@
+"""
+Pipeline di avvio: il bot comincia a ricevere aggiornamenti subito, il resto arriva in background.
+
+    import moduli -> build Application -> initialize -> post_init -> polling/webhook   (percorso critico)
+                                                           └─ in background: init DB con ritentativi,
+                                                              ripristino coda di pubblicazione, warm-up
+                                                              di cache, sessione HTTP, BeautifulSoup e
+                                                              pool di parsing
+
+Con PERSISTENCE attiva resta un solo accesso al DB sul percorso critico: initialize legge lo stato
+salvato (conversazioni, bozze), che deve esserci prima del primo aggiornamento; è la fase persistence_load.
+
+Ogni fase viene cronometrata (StartupTimer): il riepilogo finisce nel log e nella metrica
+startup_phase_seconds.
+"""
+import os
+import time
+import asyncio
+import logging
+
+import database
+from cache import warm_caches
+from extractors import load_beautifulsoup
+from metrics import metrics
+from request_controller import amazon_controller
+from utils import session_pool, AMAZON_BASE_URL
+from workers import warm_up_pool
+
+logger = logging.getLogger(__name__)
+
+# Tentativi di inizializzazione del DB (Neon può impiegare qualche secondo a risvegliarsi)
+DB_INIT_ATTEMPTS = int(os.environ.get("DB_INIT_ATTEMPTS", "6"))
+DB_INIT_BACKOFF = float(os.environ.get("DB_INIT_BACKOFF", "1"))
+# Apre in anticipo le connessioni TLS verso Amazon (una HEAD sulla home per identità, senza contare nelle statistiche)
+HTTP_PRECONNECT = os.environ.get("HTTP_PRECONNECT", "1") == "1"
+
+class StartupTimer:
+    """Cronometro delle fasi di avvio: ogni mark() chiude la fase corrente."""
+
+    def __init__(self, started: float = None):
+        self.started = started or time.perf_counter()
+        self._last = self.started
+        self.phases = []
+
+    def mark(self, phase: str, **nested) -> None:
+        """nested: sottofasi (nome -> secondi) già misurate dentro questa fase, riportate a parte."""
+        now = time.perf_counter()
+        elapsed = now - self._last
+        for name, seconds in nested.items():
+            self.phases.append((name, seconds))
+            metrics.observe("startup_phase", seconds, phase=name)
+            elapsed -= seconds
+        self.phases.append((phase, elapsed))
+        metrics.observe("startup_phase", elapsed, phase=phase)
+        self._last = now
+
+    def mark_since_start(self, phase: str) -> None:
+        """Fasi in background: durata misurata dall'inizio del processo, non dalla fase precedente."""
+        elapsed = time.perf_counter() - self.started
+        self.phases.append((phase, elapsed))
+        metrics.observe("startup_phase", elapsed, phase=phase)
+
+    def report(self, title: str) -> None:
+        total = time.perf_counter() - self.started
+        details = ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in self.phases)
+        logger.info(f"{title} in {total * 1000:.0f}ms ({details})")
+
+async def init_database() -> bool:
+    """init_db con ritentativi e backoff esponenziale, senza bloccare l'event loop."""
+    if not os.environ.get("DATABASE_URL"):
+        logger.warning("DATABASE_URL non impostata: il bot funziona senza storico, coda e cache persistenti.")
+        return False
+    for attempt in range(1, DB_INIT_ATTEMPTS + 1):
+        if await database.db_call(database.init_db):
+            return True
+        if attempt < DB_INIT_ATTEMPTS:
+            delay = DB_INIT_BACKOFF * 2 ** (attempt - 1)
+            logger.warning(f"Database non pronto (tentativo {attempt}/{DB_INIT_ATTEMPTS}), riprovo tra {delay:.0f}s.")
+            await asyncio.sleep(delay)
+    logger.error("Database non disponibile: il bot funziona, ma senza storico, coda e cache persistenti.")
+    return False
+
+async def _preconnect_identity(identity) -> None:
+    # Fuori da controller e lease: l'esito di questa HEAD (anche un 503) non tocca ritmo, breaker e statistiche
+    async with identity.session.head(AMAZON_BASE_URL, allow_redirects=False) as response:
+        await response.release()
+
+async def _preconnect() -> None:
+    """Una HEAD per identità: connessione TLS aperta e primi cookie di sessione già ricevuti."""
+    if not HTTP_PRECONNECT:
+        return
+    if amazon_controller.host_state(AMAZON_BASE_URL).snapshot()["circuit"] != "closed":
+        logger.info("Preconnessione ad Amazon saltata: circuito non chiuso.")
+        return
+    now = time.monotonic()
+    identities = [identity for identity in session_pool.identities if identity.cooldown_until <= now]
+    results = await asyncio.gather(
+        *(_preconnect_identity(identity) for identity in identities), return_exceptions=True
+    )
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed:
+        logger.warning(f"Preconnessione ad Amazon non riuscita per {len(failed)} identità: {failed[0]}")
+
+async def warm_up(timer: StartupTimer) -> None:
+    """Sessione HTTP, connessione TLS, import di bs4 e pool di parsing: nessuno deve pesare sul primo link."""
+    await asyncio.gather(_preconnect(), asyncio.to_thread(load_beautifulsoup), warm_up_pool(), return_exceptions=True)
+    timer.mark_since_start("warm_up")
+
+async def run_background_startup(application, timer: StartupTimer, on_db_ready) -> None:
+    """
+    Tutto ciò che può attendere: parte dopo post_init, mentre il bot risponde già agli aggiornamenti.
+    on_db_ready(application) viene eseguita solo se il database è pronto.
+    """
+    warm_task = asyncio.create_task(warm_up(timer))
+
+    if await init_database():
+        timer.mark_since_start("db_init")
+        await on_db_ready(application)
+        try:
+            loaded = await warm_caches()
+            timer.mark_since_start("cache_warm")
+            logger.info(f"Cache precaricate con {loaded} voci.")
+        except Exception as e:
+            logger.warning(f"Warm-up delle cache non riuscito: {e}")
+
+    await warm_task
+    timer.report("Avvio completo")
@@ -0,0 +1,27 @@
+import pytest
+
+from extractors import parse_price_text
+
+@pytest.mark.parametrize("text, expected", [
+    ("1.299", 1299.0),
+    ("1.299 €", 1299.0),
+    ("1.299,00", 1299.0),
+    ("1.299,99 €", 1299.99),
+    ("12.345.678", 12345678.0),
+    ("79,99&nbsp;€", 79.99),
+    ("129.99", 129.99),
+    ("129.9", 129.9),
+    ("49", 49.0),
+    ("€", None),
+])
+def test_parse_price_text(text, expected):
+    assert parse_price_text(text) == expected
+
+def test_bulk_lines_thousands_separator():
+    bulk = pytest.importorskip("bulk")
+    entries, errors = bulk.parse_bulk_lines(
+        "https://www.amazon.it/dp/B000000001 1.299 999\n"
+        "https://www.amazon.it/dp/B000000002 1.299,00 1.099,50\n"
+    )
+    assert errors == []
+    assert [(e['prezzo_precedente'], e['prezzo_attuale']) for e in entries] == [(1299.0, 999.0), (1299.0, 1099.5)]
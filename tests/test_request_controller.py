@@ -0,0 +1,38 @@
+import time
+import asyncio
+
+import pytest
+
+from request_controller import RequestController, CircuitOpenError
+
+URL = "https://www.amazon.it/dp/B000000000"
+
+def _half_open(controller: RequestController):
+    state = controller.host_state(URL)
+    state.open_until = time.monotonic() - 1
+    state.next_slot = 0.0
+    return state
+
+def test_probe_timeout_keeps_circuit_open():
+    controller = RequestController()
+    state = _half_open(controller)
+
+    async def probe():
+        async with controller.limit(URL):
+            raise asyncio.TimeoutError()
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(probe())
+
+    assert state.snapshot()["circuit"] == "open"
+    assert not state.half_open_probe
+    with pytest.raises(CircuitOpenError):
+        state.check_circuit()
+
+def test_network_errors_do_not_dilute_block_ratio():
+    controller = RequestController()
+    state = controller.host_state(URL)
+    for _ in range(10):
+        state.record(error=True)
+    assert len(state.outcomes) == 0
+    assert state.metrics["errors"] == 10
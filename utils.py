@@ -1,10 +1,17 @@
 import os
 import re
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import aiohttp
 import logging
 import time
 import random
+from urllib.parse import urljoin
+from cache import product_cache, short_link_cache
+from extractors import extract_product_fields
+from request_controller import amazon_controller
+from metrics import metrics
+from http_sessions import SessionPool, check_decoded_html, pool_samples
+import workers
 
 # Configurazione del logger per utils.py
 logger = logging.getLogger(__name__)
@@ -12,9 +19,12 @@ logger = logging.getLogger(__name__)
 # TAG DI AFFILIAZIONE
 AFFILIATE_TAG = os.environ.get("AMAZON_AFFILIATE_TAG", "") 
 
+# Dominio da cui scaricare le pagine prodotto (sovrascrivibile per i benchmark offline)
+AMAZON_BASE_URL = os.environ.get("AMAZON_BASE_URL", "https://www.amazon.it").rstrip('/')
+
 # --- ROTAZIONE DELLO USER-AGENT ---
 
-# Lista di User-Agent comuni per simulare browser diversi
+# Lista di User-Agent comuni per simulare browser diversi (uno per identità, vedi http_sessions.py)
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
@@ -24,142 +34,405 @@ USER_AGENTS = [
     'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1',
 ]
 
-# Headers di base (SENZA User-Agent, verrà aggiunto casualmente per ogni richiesta)
+# Headers di base (SENZA User-Agent e Accept-Encoding: li fissa ogni identità del pool di sessioni)
 HEADERS = {
     'Accept-Language': 'it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7',
-    'Accept-Encoding': 'gzip, deflate, br',
     'Connection': 'keep-alive',
 }
 # --- FINE ROTAZIONE DELLO USER-AGENT ---
 
-# FUNZIONE get_product_asin (CORRETTA E ROBUSTA)
-def get_product_asin(url: str) -> str or None:
-    """Estrae l'ASIN gestendo i reindirizzamenti per amzn.to, amzn.eu, ecc."""
-    final_url = url
+# --- RITENTATIVI (unico livello: il ritmo tra i tentativi lo decide request_controller.py) ---
+SCRAPER_MAX_ATTEMPTS = int(os.environ.get("SCRAPER_MAX_ATTEMPTS", "4"))
+# Stati per cui ha senso ritentare; 404 significa che il prodotto non esiste
+RETRY_STATUSES = (403, 429, 500, 502, 503)
 
-    # GESTIONE DEI LINK CORTI (ora include amzn.eu e altri)
-    if 'amzn.' in url:
-        try:
-            temp_headers = HEADERS.copy()
-            temp_headers['User-Agent'] = random.choice(USER_AGENTS)
+def is_captcha_page(content: bytes) -> bool:
+    """Amazon risponde 200 con una pagina captcha quando ci considera un robot."""
+    return b'/errors/validateCaptcha' in content
 
-            # allow_redirects=True è fondamentale per seguire il link fino alla pagina prodotto
-            response = requests.get(url, headers=temp_headers, allow_redirects=True, timeout=10)
+# ASIN nel percorso (/dp/, /gp/product/) o, in mancanza, ovunque nell'URL
+ASIN_PATH_RE = re.compile(r"/(?:dp|gp/product)/([A-Z0-9]{10})")
+ASIN_ANYWHERE_RE = re.compile(r"([A-Z0-9]{10})(?:[/?&]|$)")
 
-            if response.status_code == 200:
-                final_url = response.url
-                logger.info(f"URL corto {url} espanso a: {final_url}")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Errore durante l'espansione dell'URL corto {url}: {e}")
-            return None
-
-    # Estrazione ASIN dall'URL finale
-    match = re.search(r"/(?:dp|gp/product)/([A-Z0-9]{10})", final_url)
+def extract_asin_from_url(final_url: str) -> str or None:
+    """Estrae l'ASIN da un URL Amazon già espanso (nessuna richiesta di rete)."""
+    match = ASIN_PATH_RE.search(final_url)
     if match:
         return match.group(1)
 
-    match_asin_only = re.search(r"([A-Z0-9]{10})(?:[/?&]|$)", final_url)
+    match_asin_only = ASIN_ANYWHERE_RE.search(final_url)
     if match_asin_only and not match_asin_only.group(1).startswith("ref"):
         return match_asin_only.group(1)
 
     return None
-# FINE get_product_asin
 
-def get_amazon_product_details(amazon_url: str) -> dict or None:
-    """
-    Estrae Titolo e Immagine del prodotto con logica di ritentativo e rotazione dello User-Agent.
-    """
-    asin = get_product_asin(amazon_url)
-    if not asin:
-        logger.warning(f"Impossibile estrarre l'ASIN dall'URL: {amazon_url}")
-        return None
+def product_page_url(asin: str) -> str:
+    """URL da cui scaricare la pagina prodotto (il link pubblicato resta sempre amazon.it)."""
+    return f"{AMAZON_BASE_URL}/dp/{asin}"
 
+def build_product_data(asin: str, amazon_url: str) -> dict:
+    """Prepara il dizionario prodotto con i link (pulito e originale) ancora senza titolo/immagine."""
     # L'URL di base (pulito) ci serve per l'affiliate link
-    clean_url = f"https://www.amazon.it/dp/{asin}" 
-
-    # Manteniamo il link originale inviato, ci serve per la logica dei bottoni
-    original_url = amazon_url
-
+    clean_url = f"https://www.amazon.it/dp/{asin}"
     affiliate_suffix = f"?tag={AFFILIATE_TAG}" if AFFILIATE_TAG else ""
 
-    product_data = {
+    return {
         "title": None,
         "image_url": "",
+        "price": None,
         "asin": asin,
         "clean_product_link": f"{clean_url}{affiliate_suffix}",
-        "original_link": original_url, # Nuovo campo per tracciare il link originale
+        "original_link": amazon_url, # Nuovo campo per tracciare il link originale
     }
 
-    response = None
+def parse_product_html(content, product_data: dict) -> dict or None:
+    """
+    Completa product_data con Titolo e Immagine letti dall'HTML della pagina prodotto.
+    Restituisce None se il titolo non è presente (pagina di blocco/captcha).
+    Può girare in un processo figlio (workers.run_cpu): la durata html_parse la misura il chiamante.
+    """
+    asin = product_data.get("asin")
+    try:
+        # Estrattore veloce con fallback automatico su BeautifulSoup (vedi extractors.py)
+        fields = extract_product_fields(content)
+        if not fields:
+            logger.warning("Errore: Titolo non trovato.")
+            return None # Falliamo se non troviamo il titolo
 
-    # --- LOGICA DI TENTATIVO (RETRY LOGIC) ---
-    for attempt in range(1, 10): # Tenta 9 volte
-        try:
-            # ⭐️ Aggiungiamo un User-Agent casuale per questa richiesta di scraping
-            current_headers = HEADERS.copy()
-            current_headers['User-Agent'] = random.choice(USER_AGENTS)
+        product_data["title"] = fields["title"]
+        product_data["image_url"] = fields["image_url"]
+        product_data["price"] = fields.get("price")
+        return product_data
+
+    except Exception as e:
+        logger.error(f"Errore generico nell'analisi HTML del prodotto {asin}: {e}")
+        return None
+
+# --- RISOLUZIONE LINK CORTI (solo redirect, nessun download della pagina) ---
 
-            # Eseguiamo la richiesta
-            response = requests.get(clean_url, headers=current_headers, timeout=15)
+# Numero massimo di redirect seguiti per un link corto
+SHORT_LINK_MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
 
-            logger.info(f"Stato della Risposta HTTP per {asin} (Tentativo {attempt}): {response.status_code}")
+def is_short_link(url: str) -> bool:
+    return 'amzn.' in url
 
-            # Se la risposta è 200, è andata a buon fine. Esci dal ciclo.
-            if response.status_code == 200:
+def resolve_short_link(url: str) -> str or None:
+    """
+    Risolve un link corto (amzn.to, amzn.eu, ...) fino all'ASIN seguendo a mano i redirect
+    con richieste HEAD: ci fermiamo appena l'URL di destinazione contiene l'ASIN,
+    senza mai scaricare la pagina prodotto.
+    """
+    # requests serve solo alle versioni sincrone (script e test manuali): import ritardato
+    import requests
+
+    cached = short_link_cache.get(url)
+    if cached:
+        return cached
+
+    current = url
+
+    try:
+        for _ in range(SHORT_LINK_MAX_REDIRECTS):
+            with amazon_controller.limit_sync(current) as slot, session_pool.use() as lease:
+                response = lease.sync_session.head(current, allow_redirects=False, timeout=10)
+                if response.status_code == 405:
+                    # Alcuni server non accettano HEAD: GET in streaming, il corpo non viene letto
+                    response = lease.sync_session.get(current, allow_redirects=False, timeout=10, stream=True)
+                    response.close()
+                slot.record(response.status_code)
+                lease.record(response.status_code)
+
+            location = response.headers.get('Location')
+            if response.status_code not in REDIRECT_STATUSES or not location:
                 break
 
-            # Se la risposta è un errore comune di blocco o server (500, 503, 403, 404), ritenta
-            elif response.status_code in [500, 503, 403, 404]:
-                logger.warning(f"Errore {response.status_code}. Riprovo tra {attempt * 2} secondi...")
-                time.sleep(attempt * 2 + random.uniform(0.5, 1.5)) # Ritardo progressivo con jitter
+            current = urljoin(current, location)
+            asin = extract_asin_from_url(current)
+            if asin:
+                logger.info(f"URL corto {url} espanso a: {current}")
+                short_link_cache.put(url, asin)
+                return asin
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Errore durante l'espansione dell'URL corto {url}: {e}")
+        return None
+
+    logger.warning(f"Nessun ASIN trovato seguendo i redirect di {url} (ultimo URL: {current})")
+    return None
+
+# FUNZIONE get_product_asin (CORRETTA E ROBUSTA)
+def get_product_asin(url: str) -> str or None:
+    """Estrae l'ASIN gestendo i reindirizzamenti per amzn.to, amzn.eu, ecc."""
+    # GESTIONE DEI LINK CORTI (ora include amzn.eu e altri)
+    if is_short_link(url):
+        with metrics.span("asin_resolution"):
+            return resolve_short_link(url)
+
+    return extract_asin_from_url(url)
+# FINE get_product_asin
 
-            # Per qualsiasi altro errore che non gestiamo (es. 400), solleva subito l'errore
-            else:
-                response.raise_for_status() 
+def record_response(attempt: int, status: int, captcha: bool) -> None:
+    """Contatori di esito per ogni risposta Amazon (stato HTTP, captcha, ritentativi)."""
+    metrics.inc("amazon_responses_total", status="captcha" if captcha else status)
+    if attempt > 1:
+        metrics.inc("scraper_retries_total")
+
+def get_amazon_product_details(amazon_url: str) -> dict or None:
+    """
+    Estrae Titolo e Immagine del prodotto con logica di ritentativo e rotazione dello User-Agent.
+    Solleva CircuitOpenError se Amazon ci sta bloccando (vedi request_controller.py).
+    """
+    import requests
+
+    asin = get_product_asin(amazon_url)
+    if not asin:
+        logger.warning(f"Impossibile estrarre l'ASIN dall'URL: {amazon_url}")
+        return None
+
+    # --- CACHE PER ASIN ---
+    cached = product_cache.get(asin)
+    if cached:
+        logger.info(f"Dettagli di {asin} serviti dalla cache.")
+        return {**cached, "original_link": amazon_url}
+    if product_cache.is_failed(asin):
+        logger.warning(f"ASIN {asin} fallito di recente, salto lo scraping.")
+        return None
+
+    clean_url = product_page_url(asin)
+    product_data = build_product_data(asin, amazon_url)
+
+    content = None
+    status = None
+
+    # --- LOGICA DI TENTATIVO (RETRY LOGIC) ---
+    # CircuitOpenError non viene intercettata: se Amazon ci sta bloccando falliamo subito
+    for attempt in range(1, SCRAPER_MAX_ATTEMPTS + 1):
+        try:
+            # Identità del pool: User-Agent, cookie e connessione keep-alive restano gli stessi tra le richieste
+            with amazon_controller.limit_sync(clean_url) as slot, session_pool.use() as lease:
+                with metrics.span("amazon_fetch"):
+                    response = lease.sync_session.get(clean_url, timeout=15)
+                status = response.status_code
+                captcha = status == 200 and is_captcha_page(response.content)
+                slot.record(status, blocked=captcha)
+                lease.record(status, blocked=captcha)
+            record_response(attempt, status, captcha)
+
+            logger.info(f"Stato della Risposta HTTP per {asin} (Tentativo {attempt}): {status}{' (captcha)' if captcha else ''}")
+
+            if status == 200 and not captcha:
+                if check_decoded_html(response.content, response.headers.get('Content-Encoding')):
+                    content = response.content
+                break
+            if status in RETRY_STATUSES or captcha:
+                # Il controller ha già rallentato il ritmo verso Amazon: riproviamo
+                continue
+            logger.error(f"Stato HTTP {status} non gestito per {asin}, interrompo.")
+            break
 
         except requests.exceptions.RequestException as e:
+            metrics.inc("amazon_responses_total", status="network_error")
             logger.error(f"Errore di richiesta al Tentativo {attempt}: {e}")
-            if attempt < 3:
-                time.sleep(attempt * 2 + random.uniform(0.5, 1.5))
-                continue # Continua al prossimo tentativo
-            else:
-                logger.error(f"Scraping fallito dopo {attempt} tentativi.")
-                return None
+            time.sleep(attempt + random.uniform(0.5, 1.5))
 
     # --- FINE LOGICA DI TENTATIVO ---
 
-    # Se dopo i tentativi non abbiamo una risposta 200 (o response è None), fallisci
-    if response is None or response.status_code != 200:
-        logger.error(f"Scraping fallito con stato finale: {response.status_code if response else 'N/A'}")
+    if content is None:
+        logger.error(f"Scraping fallito con stato finale: {status if status else 'N/A'}")
+        metrics.inc("scraper_results_total", result="failed")
+        product_cache.mark_failed(asin)
         return None
 
     # Ora che abbiamo una risposta 200, procediamo con lo scraping
+    with metrics.span("html_parse"):
+        result = parse_product_html(content, product_data)
+    if result:
+        product_cache.put(result)
+    else:
+        product_cache.mark_failed(asin)
+    metrics.inc("scraper_results_total", result="ok" if result else "parse_failed")
+    return result
+
+# --- MOTORE DI SCRAPING ASINCRONO (aiohttp) ---
+
+# Parametri configurabili del motore asincrono
+SCRAPER_CONCURRENCY = int(os.environ.get("SCRAPER_CONCURRENCY", "5"))
+SCRAPER_TIMEOUT = float(os.environ.get("SCRAPER_TIMEOUT", "15"))
+
+# Identità persistenti (User-Agent + cookie + connessioni keep-alive) condivise da tutto il processo
+session_pool = SessionPool(HEADERS, USER_AGENTS, timeout=SCRAPER_TIMEOUT)
+metrics.register_collector(lambda: pool_samples(session_pool))
+
+async def close_http_session(*_args) -> None:
+    """Chiude le sessioni di tutte le identità (usata come post_shutdown dell'Application)."""
+    await session_pool.close()
+
+async def _backoff(attempt: int) -> None:
+    """Ritardo progressivo con jitter dopo un errore di rete, senza bloccare l'event loop (cancellabile)."""
+    await asyncio.sleep(attempt + random.uniform(0.5, 1.5))
+
+async def resolve_short_link_async(url: str) -> str or None:
+    """Versione asincrona di resolve_short_link (HEAD sui redirect, cache memoria + Postgres)."""
+    cached = await short_link_cache.get_async(url)
+    if cached:
+        return cached
+
+    current = url
+    timeout = aiohttp.ClientTimeout(total=10)
+
     try:
-        soup = BeautifulSoup(response.content, 'html.parser')
+        for _ in range(SHORT_LINK_MAX_REDIRECTS):
+            async with amazon_controller.limit(current) as slot:
+                with session_pool.use() as lease:
+                    async with lease.session.head(current, allow_redirects=False, timeout=timeout) as response:
+                        status = response.status
+                        location = response.headers.get('Location')
+                    if status == 405:
+                        # Uscendo dal context manager senza read() il corpo non viene scaricato
+                        async with lease.session.get(current, allow_redirects=False, timeout=timeout) as response:
+                            status = response.status
+                            location = response.headers.get('Location')
+                    lease.record(status)
+                slot.record(status)
+
+            if status not in REDIRECT_STATUSES or not location:
+                break
+
+            current = urljoin(current, location)
+            asin = extract_asin_from_url(current)
+            if asin:
+                logger.info(f"URL corto {url} espanso a: {current}")
+                await short_link_cache.put_async(url, asin)
+                return asin
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Errore durante l'espansione dell'URL corto {url}: {e}")
+        return None
+
+    logger.warning(f"Nessun ASIN trovato seguendo i redirect di {url} (ultimo URL: {current})")
+    return None
+
+async def resolve_short_links_async(urls: list, concurrency: int = None) -> dict:
+    """Risolve in parallelo un gruppo di link corti. Restituisce {url: asin o None}."""
+    semaphore = asyncio.Semaphore(concurrency or SCRAPER_CONCURRENCY)
+    unique_urls = list(dict.fromkeys(urls))
+
+    async def _worker(url):
+        async with semaphore:
+            return await resolve_short_link_async(url)
 
-        # --- 1. Estrazione Titolo ---
-        title_element = soup.find('span', {'id': 'productTitle'})
-        if title_element:
-            product_data["title"] = title_element.get_text(strip=True)
+    results = await asyncio.gather(*(_worker(url) for url in unique_urls))
+    return dict(zip(unique_urls, results))
+
+async def get_product_asin_async(url: str) -> str or None:
+    """Versione asincrona di get_product_asin: espande i link corti senza bloccare il bot."""
+    if is_short_link(url):
+        async with metrics.span("asin_resolution"):
+            return await resolve_short_link_async(url)
+
+    return extract_asin_from_url(url)
+
+async def get_amazon_product_details_async(amazon_url: str, use_cache: bool = True) -> dict or None:
+    """
+    Versione asincrona di get_amazon_product_details.
+    Stessa logica di ritentativo, ma con asyncio.sleep e parsing HTML fuori dall'event loop.
+    use_cache=False forza il download della pagina (serve per leggere il prezzo aggiornato).
+    Solleva CircuitOpenError se Amazon ci sta bloccando (vedi request_controller.py).
+    """
+    asin = await get_product_asin_async(amazon_url)
+    if not asin:
+        logger.warning(f"Impossibile estrarre l'ASIN dall'URL: {amazon_url}")
+        return None
+
+    # --- CACHE PER ASIN (memoria, poi Postgres) ---
+    cached = await product_cache.get_async(asin) if use_cache else None
+    if cached:
+        logger.info(f"Dettagli di {asin} serviti dalla cache.")
+        return {**cached, "original_link": amazon_url}
+    if product_cache.is_failed(asin):
+        logger.warning(f"ASIN {asin} fallito di recente, salto lo scraping.")
+        return None
+
+    if workers.REMOTE_SCRAPING:
+        # SCRAPE_BACKEND=postgres: scarica e analizza un worker (scrape_worker.py), qui si attende l'esito.
+        # Si passa l'URL canonico: il link corto è già stato risolto
+        result = await workers.scrape_client.submit(product_page_url(asin), use_cache)
+        if result:
+            result["original_link"] = amazon_url
+            await product_cache.put_async(result)
         else:
-            logger.warning("Errore: Titolo non trovato.")
-            return None # Falliamo se non troviamo il titolo
+            product_cache.mark_failed(asin)
+        return result
 
-        # --- 2. Estrazione Foto (Miniatura principale) ---
-        image_element = soup.find('img', {'id': 'landingImage'}) or soup.find('img', {'id': 'imgBliss'})
+    clean_url = product_page_url(asin)
+    product_data = build_product_data(asin, amazon_url)
 
-        if image_element:
-            image_url_data = image_element.get('data-a-dynamic-image')
+    content = None
+    status = None
 
-            if image_url_data:
-                match = re.search(r'\"(https?://[^\"]+)\"', image_url_data)
-                if match:
-                    product_data["image_url"] = match.group(1)
-            else:
-                product_data["image_url"] = image_element.get('src')
+    for attempt in range(1, SCRAPER_MAX_ATTEMPTS + 1):
+        try:
+            async with amazon_controller.limit(clean_url) as slot:
+                # Identità del pool: User-Agent, cookie e connessione keep-alive restano gli stessi tra le richieste
+                with session_pool.use() as lease:
+                    async with metrics.span("amazon_fetch"):
+                        async with lease.session.get(clean_url) as response:
+                            status = response.status
+                            encoding = response.headers.get('Content-Encoding')
+                            body = await response.read() if status == 200 else None
+                    captcha = body is not None and is_captcha_page(body)
+                    lease.record(status, blocked=captcha)
+                slot.record(status, blocked=captcha)
+            record_response(attempt, status, captcha)
+
+            logger.info(f"Stato della Risposta HTTP per {asin} (Tentativo {attempt}): {status}{' (captcha)' if captcha else ''}")
+
+            if status == 200 and not captcha:
+                if check_decoded_html(body, encoding):
+                    content = body
+                break
+            if status in RETRY_STATUSES or captcha:
+                # Il controller ha già rallentato il ritmo verso Amazon: riproviamo
+                continue
+            logger.error(f"Stato HTTP {status} non gestito per {asin}, interrompo.")
+            break
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.inc("amazon_responses_total", status="network_error")
+            logger.error(f"Errore di richiesta al Tentativo {attempt}: {e}")
+            await _backoff(attempt)
 
-        return product_data
+    if content is None:
+        logger.error(f"Scraping fallito con stato finale: {status if status else 'N/A'}")
+        metrics.inc("scraper_results_total", result="failed")
+        product_cache.mark_failed(asin)
+        return None
 
-    except Exception as e:
-        logger.error(f"Errore generico nell'analisi HTML del prodotto {asin}: {e}")
-        return None
\ No newline at end of file
+    # Il parsing è CPU-bound: lo spostiamo fuori dall'event loop (pool di processi, vedi workers.py).
+    # Cronometrato qui: le metriche registrate nel processo figlio non arriverebbero a questo registro
+    async with metrics.span("html_parse"):
+        result = await workers.run_cpu(parse_product_html, content, product_data)
+    if result:
+        await product_cache.put_async(result)
+    else:
+        product_cache.mark_failed(asin)
+    metrics.inc("scraper_results_total", result="ok" if result else "parse_failed")
+    return result
+
+async def get_many_product_details_async(urls: list, concurrency: int = None) -> list:
+    """
+    Scarica i dettagli di più link in parallelo con un limite di concorrenza.
+    Restituisce una lista nello stesso ordine degli URL (None per i link falliti).
+    """
+    semaphore = asyncio.Semaphore(concurrency or SCRAPER_CONCURRENCY)
+
+    async def _worker(url):
+        async with semaphore:
+            try:
+                return await get_amazon_product_details_async(url)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Errore imprevisto durante lo scraping di {url}: {e}")
+                return None
+
+    return await asyncio.gather(*(_worker(url) for url in urls))
@@ -0,0 +1,197 @@
+import os
+import re
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import ContextTypes, CommandHandler, Application
+
+import database
+from handlers import admin_only, make_draft, parse_price, ADMIN_IDS
+from bulk import offer_drafts
+from utils import get_amazon_product_details_async, get_product_asin_async
+from request_controller import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione del watcher prezzi ---
+# Ogni quanti secondi si prende un nuovo lotto di ASIN scaduti
+WATCH_TICK = float(os.environ.get("WATCH_TICK", "60"))
+# ASIN per lotto: con i valori di default fino a 6000 controlli l'ora, memoria limitata al lotto
+WATCH_BATCH_SIZE = int(os.environ.get("WATCH_BATCH_SIZE", "100"))
+WATCH_CONCURRENCY = int(os.environ.get("WATCH_CONCURRENCY", "8"))
+# Intervallo di ricontrollo normale e per gli ASIN "caldi" (prezzo in movimento o vicino alla soglia)
+WATCH_INTERVAL = int(os.environ.get("WATCH_INTERVAL", "10800"))
+WATCH_HOT_INTERVAL = int(os.environ.get("WATCH_HOT_INTERVAL", "1200"))
+# Se il processo cade, gli ASIN presi in carico tornano disponibili dopo questo tempo
+WATCH_LEASE = int(os.environ.get("WATCH_LEASE", "900"))
+# Senza soglia esplicita si segnala un calo di almeno questa percentuale dal massimo visto
+WATCH_DROP_PCT = float(os.environ.get("WATCH_DROP_PCT", "15"))
+# Un ASIN entro questa percentuale sopra la soglia è "caldo"
+WATCH_HOT_MARGIN_PCT = float(os.environ.get("WATCH_HOT_MARGIN_PCT", "10"))
+
+ASIN_RE = re.compile(r'^[A-Z0-9]{10}$')
+
+_watch_lock = asyncio.Lock()
+
+def evaluate_price(item: dict, price: float) -> tuple:
+    """
+    Decide se l'ASIN è caldo e se il nuovo prezzo merita una bozza.
+    Restituisce (hot, alert): si segnala solo un prezzo più basso dell'ultimo già segnalato.
+    """
+    threshold = item["threshold"]
+    last_price = item["last_price"]
+    reference = max(filter(None, (item["max_price"], last_price)), default=None)
+
+    changed = last_price is not None and abs(price - last_price) >= 0.01
+    near_threshold = threshold is not None and price <= threshold * (1 + WATCH_HOT_MARGIN_PCT / 100)
+    hot = changed or near_threshold
+
+    if threshold is not None:
+        below = price <= threshold
+    else:
+        below = reference is not None and price <= reference * (1 - WATCH_DROP_PCT / 100)
+    already_alerted = item["last_alert_price"] is not None and price >= item["last_alert_price"]
+    return hot, below and not already_alerted
+
+async def _check_item(item: dict, semaphore: asyncio.Semaphore) -> dict:
+    async with semaphore:
+        product = await get_amazon_product_details_async(f"https://www.amazon.it/dp/{item['asin']}", use_cache=False)
+    return product
+
+async def check_watchlist(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Un giro incrementale del watcher: prende il prossimo lotto di ASIN scaduti (i caldi prima),
+    li riscarica in parallelo, salva prezzi e prossime scadenze in blocco e propone le bozze.
+    Restituisce il numero di ASIN controllati.
+    """
+    if _watch_lock.locked():
+        return 0
+
+    async with _watch_lock:
+        try:
+            items = await database.db_call(database.claim_due_watch_items, WATCH_BATCH_SIZE, WATCH_LEASE)
+        except Exception as e:
+            logger.error(f"Errore lettura watchlist: {e}")
+            return 0
+        if not items:
+            return 0
+
+        semaphore = asyncio.Semaphore(WATCH_CONCURRENCY)
+        products = await asyncio.gather(*(_check_item(item, semaphore) for item in items), return_exceptions=True)
+
+        results, offers = [], {}
+        for item, product in zip(items, products):
+            if isinstance(product, CircuitOpenError):
+                # Amazon ci blocca: riproviamo alla riapertura del circuito, senza contare un fallimento
+                results.append({"asin": item["asin"], "price": None, "hot": item["hot"], "next_check_in": product.retry_in + 60})
+                continue
+            if isinstance(product, Exception) or not product or product.get("price") is None:
+                if isinstance(product, Exception):
+                    logger.error(f"Errore controllo prezzo di {item['asin']}: {product}")
+                results.append({"asin": item["asin"], "price": None, "hot": item["hot"], "next_check_in": WATCH_INTERVAL})
+                continue
+
+            price = product["price"]
+            hot, alert = evaluate_price(item, price)
+            result = {"asin": item["asin"], "price": price, "hot": hot,
+                      "next_check_in": WATCH_HOT_INTERVAL if hot else WATCH_INTERVAL}
+
+            if alert:
+                result["alert_price"] = price
+                draft = make_draft(product)
+                reference = max(filter(None, (item["max_price"], item["last_price"])), default=price)
+                draft['prezzo_precedente'] = max(reference, price)
+                draft['prezzo_attuale'] = price
+                recipients = [item["added_by"]] if item["added_by"] else ADMIN_IDS
+                for admin_id in recipients:
+                    offers.setdefault(admin_id, []).append(draft)
+            results.append(result)
+
+        try:
+            await database.db_call(database.save_watch_results, results)
+        except Exception as e:
+            logger.error(f"Errore salvataggio risultati watchlist: {e}")
+
+        for admin_id, drafts in offers.items():
+            try:
+                await offer_drafts(context.application, admin_id, drafts, f"📉 {len(drafts)} prezzi in calo dalla watchlist!")
+            except Exception as e:
+                logger.error(f"Impossibile proporre le bozze all'admin {admin_id}: {e}")
+
+        logger.info(f"Watchlist: {len(items)} ASIN controllati, {sum(len(d) for d in offers.values())} bozze proposte.")
+        return len(items)
+
+async def _asin_from_arg(arg: str) -> str or None:
+    arg = arg.strip()
+    if ASIN_RE.match(arg):
+        return arg
+    try:
+        return await get_product_asin_async(arg)
+    except CircuitOpenError:
+        return None
+
+@admin_only
+async def segui(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/segui <link o ASIN> [soglia]: aggiunge un prodotto alla watchlist."""
+    if not context.args:
+        await update.message.reply_text("Uso: /segui <link o ASIN> [prezzo soglia]")
+        return
+
+    asin = await _asin_from_arg(context.args[0])
+    if not asin:
+        await update.message.reply_text("⚠️ ASIN non riconosciuto.")
+        return
+
+    threshold = None
+    if len(context.args) > 1:
+        try:
+            threshold = parse_price(context.args[1])
+        except ValueError:
+            await update.message.reply_text("❌ Soglia non valida (es: 49.90).")
+            return
+
+    added = await database.db_call(database.add_to_watchlist, asin, threshold, update.effective_user.id)
+    if not added:
+        await update.message.reply_text("❌ Database non disponibile.")
+        return
+    soglia = f" sotto € {threshold:.2f}" if threshold is not None else f" con calo di almeno il {WATCH_DROP_PCT:.0f}%"
+    await update.message.reply_text(f"👀 Seguo {asin}: ti proporrò una bozza{soglia}.")
+
+@admin_only
+async def smetti(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/smetti <link o ASIN>: rimuove un prodotto dalla watchlist."""
+    asin = await _asin_from_arg(context.args[0]) if context.args else None
+    if not asin:
+        await update.message.reply_text("Uso: /smetti <link o ASIN>")
+        return
+    removed = await database.db_call(database.remove_from_watchlist, asin)
+    await update.message.reply_text(f"✅ {asin} rimosso." if removed else f"ℹ️ {asin} non era nella watchlist.")
+
+@admin_only
+async def seguiti(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    total, rows = await database.db_call(database.get_watchlist_summary, 20)
+    if not total:
+        await update.message.reply_text("La watchlist è vuota. Usa /segui <link> [soglia].")
+        return
+    lines = [f"👀 {total} prodotti seguiti (primi {len(rows)}):"]
+    for asin, threshold, last_price, hot in rows:
+        soglia = f"soglia € {threshold:.2f}" if threshold is not None else "soglia automatica"
+        ultimo = f"ultimo € {last_price:.2f}" if last_price is not None else "mai controllato"
+        lines.append(f"{'🔥' if hot else '•'} {asin}: {soglia}, {ultimo}")
+    await update.message.reply_text("\n".join(lines))
+
+def setup_price_watcher(application: Application) -> None:
+    """Avvia il controllo periodico della watchlist."""
+    application.job_queue.run_repeating(
+        check_watchlist,
+        interval=WATCH_TICK,
+        first=30,
+        name="price_watcher",
+        job_kwargs={"max_instances": 1, "coalesce": True},
+    )
+
+watch_handlers = [
+    CommandHandler("segui", segui),
+    CommandHandler("smetti", smetti),
+    CommandHandler("seguiti", seguiti),
+]
@@ -0,0 +1,179 @@
+"""
+Scraping fuori dall'event loop del bot, su più core e, se serve, su più macchine.
+
+SCRAPE_BACKEND:
+    thread    il parsing HTML gira in un thread (condivide il GIL con l'event loop)
+    process   il parsing HTML gira in un pool di processi locali (default): scala con i core
+    postgres  lo scraping intero diventa un job nella tabella scrape_jobs. Lo eseguono uno o più
+              `python scrape_worker.py` (anche su altre VM con lo stesso DATABASE_URL), che prelevano
+              i job con FOR UPDATE SKIP LOCKED. Il bot attende il risultato senza bloccare la
+              conversazione: un solo poller ritira in blocco i job conclusi e sveglia chi li aspetta.
+
+Con postgres le cache restano valide: il bot risponde dalla propria cache senza creare job,
+il worker popola product_cache su Postgres come farebbe il bot.
+"""
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import database
+from metrics import metrics, LOG_FORMAT, LOG_LEVEL
+from request_controller import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+SCRAPE_BACKEND = os.environ.get("SCRAPE_BACKEND", "process").lower()
+# Processi del pool di parsing (default: uno per core)
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", str(os.cpu_count() or 2)))
+# Attesa massima del risultato di un job remoto, e ogni quanto il bot controlla i job conclusi
+SCRAPE_JOB_TIMEOUT = float(os.environ.get("SCRAPE_JOB_TIMEOUT", "90"))
+SCRAPE_JOB_POLL = float(os.environ.get("SCRAPE_JOB_POLL", "0.2"))
+
+# Il bot delega lo scraping ai worker; scrape_worker.py lo rimette a False (il worker scarica davvero)
+REMOTE_SCRAPING = SCRAPE_BACKEND == "postgres"
+
+CIRCUIT_ERROR = "circuit_open"
+
+# --- Pool di processi per il lavoro CPU-bound ---
+
+_process_pool = None
+
+def _init_parse_process() -> None:
+    # Il figlio eredita il QueueHandler del padre ma non il thread che svuota la coda: log diretti su stderr
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # forkserver/spawn: niente fork di un processo con thread attivi (listener dei log, pool DB).
+        # Ogni processo reimporta lo script principale come __mp_main__: bot.py e scrape_worker.py
+        # avviano il logging (e il suo thread) solo in main(), non all'import.
+        # Il forkserver precarica solo il modulo di parsing, che non ha effetti collaterali
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        context = multiprocessing.get_context(method)
+        if method == "forkserver":
+            context.set_forkserver_preload(["extractors"])
+        _process_pool = ProcessPoolExecutor(
+            max_workers=PARSE_WORKERS,
+            mp_context=context,
+            initializer=_init_parse_process,
+        )
+        logger.info(f"Pool di parsing avviato ({PARSE_WORKERS} processi, {method}).")
+    return _process_pool
+
+def _noop() -> None:
+    pass
+
+async def run_cpu(func, *args):
+    """
+    Esegue una funzione CPU-bound (parsing HTML) fuori dall'event loop, secondo SCRAPE_BACKEND.
+    func e argomenti devono essere serializzabili con pickle (funzioni di modulo, bytes, dict).
+    """
+    global _process_pool
+    if SCRAPE_BACKEND == "thread" or PARSE_WORKERS <= 1:
+        return await asyncio.to_thread(func, *args)
+
+    loop = asyncio.get_running_loop()
+    try:
+        async with metrics.span("cpu_offload", func=func.__name__):
+            return await loop.run_in_executor(_get_process_pool(), func, *args)
+    except BrokenProcessPool:
+        # Un processo del pool è morto (es. OOM): si ricrea al prossimo uso, intanto si ripiega sul thread
+        logger.error("Pool di parsing interrotto, lo ricreo. Questo parsing passa da un thread.")
+        _process_pool = None
+        return await asyncio.to_thread(func, *args)
+
+async def warm_up_pool() -> None:
+    """Avvia i processi del pool in anticipo: il primo link non paga l'avvio dell'interprete."""
+    if SCRAPE_BACKEND == "thread" or PARSE_WORKERS <= 1:
+        return
+    loop = asyncio.get_running_loop()
+    pool = _get_process_pool()
+    await asyncio.gather(*(loop.run_in_executor(pool, _noop) for _ in range(PARSE_WORKERS)))
+
+def shutdown_workers(*_args) -> None:
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+# --- Job remoti (SCRAPE_BACKEND=postgres) ---
+
+def encode_circuit_error(error: CircuitOpenError) -> str:
+    return f"{CIRCUIT_ERROR} {error.retry_in:.1f} {error.host}"
+
+def _raise_if_circuit_open(error: str) -> None:
+    if error and error.startswith(CIRCUIT_ERROR):
+        _, retry_in, host = error.split(" ", 2)
+        raise CircuitOpenError(host, float(retry_in))
+
+class ScrapeJobClient:
+    """Lato bot: accoda i job e consegna i risultati a chi li attende. Un solo poller per tutte le attese."""
+
+    def __init__(self):
+        self._waiters = {}
+        self._poller = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._waiters)
+
+    async def submit(self, url: str, use_cache: bool = True) -> dict or None:
+        """
+        Accoda lo scraping di url e ne attende l'esito (dict prodotto o None).
+        Solleva CircuitOpenError se il worker ha trovato Amazon in blocco.
+        """
+        [job_id] = await database.db_call(database.enqueue_scrape_jobs, [(url, use_cache)])
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[job_id] = future
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll())
+
+        try:
+            async with metrics.span("scrape_job_wait"):
+                status, result, error = await asyncio.wait_for(future, SCRAPE_JOB_TIMEOUT)
+        except asyncio.TimeoutError:
+            metrics.inc("scrape_jobs_total", outcome="timeout")
+            logger.warning(f"Job di scraping {job_id} senza risposta dopo {SCRAPE_JOB_TIMEOUT:.0f}s: nessun worker attivo?")
+            try:
+                await database.db_call(database.cancel_scrape_jobs, [job_id])
+            except Exception as e:
+                logger.error(f"Errore cancellazione del job {job_id}: {e}")
+            return None
+        finally:
+            self._waiters.pop(job_id, None)
+
+        metrics.inc("scrape_jobs_total", outcome=status)
+        if status == "failed":
+            _raise_if_circuit_open(error)
+            logger.error(f"Job di scraping {job_id} fallito: {error}")
+            return None
+        return result
+
+    async def _poll(self) -> None:
+        """Finché qualcuno attende: ritira in una query tutti i job conclusi e sveglia le attese."""
+        while self._waiters:
+            await asyncio.sleep(SCRAPE_JOB_POLL)
+            try:
+                rows = await database.db_call(database.take_finished_scrape_jobs, list(self._waiters))
+            except Exception as e:
+                logger.error(f"Errore lettura dei job di scraping conclusi: {e}")
+                continue
+            for job_id, status, result, error in rows:
+                future = self._waiters.get(job_id)
+                if future is not None and not future.done():
+                    future.set_result((status, result, error))
+
+scrape_client = ScrapeJobClient()
+
+def _worker_samples() -> list:
+    return [("scrape_jobs_waiting", "gauge", {}, scrape_client.pending)]
+
+metrics.register_collector(_worker_samples)